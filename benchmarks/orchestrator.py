@@ -0,0 +1,127 @@
+#!/usr/bin/python3
+#
+# Copyright (C) 2024 FreeIPA Contributors see COPYING for license
+#
+"""
+Measure the overhead of ipaperftest itself at large host counts.
+
+Every test is run end to end against the simulation provider, which
+fakes the hosts locally, so what is measured is the orchestration:
+wall time, peak memory and peak open file descriptors of the
+ipaperftest process. Each case runs in a fresh interpreter and
+working directory. Run it from an environment where ipaperftest is
+installed (or with src/ and an egg-info directory on PYTHONPATH):
+
+    python3 benchmarks/orchestrator.py --sizes 10 100 --output base.json
+    python3 benchmarks/orchestrator.py --sizes 10 100 --compare base.json
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+TESTS = {
+    # Each size is the number of simulated clients
+    "EnrollmentTest": lambda n: ["--amount", str(n)],
+    "AuthenticationTest": lambda n: ["--amount", str(n), "--threads", "10"],
+    "CertIssuanceTest": lambda n: ["--amount", str(n), "--cert-requests", "1"],
+    "APITest": lambda n: ["--amount", str(n), "--commands-per-client", "1",
+                          "--command", "ipa user-find"],
+    # A single server, the size is the number of group members
+    "GroupSizeTest": lambda n: ["--amount", "1", "--threads", str(n)],
+}
+RUN = "from ipaperftest.core.main import main\nmain()\n"
+
+
+class FdSampler(threading.Thread):
+    """Record the peak number of open file descriptors of a process"""
+    def __init__(self, pid, interval=0.05):
+        super().__init__(daemon=True)
+        self.path = "/proc/%d/fd" % pid
+        self.interval = interval
+        self.peak = None
+        self.done = threading.Event()
+
+    def run(self):
+        while not self.done.is_set():
+            try:
+                self.peak = max(self.peak or 0, len(os.listdir(self.path)))
+            except OSError:
+                pass
+            self.done.wait(self.interval)
+
+
+def measure(test, size):
+    argv = [sys.executable, "-c", RUN, test, "--provider", "simulation"] + TESTS[test](size)
+    with tempfile.TemporaryDirectory(prefix="ipaperftest-bench-") as cwd:
+        start = time.perf_counter()
+        proc = subprocess.Popen(argv, cwd=cwd, stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL)
+        sampler = FdSampler(proc.pid)
+        sampler.start()
+        _, status, usage = os.wait4(proc.pid, 0)
+        wall = time.perf_counter() - start
+        sampler.done.set()
+        sampler.join()
+        proc.returncode = os.waitstatus_to_exitcode(status) \
+            if hasattr(os, "waitstatus_to_exitcode") else status >> 8
+    # ru_maxrss is in KiB on Linux
+    return {
+        "test": test,
+        "size": size,
+        "returncode": proc.returncode,
+        "wall": round(wall, 3),
+        "max_rss": round(usage.ru_maxrss / 1024, 1),
+        "max_fds": sampler.peak,
+    }
+
+
+def ratio(value, base):
+    if not value or not base:
+        return ""
+    return "x%.2f" % (value / base)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 5000])
+    parser.add_argument("--tests", nargs="+", choices=sorted(TESTS), default=sorted(TESTS))
+    parser.add_argument("--output", help="Write the measurements to this JSON file")
+    parser.add_argument("--compare", help="JSON file written by a previous --output")
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = {(m["test"], m["size"]): m for m in json.load(f)}
+
+    # Every command in flight holds pipes open, like on a real run
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    print("%-20s %6s %4s %10s %8s %10s %8s %8s" % (
+        "test", "hosts", "rc", "wall s", "", "RSS MiB", "", "max fds"))
+    measurements = []
+    for test in args.tests:
+        for size in args.sizes:
+            m = measure(test, size)
+            measurements.append(m)
+            base = baseline.get((test, size), {})
+            print("%-20s %6s %4s %10.1f %8s %10.1f %8s %8s" % (
+                test, size, m["returncode"], m["wall"], ratio(m["wall"], base.get("wall")),
+                m["max_rss"], ratio(m["max_rss"], base.get("max_rss")),
+                "?" if m["max_fds"] is None else m["max_fds"]))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(measurements, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
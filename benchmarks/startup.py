@@ -0,0 +1,67 @@
+#!/usr/bin/python3
+#
+# Copyright (C) 2024 FreeIPA Contributors see COPYING for license
+#
+"""
+Measure the startup cost of ipaperftest.
+
+Each case runs in a fresh interpreter so that nothing is cached
+between runs. Run it from an environment where ipaperftest is
+installed (or with src/ and an egg-info directory on PYTHONPATH):
+
+    python3 benchmarks/startup.py --runs 20
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+CASES = {
+    "interpreter": "pass",
+    "import pkg_resources": "import pkg_resources",
+    "import ipaperftest.core.main": "import ipaperftest.core.main",
+    "ipaperftest --help": (
+        "import sys\n"
+        "from ipaperftest.core.main import main\n"
+        "sys.argv = ['ipaperftest', '--help']\n"
+        "main()\n"
+    ),
+    "resolve one plugin": (
+        "from ipaperftest.core.main import find_registries, find_plugin\n"
+        "for name, registry in find_registries(['ipaperftest.registry']).items():\n"
+        "    assert find_plugin(name, registry, 'EnrollmentTest') is not None\n"
+    ),
+}
+
+
+def measure(code, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], check=True,
+                       stdout=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    print("%-30s %10s %10s %10s" % ("case", "min ms", "median ms", "max ms"))
+    for name, code in CASES.items():
+        try:
+            timings = measure(code, args.runs)
+        except subprocess.CalledProcessError:
+            print("%-30s %10s" % (name, "failed"))
+            continue
+        print("%-30s %10.1f %10.1f %10.1f" % (
+            name, min(timings) * 1000, statistics.median(timings) * 1000,
+            max(timings) * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -40,6 +40,8 @@ Requires:       libvirt
 Requires:       ansible
 Requires:       git
 Requires:       rsync
+Requires:       python3-pyyaml
+Recommends:     podman
 
 %description controller
 freeipa-perftest is a performance measurement tool for
@@ -76,9 +78,9 @@ popd
 %license COPYING
 %doc README.md
 %{_bindir}/ipaperftest
+%{_bindir}/ipaperftest-campaign
 %{python3_sitelib}/ipaperftest
 %{python3_sitelib}/ipaperftest-%{version}-*.egg-info/
-%{python3_sitelib}/ipaperftest-%{version}-*-nspkg.pth
 
 
 %changelog
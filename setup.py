@@ -4,31 +4,37 @@ from setuptools import setup
 setup(
     name='ipaperftest',
     version='0.4.1',
-    namespace_packages=['ipaperftest', ],
     package_dir={'': 'src'},
     packages=[
+        'ipaperftest',
         'ipaperftest.core',
+        'ipaperftest.plugins',
+        'ipaperftest.providers',
     ],
     entry_points={
         # creates bin/ipaperftest
         'console_scripts': [
             'ipaperftest = ipaperftest.core.main:main',
+            'ipaperftest-campaign = ipaperftest.core.campaign:main',
         ],
         # subsystem registries
         'ipaperftest.registry': [
             'ipaperftest.plugins = ipaperftest.plugins.registry:registry',
         ],
         # plugin modules for ipaperftest.plugins registry
+        # named after the plugin class so that only the selected test is loaded
         'ipaperftest.plugins': [
-            'apitest = ipaperftest.plugins.apitest',
-            'authenticationtest = ipaperftest.plugins.authenticationtest',
-            'certissuetest = ipaperftest.plugins.certissuetest',
-            'enrollmenttest = ipaperftest.plugins.enrollmenttest',
-            'groupsizetest = ipaperftest.plugins.groupsizetest',
+            'APITest = ipaperftest.plugins.apitest:APITest',
+            'AuthenticationTest = ipaperftest.plugins.authenticationtest:AuthenticationTest',
+            'CertIssuanceTest = ipaperftest.plugins.certissuetest:CertIssuanceTest',
+            'EnrollmentTest = ipaperftest.plugins.enrollmenttest:EnrollmentTest',
+            'GroupSizeTest = ipaperftest.plugins.groupsizetest:GroupSizeTest',
         ],
     },
     install_requires=[
         'click',
+        # campaign files of ipaperftest-campaign, replica topology files
+        'PyYAML',
     ],
     classifiers=[
         'Programming Language :: Python :: 3.8',
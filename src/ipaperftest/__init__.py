@@ -2,4 +2,4 @@
 # Copyright (C) 2021 FreeIPA Contributors see COPYING for license
 #
 
-__import__('pkg_resources').declare_namespace(__name__)
+__path__ = __import__('pkgutil').extend_path(__path__, __name__)
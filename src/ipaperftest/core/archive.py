@@ -0,0 +1,221 @@
+#
+# Copyright (C) 2024 FreeIPA Contributors see COPYING for license
+#
+
+import gzip
+import hashlib
+import json
+import lzma
+import os
+import shutil
+import subprocess as sp
+import tarfile
+
+# codec: (file extension, whether Python can compress it when no
+# external compressor is available, default level, levels accepted by
+# the external compressor)
+CODECS = {
+    "gz": (".tar.gz", True, 6, range(0, 12)),
+    "xz": (".tar.xz", True, 6, range(0, 10)),
+    "zstd": (".tar.zst", False, 3, range(1, 20)),
+    "none": (".tar", True, None, None),
+}
+# Highest level of the gzip and lzma modules
+PYTHON_MAX_LEVEL = 9
+
+
+def check_level(codec, level):
+    """Return why level cannot be used with codec, or None"""
+    levels = CODECS[codec][3]
+    if level is None or levels is None or level in levels:
+        return None
+    return "--archive-codec %s accepts levels %s to %s, not %s." % (
+        codec, levels[0], levels[-1], level)
+
+
+def compressor_command(codec, level):
+    """Return the argv of a multi-threaded compressor for codec
+
+       None is returned when no suitable compressor is installed.
+    """
+    if codec == "gz" and shutil.which("pigz"):
+        return ["pigz", "-c", "-%d" % level, "-p", str(os.cpu_count() or 1)]
+    if codec == "xz" and shutil.which("xz"):
+        return ["xz", "-c", "-%d" % level, "-T0"]
+    if codec == "zstd" and shutil.which("zstd"):
+        return ["zstd", "-c", "-q", "-%d" % level, "-T0"]
+    return None
+
+
+def python_compressor(codec, out, level):
+    """Return a file object compressing into out at level
+
+       None is returned for the none codec.
+    """
+    if codec == "gz":
+        return gzip.GzipFile(fileobj=out, mode="wb", compresslevel=level)
+    if codec == "xz":
+        return lzma.LZMAFile(out, "wb", preset=level)
+    return None
+
+
+class HashingReader:
+    """
+    Read exactly size bytes from f while computing their sha256.
+
+    A file truncated while it is archived is padded with zeros so
+    that the size already written in the tar header stays valid.
+    """
+    def __init__(self, f, size):
+        self.f = f
+        self.left = size
+        self.sha256 = hashlib.sha256()
+
+    def read(self, n=-1):
+        if n < 0 or n > self.left:
+            n = self.left
+        data = self.f.read(n)
+        data += b"\0" * (n - len(data))
+        self.left -= n
+        self.sha256.update(data)
+        return data
+
+
+def walk(paths):
+    """Yield every path under paths, directories before their content"""
+    for path in paths:
+        if not os.path.lexists(path):
+            continue
+        yield path
+        if os.path.isdir(path) and not os.path.islink(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in dirs + sorted(files):
+                    yield os.path.join(root, name)
+
+
+def add_files(tar, paths):
+    """Add paths to tar, returning the manifest entry of every file"""
+    entries = []
+    for path in walk(paths):
+        info = tar.gettarinfo(path, arcname=os.path.normpath(path))
+        if not info.isreg():
+            tar.addfile(info)
+            continue
+        try:
+            with open(path, "rb") as f:
+                reader = HashingReader(f, info.size)
+                tar.addfile(info, reader)
+        except OSError as e:
+            print("Unable to archive %s: %s" % (path, e))
+            continue
+        entries.append({
+            "path": info.name,
+            "size": info.size,
+            "mtime": info.mtime,
+            "sha256": reader.sha256.hexdigest(),
+        })
+    return entries
+
+
+def checked_members(tar):
+    """Return the members of tar, refusing any that would be written
+       outside of the directory it is extracted to
+
+       Absolute paths, .. components, links pointing out of the
+       archive and device files raise a tarfile.TarError.
+    """
+    def inside(path):
+        path = os.path.normpath(path)
+        return not os.path.isabs(path) and path != ".." \
+            and not path.startswith(".." + os.sep)
+
+    members = tar.getmembers()
+    for member in members:
+        if not inside(member.name):
+            raise tarfile.TarError("Refusing to extract %s." % member.name)
+        if member.issym() and not inside(os.path.join(os.path.dirname(member.name),
+                                                      member.linkname)):
+            raise tarfile.TarError("Refusing to extract the link %s to %s."
+                                   % (member.name, member.linkname))
+        if member.islnk() and not inside(member.linkname):
+            raise tarfile.TarError("Refusing to extract the link %s to %s."
+                                   % (member.name, member.linkname))
+        if member.isdev():
+            raise tarfile.TarError("Refusing to extract the device %s." % member.name)
+    return members
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def write_archive(name, paths, codec="gz", level=None):
+    """Stream paths into a tar archive compressed with codec
+
+       The tar stream is piped into a multi-threaded compressor (pigz,
+       xz or zstd) when one is installed. Otherwise Python's own
+       single-threaded compression is used, up to level 9, and zstd
+       falls back to gz. A manifest listing the size and sha256
+       of every file is written next to the archive as
+       <name>.manifest.json.
+
+       Returns the paths of the archive and of the manifest.
+    """
+    if codec not in CODECS:
+        raise RuntimeError("Unknown archive codec '%s'." % codec)
+    error = check_level(codec, level)
+    if error:
+        raise RuntimeError(error)
+    extension, fallback, default_level, levels = CODECS[codec]
+    if level is None:
+        level = default_level
+
+    command = compressor_command(codec, level) if level is not None else None
+    if command is None and not fallback:
+        print("No %s compressor found, using gz instead." % codec)
+        codec = "gz"
+        extension, fallback, default_level, levels = CODECS[codec]
+        level = default_level
+    if command is None and level is not None and level > PYTHON_MAX_LEVEL:
+        print("No %s compressor found, using level %s instead of %s."
+              % (codec, PYTHON_MAX_LEVEL, level))
+        level = PYTHON_MAX_LEVEL
+
+    archive = name + extension
+    with open(archive, "wb") as out:
+        if command:
+            proc = sp.Popen(command, stdin=sp.PIPE, stdout=out)
+            try:
+                with tarfile.open(fileobj=proc.stdin, mode="w|") as tar:
+                    entries = add_files(tar, paths)
+            finally:
+                proc.stdin.close()
+                returncode = proc.wait()
+            if returncode != 0:
+                raise RuntimeError("%s exited with %s while writing %s."
+                                   % (command[0], returncode, archive))
+        else:
+            stream = python_compressor(codec, out, level)
+            try:
+                with tarfile.open(fileobj=stream or out, mode="w|") as tar:
+                    entries = add_files(tar, paths)
+            finally:
+                if stream is not None:
+                    stream.close()
+
+    manifest = name + ".manifest.json"
+    with open(manifest, "w") as f:
+        json.dump({
+            "archive": os.path.basename(archive),
+            "codec": codec,
+            "level": level,
+            "archive_size": os.path.getsize(archive),
+            "archive_sha256": file_sha256(archive),
+            "files": entries,
+        }, f, indent=2)
+    return archive, manifest
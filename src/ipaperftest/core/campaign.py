@@ -0,0 +1,293 @@
+#
+# Copyright (C) 2024 FreeIPA Contributors see COPYING for license
+#
+
+import click
+import itertools
+import json
+import os
+import sys
+import traceback
+import yaml
+
+from ipaperftest.core.constants import SUCCESS, getLevelName
+from ipaperftest.core.main import RunTest, make_test_context
+
+# Options that change the machines deployed or how IPA is installed.
+# Points that only differ in other options can share one deployment.
+PROVISIONING_OPTIONS = (
+    "test",
+    "provider",
+    "replicas",
+    "replica_topology",
+    "replica_topology_file",
+    "replica_fanout",
+    "amount",
+    "server_image",
+    "client_image",
+    "custom_repo_url",
+    "client_cpus",
+    "client_memory",
+    "commands_per_client",
+    "api_mode",
+    "api_target_concurrency",
+    "sequential",
+    "ad_threads",
+    "private_key",
+    "idmci_lifetime",
+)
+
+
+class CampaignPoint:
+    """
+    A single run of a campaign.
+
+    :param index: Position of the point in the campaign file order.
+    :param options: ipaperftest options of the run, using the
+                    parameter names of main().
+    :param varied: Names of the options set by the matrix.
+    """
+    def __init__(self, index, options, varied):
+        self.index = index
+        self.options = options
+        self.varied = varied
+        self.reuse = False
+        self.returncode = None
+        self.execution_time = None
+        self.archive = None
+        self.metrics = {}
+        self.error = None
+
+    def provisioning_key(self):
+        return tuple(
+            (name, json.dumps(self.options.get(name), sort_keys=True))
+            for name in PROVISIONING_OPTIONS
+        )
+
+    def args(self):
+        """Return the ipaperftest command line arguments of the point"""
+        args = []
+        for name, value in sorted(self.options.items()):
+            option = "--" + name.replace("_", "-")
+            if isinstance(value, bool):
+                if value:
+                    args.append(option)
+                continue
+            if value is None:
+                continue
+            values = value if isinstance(value, (list, tuple)) else [value]
+            for v in values:
+                args.extend([option, str(v)])
+        if self.reuse:
+            args.append("--reuse-deployment")
+        return args
+
+
+def load_campaign(path):
+    """Read a campaign file and expand its matrix into points
+
+       The file is a YAML mapping with the options shared by every
+       point (``test``, ``provider`` and any ``options``) and a
+       ``matrix`` of option name to the list of values to sweep::
+
+           test: AuthenticationTest
+           provider: vagrant
+           options:
+             amount: 10
+           matrix:
+             threads: [10, 50, 100, 500]
+             wsgi_processes: [2, 4, 8]
+             replicas: [0, 2]
+    """
+    with open(path) as f:
+        campaign = yaml.safe_load(f) or {}
+    if not isinstance(campaign, dict):
+        raise RuntimeError("The campaign file must contain a mapping.")
+
+    base = dict(campaign.get("options") or {})
+    for name in ("test", "provider"):
+        if name in campaign:
+            base[name] = campaign[name]
+    if "test" not in base:
+        raise RuntimeError("The campaign does not define a test.")
+    base = {name.replace("-", "_"): value for name, value in base.items()}
+
+    matrix = campaign.get("matrix") or {}
+    names = [name.replace("-", "_") for name in matrix.keys()]
+    for name, values in zip(names, matrix.values()):
+        if not isinstance(values, list) or not values:
+            raise RuntimeError("Matrix entry '%s' must be a non-empty list." % name)
+
+    points = []
+    for index, values in enumerate(itertools.product(*matrix.values())):
+        options = dict(base)
+        options.update(zip(names, values))
+        points.append(CampaignPoint(index, options, names))
+    return points
+
+
+def plan_campaign(points):
+    """Order points so that those sharing a deployment run back to back
+
+       The first point of each group provisions the machines and the
+       following ones reuse them, resetting the IPA state unless the
+       campaign sets reset_ipa_state to false. Groups keep the order in
+       which they first appear in the campaign file.
+    """
+    groups = {}
+    for point in points:
+        groups.setdefault(point.provisioning_key(), []).append(point)
+
+    ordered = []
+    for group in groups.values():
+        for i, point in enumerate(group):
+            set_reuse(point, i > 0)
+            ordered.append(point)
+    return ordered
+
+
+def set_reuse(point, reuse):
+    """Make point reuse the deployment of the previous one, or not"""
+    point.reuse = reuse
+    point.options["reset_ipa_state"] = reuse and point.options.get("reset_ipa_state", True)
+
+
+def collect_metrics(results):
+    """Gather the numeric keywords reported by the test itself"""
+    metrics = {}
+    for result in results.results:
+        if "phase" in result.kw:
+            continue
+        for key, value in result.kw.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                metrics[key] = value
+    return metrics
+
+
+def run_point(point, name):
+    """Run one point through RunTest, like a separate ipaperftest run"""
+    print("Running point %s: %s" % (point.index, " ".join(point.args())))
+    test = None
+    try:
+        ctx = make_test_context(point.args())
+        with ctx:
+            test = RunTest(['ipaperftest.registry'])
+            point.returncode = test.run(ctx)
+    except Exception:
+        point.returncode = 1
+        point.error = traceback.format_exc()
+
+    if test is None or test.plugin is None:
+        return False
+    plugin = test.plugin
+    point.execution_time = getattr(plugin, "execution_time", None)
+    point.metrics = collect_metrics(test.results)
+    errors = [r for r in test.results.results if r.result != SUCCESS]
+    if errors and point.error is None:
+        point.error = "; ".join(
+            "%s: %s" % (getLevelName(r.result),
+                        r.kw.get("error") or r.kw.get("exception") or r.kw.get("msg", ""))
+            for r in errors)
+
+    # Archives of points run within the same minute would share a name
+    for attr in ("manifest_path", "archive_path"):
+        path = getattr(plugin, attr, None)
+        if path and os.path.exists(path):
+            point.archive = "%s-%03d-%s" % (name, point.index, path)
+            os.rename(path, point.archive)
+
+    # Later points can only reuse a deployment that got installed
+    phases = getattr(plugin, "phases", [])
+    return any(p["phase"] == "enable_data_collection" and p["outcome"] == "success"
+               for p in phases)
+
+
+def format_table(points):
+    varied = []
+    for point in points:
+        varied.extend(v for v in point.varied if v not in varied)
+    header = ["point"] + varied + ["reuse", "result", "execution_time", "archive"]
+    rows = [header]
+    for point in sorted(points, key=lambda p: p.index):
+        if point.returncode is None:
+            result = "not run"
+        else:
+            result = "ok" if point.returncode == 0 else "failed"
+        time_str = ("%.3f" % point.execution_time
+                    if isinstance(point.execution_time, (int, float)) else "-")
+        rows.append([str(point.index)]
+                    + [str(point.options.get(v)) for v in varied]
+                    + ["yes" if point.reuse else "no", result, time_str,
+                       point.archive or "-"])
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    return "\n".join(
+        "  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip()
+        for row in rows
+    ) + "\n"
+
+
+def format_json(points):
+    return json.dumps([
+        {
+            "point": point.index,
+            "options": point.options,
+            "reuse": point.reuse,
+            "returncode": point.returncode,
+            "execution_time": point.execution_time,
+            "archive": point.archive,
+            "metrics": point.metrics,
+            "error": point.error,
+        }
+        for point in sorted(points, key=lambda p: p.index)
+    ], indent=2) + "\n"
+
+
+def write_report(points, output_format, output_file):
+    report = format_json(points) if output_format == "json" else format_table(points)
+    if output_file:
+        with open(output_file, "w") as f:
+            f.write(report)
+    else:
+        sys.stdout.write(report)
+
+
+@click.command("campaign", context_settings={"show_default": True})
+@click.argument("campaign_file", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--results-format",
+    help="Format of the aggregated results.",
+    type=click.Choice(["table", "json"]), default="table"
+)
+@click.option(
+    "--results-output-file",
+    help="File to write the aggregated results to, updated after every point.",
+)
+@click.option(
+    "--dry-run",
+    help="Only print the points in the order they would be run.",
+    is_flag=True
+)
+def main(campaign_file, results_format="table", results_output_file=None, dry_run=False):
+    try:
+        points = plan_campaign(load_campaign(campaign_file))
+    except (OSError, yaml.YAMLError, RuntimeError) as e:
+        print("Unable to load campaign: %s" % e)
+        sys.exit(1)
+
+    if dry_run:
+        for point in points:
+            print("%03d %s" % (point.index, " ".join(["ipaperftest"] + point.args())))
+        return
+
+    name = os.path.splitext(os.path.basename(campaign_file))[0]
+    deployment_ready = False
+    for point in points:
+        # Reprovision when the previous point left no usable deployment
+        if point.reuse and not deployment_ready:
+            set_reuse(point, False)
+        deployment_ready = run_point(point, name)
+        if results_output_file:
+            write_report(points, results_format, results_output_file)
+
+    write_report(points, results_format, None)
+    sys.exit(0 if all(p.returncode == 0 for p in points) else 1)
@@ -99,6 +99,27 @@ VAGRANT_HOST_TEMPLATE = """
     end
 """
 
+# Image of the podman provider: systemd as init, sshd reachable with the
+# key of the provider and the IPA packages installed beforehand, so that
+# hundreds of containers do not all download them.
+PODMAN_CONTAINERFILE_TEMPLATE = """
+FROM {image}
+RUN dnf install -y systemd openssh-server python3 sudo procps-ng hostname \\
+        iproute sysstat {packages} && \\
+    dnf clean all && \\
+    systemctl enable sshd && \\
+    mkdir -p -m 0700 /root/.ssh
+COPY authorized_keys /root/.ssh/authorized_keys
+RUN chmod 0600 /root/.ssh/authorized_keys
+STOPSIGNAL SIGRTMIN+3
+CMD ["/sbin/init"]
+"""
+
+PODMAN_PACKAGES = {
+    "server": "freeipa-server freeipa-server-dns freeipa-server-trust-ad",
+    "client": "freeipa-client",
+}
+
 HOSTS_FILE_TEMPLATE = """
 [ipaserver]
 {server_ip}
@@ -164,60 +185,30 @@ module_utils = {cwd}/ansible-freeipa/plugins/module_utils
 ssh_args = '-i "{private_key_path}" -i "{default_private_key_path}" -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -C -o ControlMaster=auto -o ControlPersist=60s'
 """
 
-ANSIBLE_FETCH_FILES_PLAYBOOK = """
----
-- name: Fetch IPA server log files
-  hosts: ipaserver, ipareplicas*
-  become: yes
-  ignore_errors: yes
-  tasks:
-    - synchronize:
-        src: "{{{{ item }}}}"
-        dest: "{cwd}/sync/{{{{ ansible_hostname }}}}/"
-        mode: pull
-        use_ssh_args: yes
-      with_items:
-        - "/var/log/ipaserver-install.log"
-        - "/var/log/ipaclient-install.log"
-        - "/var/log/httpd"
-        - "/var/log/dirsrv"
-        - "/var/log/krb5kdc.log"
-        - "/var/log/pki/pki-tomcat/ca"
-        - "~/saroutput"
-{custom_logs}
-
-- name: Fetch IPA replica log files
-  hosts: ipareplicas
-  become: yes
-  tasks:
-    - synchronize:
-        src: "{{{{ item }}}}"
-        dest: "{cwd}/sync/{{{{ ansible_hostname }}}}/"
-        mode: pull
-        use_ssh_args: yes
-      with_items:
-        - "/var/log/ipareplica-install.log"
-        - "/var/log/httpd"
-        - "/var/log/dirsrv"
-        - "/var/log/krb5kdc.log"
-        - "/var/log/pki/pki-tomcat/ca"
-        - "~/saroutput"
-
-- name: Fetch IPA clients log files
-  hosts: ipaclients
-  become: yes
-  ignore_errors: yes
-  tasks:
-    - synchronize:
-        src: "{{{{ item }}}}"
-        dest: "{cwd}/sync/{{{{ ansible_hostname }}}}/"
-        mode: pull
-        use_ssh_args: yes
-      with_items:
-        - "/var/log/ipaclient-install.log"
-{custom_logs}
+# Logs collected from each kind of host, in addition to the test's
+# custom logs. Paths not starting with / are relative to root's home.
+SERVER_LOG_FILES = [
+    "/var/log/ipaserver-install.log",
+    "/var/log/ipaclient-install.log",
+    "/var/log/httpd",
+    "/var/log/dirsrv",
+    "/var/log/krb5kdc.log",
+    "/var/log/pki/pki-tomcat/ca",
+]
 
-"""
+REPLICA_LOG_FILES = [
+    "/var/log/ipareplica-install.log",
+    "/var/log/httpd",
+    "/var/log/dirsrv",
+    "/var/log/krb5kdc.log",
+    "/var/log/pki/pki-tomcat/ca",
+]
+
+CLIENT_LOG_FILES = [
+    "/var/log/ipaclient-install.log",
+]
+
+SAR_OUTPUT_FILE = "~/saroutput"
 
 ANSIBLE_SERVER_ADD_REPO_PLAYBOOK = """
 ---
@@ -266,39 +257,35 @@ ANSIBLE_REPLICA_CONFIG_PLAYBOOK = """
         line: nameserver {server_ip}
 """
 
+# Run once per tier. With the free strategy every replica goes
+# through the role at its own pace instead of waiting for the slowest
+# one of the tier after each task.
 ANSIBLE_REPLICA_INSTALL_PLAYBOOK = """
 ---
-- name: Install IPA replicas (tier0)
-  hosts: ipareplicas_tier0
-  become: true
-
-  roles:
-  - role: ipareplica
-    state: present
-
-- name: Install IPA replicas (tier1)
-  hosts: ipareplicas_tier1
-  become: true
-
-  roles:
-  - role: ipareplica
-    state: present
-
-- name: Install IPA replicas (tier2)
-  hosts: ipareplicas_tier2
+- name: Install IPA replicas (tier{tier})
+  hosts: ipareplicas_tier{tier}
   become: true
+  strategy: free
 
   roles:
   - role: ipareplica
     state: present
+"""
 
-- name: Install IPA replicas (tier3)
-  hosts: ipareplicas_tier3
-  become: true
-
-  roles:
-  - role: ipareplica
-    state: present
+ANSIBLE_REPLICA_SEGMENTS_PLAYBOOK = """
+---
+- name: Add the replication segments not created by the replica installs
+  hosts: ipaserver
+  become: yes
+  tasks:
+    - command: "kinit admin"
+      args:
+        stdin: "password"
+    - command: >
+        ipa topologysegment-add {{{{ item[0] }}}} {{{{ item[1] }}}}-to-{{{{ item[2] }}}}
+        --leftnode={{{{ item[1] }}}}.{domain} --rightnode={{{{ item[2] }}}}.{domain}
+      with_items:
+{segments}
 """
 
 ANSIBLE_ENABLE_DATA_COLLECTION_PLAYBOOK = """
@@ -307,7 +294,37 @@ ANSIBLE_ENABLE_DATA_COLLECTION_PLAYBOOK = """
   hosts: ipaserver, ipareplicas*
   tasks:
     - shell:
-        cmd: "nohup sar -o ~/saroutput 2 >/dev/null 2>&1 &"
+        cmd: "pkill -x sar; pkill -x sadc; rm -f ~/saroutput; nohup sar -o ~/saroutput 2 >/dev/null 2>&1 &"
+"""
+
+ANSIBLE_RESET_IPA_STATE_PLAYBOOK = """
+---
+- name: Unenroll clients and remove the output of previous runs
+  hosts: ipaclients
+  become: yes
+  ignore_errors: yes
+  tasks:
+    - shell:
+        cmd: "ipa-client-install --uninstall -U"
+    - shell:
+        cmd: "kdestroy -A; rm -f {custom_logs}"
+        chdir: /root
+
+- name: Remove the client hosts and restart IPA
+  hosts: ipaserver
+  become: yes
+  ignore_errors: yes
+  tasks:
+    - shell:
+        cmd: >
+          echo password | kinit admin &&
+          for host in $(ipa host-find --pkey-only --sizelimit=0 |
+          awk '/Host name: client/ {{print $3}}'); do ipa host-del $host --updatedns; done;
+          kdestroy
+    - shell:
+        cmd: "rm -f {custom_logs}"
+        chdir: /root
+    - command: ipactl restart
 """
 
 ANSIBLE_ENROLLMENTTEST_CLIENT_CONFIG_PLAYBOOK = """
@@ -346,6 +363,21 @@ ANSIBLE_COUNT_IPA_HOSTS_PLAYBOOK = """
         cacheable: yes
 """
 
+ANSIBLE_UPLOAD_CLIENT_FILES_PLAYBOOK = """
+---
+- name: Upload files from the metadata folder to client machines
+  hosts: ipaclients
+  become: yes
+  tasks:
+    - synchronize:
+        src: "{{{{ item }}}}"
+        dest: "/root"
+        mode: push
+        use_ssh_args: yes
+      with_items:
+{files}
+"""
+
 ANSIBLE_APITEST_CLIENT_CONFIG_PLAYBOOK = """
 ---
 - name: Configure client machines before installation
@@ -362,12 +394,6 @@ ANSIBLE_APITEST_CLIENT_CONFIG_PLAYBOOK = """
     - lineinfile:
         path: /etc/hosts
         line: {server_ip} server.{domain} server
-    - package:
-        name: at
-    - systemd:
-        name: atd
-        enabled: yes
-        state: started
 """
 
 ANSIBLE_APITEST_CLIENT_UPLOAD_SEQUENTIAL_SCRIPT_PLAYBOOK = """
@@ -649,3 +675,560 @@ ANSIBLE_CERTISSUANCETEST_SERVER_TUNING_PLAYBOOK = """
         name: httpd
         state: restarted
 """
+
+CERTISSUANCETEST_DRIVER_SCRIPT = """#!/usr/bin/python3
+# Issue certificate requests concurrently from this client and
+# record when each of them started and finished.
+import argparse
+import json
+import subprocess
+import threading
+import time
+
+
+def request(idx, args, records, lock):
+    nickname = "service%d" % idx
+    cmd = [
+        "ipa-getcert", "request", "-I", nickname,
+        "-K", "service%d/%s" % (idx, args.host),
+        "-f", "/etc/pki/tls/certs/service%d.pem" % idx,
+        "-k", "/etc/pki/tls/private/service%d.key" % idx,
+        "-v", "-w",
+    ]
+    start = time.time()
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    end = time.time()
+    with lock:
+        records.append({
+            "request": nickname,
+            "start": start,
+            "end": end,
+            "returncode": proc.returncode,
+            "output": proc.stdout.decode("utf-8", "replace").strip(),
+        })
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, required=True)
+    parser.add_argument("--host", required=True)
+    parser.add_argument("--start", type=float, required=True)
+    parser.add_argument("--output", default="certrequests.log")
+    args = parser.parse_args()
+
+    records = []
+    lock = threading.Lock()
+    threads = [
+        threading.Thread(target=request, args=(i, args, records, lock))
+        for i in range(args.requests)
+    ]
+    time.sleep(max(0, args.start - time.time()))
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    with open(args.output, "w") as f:
+        for record in sorted(records, key=lambda r: r["start"]):
+            f.write(json.dumps(record) + "\\n")
+
+    failures = len([r for r in records if r["returncode"] != 0])
+    print(json.dumps({
+        "start": min((r["start"] for r in records), default=args.start),
+        "end": max((r["end"] for r in records), default=args.start),
+        "requests": len(records),
+        "failures": failures,
+    }))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
+"""
+
+AUTHENTICATIONTEST_RATE_DRIVER_SCRIPT = """#!/usr/bin/python3
+# Open-loop authentication load: run one pamtest login per arrival of
+# a Poisson or fixed-interval process, without waiting for previous
+# logins to complete, and record the timing of each of them. At most
+# --workers logins are in flight, later arrivals wait for a worker.
+import argparse
+import json
+import random
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def arrivals(args):
+    rnd = random.Random(args.seed)
+    interval = 1.0 / args.rate
+    if args.arrival == "fixed":
+        t = args.phase * interval
+    else:
+        t = rnd.expovariate(args.rate)
+    while t < args.duration:
+        yield t
+        if args.arrival == "fixed":
+            t += interval
+        else:
+            t += rnd.expovariate(args.rate)
+
+
+def login(idx, scheduled, args, records, lock):
+    cmd = ["pamtest", "--threads", "1", "--first-user", str(idx % args.users)]
+    if args.fork:
+        cmd.append("-f")
+    start = time.time()
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    end = time.time()
+    returncode = proc.returncode
+    for line in proc.stdout.decode("utf-8", "replace").splitlines():
+        if line.startswith("Thread returned"):
+            returncode = int(line.replace("Thread returned ", "").strip())
+    with lock:
+        records.append({
+            "step": args.step,
+            "user": idx % args.users,
+            "scheduled": args.start + scheduled,
+            "start": start,
+            "end": end,
+            "returncode": returncode,
+        })
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rate", type=float, required=True)
+    parser.add_argument("--duration", type=float, required=True)
+    parser.add_argument("--start", type=float, required=True)
+    parser.add_argument("--arrival", choices=["poisson", "fixed"], default="poisson")
+    parser.add_argument("--phase", type=float, default=0)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--users", type=int, required=True)
+    parser.add_argument("--step", type=int, default=0)
+    parser.add_argument("--fork", action="store_true")
+    parser.add_argument("--workers", type=int, default=200)
+    parser.add_argument("--output", default="pamtest-rate.log")
+    args = parser.parse_args()
+
+    records = []
+    lock = threading.Lock()
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        for idx, scheduled in enumerate(arrivals(args)):
+            time.sleep(max(0, args.start + scheduled - time.time()))
+            pool.submit(login, idx, scheduled, args, records, lock)
+
+    with open(args.output, "a") as f:
+        for record in sorted(records, key=lambda r: r["scheduled"]):
+            f.write(json.dumps(record) + "\\n")
+
+    failures = len([r for r in records if r["returncode"] != 0])
+    print(json.dumps({"logins": len(records), "failures": failures}))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
+"""
+
+APITEST_RUNNER_SCRIPT = """#!/usr/bin/python3
+# Run the APITest commands assigned to this client, all at the same
+# epoch timestamp, and print a record with the start and end time of
+# each command on stdout when it completes.
+import argparse
+import json
+import subprocess
+import sys
+import threading
+import time
+
+
+def run(cmd_id, command, lock):
+    logfile = "command%slog" % cmd_id
+    start = time.time()
+    with open(logfile, "w") as f:
+        f.write(command + "\\n")
+        f.flush()
+        proc = subprocess.run(command, shell=True, stdout=f, stderr=subprocess.STDOUT)
+    end = time.time()
+    with open(logfile, "a") as f:
+        f.write("%s\\n" % proc.returncode)
+    event = {
+        "id": cmd_id,
+        "start": start,
+        "end": end,
+        "returncode": proc.returncode,
+    }
+    with lock:
+        sys.stdout.write(json.dumps(event) + "\\n")
+        sys.stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--commands", default="apitest_commands.json")
+    parser.add_argument("--client", required=True)
+    parser.add_argument("--start", type=float, required=True)
+    args = parser.parse_args()
+
+    with open(args.commands) as f:
+        commands = json.load(f).get(args.client, [])
+
+    lock = threading.Lock()
+    threads = [
+        threading.Thread(target=run, args=(cmd_id, command, lock))
+        for cmd_id, command in commands
+    ]
+    time.sleep(max(0, args.start - time.time()))
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
+"""
+
+APITEST_JSONRPC_SCRIPT = """#!/usr/bin/python3
+# Issue the APITest commands assigned to this client as JSON-RPC calls
+# over a fixed number of authenticated keep-alive HTTPS sessions, and
+# print a record with the start and end time of each call on stdout
+# when it completes.
+import argparse
+import http.client
+import json
+import ssl
+import sys
+import threading
+import time
+import urllib.parse
+
+
+class Session:
+    def __init__(self, args, cookie=None):
+        self.args = args
+        self.cookie = cookie
+        self.conn = None
+
+    def connect(self):
+        context = ssl.create_default_context(cafile=self.args.ca)
+        self.conn = http.client.HTTPSConnection(
+            self.args.server, context=context, timeout=self.args.timeout)
+        self.conn.connect()
+
+    def request(self, path, body, content_type, accept):
+        headers = {
+            "Content-Type": content_type,
+            "Accept": accept,
+            "Referer": "https://%s/ipa" % self.args.server,
+        }
+        if self.cookie:
+            headers["Cookie"] = self.cookie
+        # A keep-alive connection closed by the server is reopened once
+        for attempt in (0, 1):
+            try:
+                if self.conn is None:
+                    self.connect()
+                self.conn.request("POST", path, body=body, headers=headers)
+                response = self.conn.getresponse()
+                data = response.read()
+                return response, data
+            except (http.client.HTTPException, OSError):
+                if self.conn is not None:
+                    self.conn.close()
+                self.conn = None
+                if attempt:
+                    raise
+
+    def login(self):
+        body = urllib.parse.urlencode({"user": self.args.user,
+                                       "password": self.args.password})
+        response, _ = self.request("/ipa/session/login_password", body,
+                                   "application/x-www-form-urlencoded", "text/plain")
+        if response.status != 200:
+            raise RuntimeError("Login failed with HTTP %s" % response.status)
+        for header, value in response.getheaders():
+            if header.lower() == "set-cookie" and value.startswith("ipa_session="):
+                self.cookie = value.split(";")[0]
+        return self.cookie
+
+    def call(self, method, args, options):
+        body = json.dumps({"method": method, "params": [args, options], "id": 0})
+        response, data = self.request("/ipa/session/json", body,
+                                      "application/json", "application/json")
+        if response.status == 401:
+            self.login()
+            response, data = self.request("/ipa/session/json", body,
+                                          "application/json", "application/json")
+        if response.status != 200:
+            return {"error": {"message": "HTTP %s" % response.status}}
+        return json.loads(data.decode("utf-8"))
+
+
+def command_params(session, method):
+    # Map CLI option names to parameter names using the server metadata
+    try:
+        response = session.call("json_metadata", [], {"command": method})
+        result = response.get("result") or {}
+        if "commands" not in result:
+            result = result.get("result") or {}
+        metadata = result["commands"][method]
+    except (KeyError, TypeError, ValueError, AttributeError):
+        return {}
+    params = {}
+    for param in metadata.get("takes_options", []):
+        if not isinstance(param, dict):
+            continue
+        params[param.get("cli_name") or param["name"]] = param
+    return params
+
+
+def parse_argv(argv, params):
+    args = []
+    options = {}
+    i = 0
+    while i < len(argv):
+        token = argv[i]
+        i += 1
+        if not token.startswith("--"):
+            args.append(token)
+            continue
+        cli_name, sep, value = token[2:].partition("=")
+        param = params.get(cli_name, {})
+        if not sep:
+            if param.get("class") == "Flag" or i >= len(argv) or argv[i].startswith("-"):
+                value = True
+            else:
+                value = argv[i]
+                i += 1
+        name = param.get("name", cli_name.replace("-", "_"))
+        if param.get("multivalue") or name in options:
+            if name in options and not isinstance(options[name], list):
+                options[name] = [options[name]]
+            options.setdefault(name, []).append(value)
+        else:
+            options[name] = value
+    return args, options
+
+
+def write_log(cmd_id, command, output, returncode):
+    with open("command%slog" % cmd_id, "w") as f:
+        f.write(command + "\\n")
+        f.write(json.dumps(output) + "\\n")
+        f.write("%s\\n" % returncode)
+
+
+def worker(session, calls, args, lock):
+    while True:
+        with lock:
+            batch = calls[:args.batch_size]
+            del calls[:args.batch_size]
+        if not batch:
+            return
+        if len(batch) == 1:
+            method, params = batch[0][2], [batch[0][3], batch[0][4]]
+        else:
+            method = "batch"
+            params = [[{"method": call[2], "params": [call[3], call[4]]}
+                       for call in batch], {}]
+        start = time.time()
+        try:
+            response = session.call(method, *params)
+        except Exception as e:
+            response = {"error": {"message": str(e)}}
+        end = time.time()
+
+        if len(batch) == 1:
+            outputs = [response]
+        elif response.get("error"):
+            outputs = [response] * len(batch)
+        else:
+            outputs = response["result"]["results"]
+        for call, output in zip(batch, outputs):
+            returncode = 1 if output.get("error") else 0
+            write_log(call[0], call[1], output, returncode)
+            event = {
+                "id": call[0],
+                "start": start,
+                "end": end,
+                "returncode": returncode,
+            }
+            with lock:
+                sys.stdout.write(json.dumps(event) + "\\n")
+                sys.stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--commands", default="apitest_commands.json")
+    parser.add_argument("--client", required=True)
+    parser.add_argument("--start", type=float, required=True)
+    parser.add_argument("--server", required=True)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--user", default="admin")
+    parser.add_argument("--password", default="password")
+    parser.add_argument("--ca", default="/etc/ipa/ca.crt")
+    parser.add_argument("--timeout", type=float, default=300)
+    args = parser.parse_args()
+
+    with open(args.commands) as f:
+        commands = json.load(f).get(args.client, [])
+
+    # Log in and resolve every command before the start time, so that
+    # only the calls themselves are measured
+    session = Session(args)
+    session.login()
+    metadata = {}
+    calls = []
+    for cmd_id, command, argv in commands:
+        method = argv[0].replace("-", "_")
+        if method not in metadata:
+            metadata[method] = command_params(session, method)
+        call_args, call_options = parse_argv(argv[1:], metadata[method])
+        calls.append([cmd_id, command, method, call_args, call_options])
+
+    sessions = [session] + [Session(args, session.cookie)
+                            for _ in range(max(1, args.concurrency) - 1)]
+    for s in sessions[1:]:
+        s.connect()
+    lock = threading.Lock()
+    threads = [
+        threading.Thread(target=worker, args=(s, calls, args, lock))
+        for s in sessions
+    ]
+    time.sleep(max(0, args.start - time.time()))
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
+"""
+
+LOG_COLLECTOR_SCRIPT = """#!/usr/bin/python3
+# Write the requested log files to stdout as a gzip compressed tar
+# stream. With --mark, record the current size of the files instead,
+# so that a later --since-mark collection only sends what was
+# appended to them afterwards.
+import argparse
+import glob
+import json
+import os
+import sys
+import tarfile
+import time
+
+MARK_FILE = os.path.expanduser("~/.ipaperftest-log-offsets.json")
+
+
+def expand(patterns):
+    # Yield (path, arcname) for every file matching patterns
+    for pattern in patterns:
+        pattern = os.path.expanduser(pattern)
+        if not os.path.isabs(pattern):
+            pattern = os.path.join(os.path.expanduser("~"), pattern)
+        for match in sorted(glob.glob(pattern)):
+            base = os.path.basename(match.rstrip("/"))
+            if os.path.isdir(match):
+                for root, _, files in os.walk(match):
+                    for name in sorted(files):
+                        path = os.path.join(root, name)
+                        yield path, os.path.join(base, os.path.relpath(path, match))
+            elif os.path.isfile(match):
+                yield match, base
+
+
+def wait_for_sar(path, timeout):
+    # Wait until sar has written a sample after the collection started
+    path = os.path.expanduser(path)
+    start = time.time()
+    while time.time() - start < timeout:
+        try:
+            if os.stat(path).st_mtime > start:
+                break
+        except OSError:
+            return 0
+        time.sleep(0.5)
+    return time.time() - start
+
+
+class Segment:
+    # Read the size bytes of a file following its current position
+    def __init__(self, f, size):
+        self.f = f
+        self.left = size
+
+    def read(self, n=-1):
+        if n < 0 or n > self.left:
+            n = self.left
+        data = self.f.read(n)
+        # Pad a file truncated while it is read to keep the stream valid
+        data += b"\\0" * (n - len(data))
+        self.left -= n
+        return data
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mark", action="store_true")
+    parser.add_argument("--since-mark", action="store_true")
+    parser.add_argument("--whole", action="append", default=[])
+    parser.add_argument("--sar", default="")
+    parser.add_argument("--sar-timeout", type=float, default=30)
+    parser.add_argument("files", nargs="*")
+    args = parser.parse_args()
+
+    if args.mark:
+        offsets = {path: os.path.getsize(path) for path, _ in expand(args.files)}
+        with open(MARK_FILE, "w") as f:
+            json.dump(offsets, f)
+        return 0
+
+    sar_wait = wait_for_sar(args.sar, args.sar_timeout) if args.sar else 0
+
+    offsets = {}
+    if args.since_mark:
+        try:
+            with open(MARK_FILE) as f:
+                offsets = json.load(f)
+        except (OSError, ValueError):
+            pass
+    whole = set(path for path, _ in expand(args.whole))
+
+    summary = {"files": 0, "bytes": 0, "sar_wait": round(sar_wait, 3)}
+    out = os.fdopen(sys.stdout.fileno(), "wb")
+    with tarfile.open(fileobj=out, mode="w|gz") as tar:
+        for path, arcname in expand(args.files + args.whole):
+            try:
+                with open(path, "rb") as f:
+                    st = os.fstat(f.fileno())
+                    offset = 0 if path in whole else offsets.get(path, 0)
+                    # A file smaller than its mark was rotated, send all of it
+                    if offset > st.st_size:
+                        offset = 0
+                    info = tarfile.TarInfo(arcname)
+                    info.size = st.st_size - offset
+                    info.mtime = st.st_mtime
+                    info.mode = st.st_mode & 0o777
+                    f.seek(offset)
+                    tar.addfile(info, Segment(f, info.size))
+            except (OSError, tarfile.TarError) as e:
+                sys.stderr.write("Skipping %s: %s\\n" % (path, e))
+                continue
+            summary["files"] += 1
+            summary["bytes"] += info.size
+    out.flush()
+    sys.stderr.write(json.dumps(summary) + "\\n")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
+"""
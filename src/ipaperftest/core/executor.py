@@ -0,0 +1,197 @@
+#
+# Copyright (C) 2024 FreeIPA Contributors see COPYING for license
+#
+
+import asyncio
+import resource
+import time
+
+
+class CommandResult:
+    """
+    The outcome of a single remote command.
+
+    :param key: Caller-provided identifier, usually the host name.
+    :param target: Address the command was sent to.
+    :param command: The command line run by the remote shell.
+
+    start and end are epoch timestamps taken on the controller.
+    returncode is None only if the command could not be started.
+    """
+    def __init__(self, key, target, command):
+        self.key = key
+        self.target = target
+        self.command = command
+        self.returncode = None
+        self.stdout = b""
+        self.stderr = b""
+        self.start = None
+        self.end = None
+        self.timed_out = False
+
+    @property
+    def duration(self):
+        if self.start is None or self.end is None:
+            return None
+        return self.end - self.start
+
+    def __repr__(self):
+        return "CommandResult(%s, %s, rc=%s)" % (self.key, self.target, self.returncode)
+
+
+class RemoteExecutor:
+    """
+    Fan remote commands out from a single asyncio event loop.
+
+    At most max_concurrency commands are in flight at any time, and
+    each of them is killed once it has run for longer than timeout
+    seconds (no limit when timeout is None). Results are yielded in
+    completion order, not submission order.
+
+    The master connection of each host is started by the first
+    command sent to it; other commands for the same host wait for it
+    instead of racing to open their own connections. Commands past
+    the sessions a master allows get a connection of their own.
+
+    Usage::
+
+        executor = RemoteExecutor(ssh_pool, private_keys, max_concurrency=500)
+        for result in executor.run([(host, ip, "hostname"), ...]):
+            print(result.key, result.returncode)
+    """
+    def __init__(self, ssh_pool, private_keys, max_concurrency=500, timeout=None,
+                 cwd="runner_metadata"):
+        self.ssh_pool = ssh_pool
+        self.private_keys = private_keys
+        self.max_concurrency = max(1, max_concurrency)
+        self.timeout = timeout or None
+        self.cwd = cwd
+
+    def raise_fd_limit(self):
+        """Make sure the open files limit fits the concurrency bound
+
+           Every command in flight holds two pipes on the controller.
+        """
+        needed = self.max_concurrency * 4 + 256
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != resource.RLIM_INFINITY and soft < needed:
+            if hard != resource.RLIM_INFINITY:
+                needed = min(needed, hard)
+            resource.setrlimit(resource.RLIMIT_NOFILE, (needed, hard))
+
+    async def _connect(self, target, locks):
+        if self.ssh_pool.is_connected(target):
+            return
+        lock = locks.setdefault(target, asyncio.Lock())
+        async with lock:
+            if self.ssh_pool.is_connected(target):
+                return
+            proc = await asyncio.create_subprocess_exec(
+                *self.ssh_pool.master_args(target, self.private_keys),
+                cwd=self.cwd,
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL)
+            self.ssh_pool.register_master(target, await proc.wait())
+
+    async def _run_one(self, semaphore, locks, key, target, command, input, output,
+                       on_line):
+        result = CommandResult(key, target, command)
+        async with semaphore:
+            await self._connect(target, locks)
+            multiplex = self.ssh_pool.open_session(target)
+            try:
+                return await self._run_command(result, multiplex, input, output, on_line)
+            finally:
+                if multiplex:
+                    self.ssh_pool.close_session(target)
+
+    async def _communicate(self, proc, input, key, on_line):
+        """Like proc.communicate(), handing each line of stdout to on_line"""
+        if on_line is None:
+            return await proc.communicate(input)
+        if input:
+            proc.stdin.write(input)
+            await proc.stdin.drain()
+            proc.stdin.close()
+
+        async def read_lines():
+            async for line in proc.stdout:
+                on_line(key, line)
+
+        _, stderr, _ = await asyncio.gather(read_lines(), proc.stderr.read(), proc.wait())
+        return b"", stderr
+
+    async def _run_command(self, result, multiplex, input, output, on_line):
+        key, target, command = result.key, result.target, result.command
+        argv = self.ssh_pool.command_args(target, command, self.private_keys,
+                                          connect=False, multiplex=multiplex)
+        stdout = open(output(key), "wb") if output else asyncio.subprocess.PIPE
+        result.start = time.time()
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *argv,
+                cwd=self.cwd,
+                stdin=asyncio.subprocess.PIPE if input else asyncio.subprocess.DEVNULL,
+                stdout=stdout,
+                stderr=asyncio.subprocess.PIPE)
+        except OSError as e:
+            result.end = time.time()
+            result.stderr = str(e).encode("utf-8")
+            return result
+        finally:
+            if output:
+                stdout.close()
+        try:
+            stdout_data, result.stderr = await asyncio.wait_for(
+                self._communicate(proc, input, key, on_line), self.timeout)
+        except asyncio.TimeoutError:
+            result.timed_out = True
+            if proc.returncode is None:
+                proc.kill()
+            stdout_data, result.stderr = await proc.communicate()
+        result.stdout = stdout_data or b""
+        result.end = time.time()
+        result.returncode = proc.returncode
+        return result
+
+    async def _stream(self, commands, input, output, on_line):
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        locks = {}
+        tasks = [
+            asyncio.ensure_future(self._run_one(semaphore, locks, key, target, command,
+                                                input, output, on_line))
+            for key, target, command in commands
+        ]
+        try:
+            for future in asyncio.as_completed(tasks):
+                yield await future
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def run(self, commands, input=None, output=None, on_line=None):
+        """Run (key, target, command) tuples, yielding each CommandResult
+           as soon as it completes.
+
+           input is sent to the standard input of every command. When
+           output is given, it is called with the key of each command
+           and the standard output of the command is written to the
+           file it returns instead of being kept in memory. When on_line
+           is given, it is called with the key of each command and every
+           line of its standard output as soon as the line is read, and
+           the output is not kept either.
+        """
+        self.raise_fd_limit()
+        loop = asyncio.new_event_loop()
+        stream = self._stream(list(commands), input, output, on_line)
+        try:
+            while True:
+                try:
+                    yield loop.run_until_complete(stream.__anext__())
+                except StopAsyncIteration:
+                    break
+        finally:
+            loop.run_until_complete(stream.aclose())
+            loop.close()
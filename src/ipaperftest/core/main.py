@@ -3,14 +3,16 @@
 #
 
 import click
-import pkg_resources
+import importlib.metadata
 import sys
 import traceback
 
 from ipaperftest.core.plugin import Result, Results
 from ipaperftest.core.output import output_registry
+from ipaperftest.core.topology import TOPOLOGIES
 from ipaperftest.core.constants import (
     SUCCESS,
+    ERROR,
     CRITICAL
 )
 
@@ -41,21 +43,42 @@ class Registry:
             yield plugincls(self)
 
 
+def iter_entry_points(group):
+    eps = importlib.metadata.entry_points()
+    if hasattr(eps, "select"):
+        return eps.select(group=group)
+    # Python < 3.10 returns a dict of groups
+    return eps.get(group, [])
+
+
 def find_registries(entry_points):
     registries = {}
     for entry_point in entry_points:
         registries.update({
-            ep.name: ep.resolve()
-            for ep in pkg_resources.iter_entry_points(entry_point)
+            ep.name: ep.load()
+            for ep in iter_entry_points(entry_point)
         })
     return registries
 
 
-def find_plugins(name, registry):
-    for ep in pkg_resources.iter_entry_points(name):
-        # load module
+def find_plugin(name, registry, plugin_name):
+    """Return an instance of the plugin class plugin_name, or None
+
+       Plugin entry points are named after the class they point to,
+       so only the module of the requested plugin is imported. Entry
+       points naming a module instead are all imported as a fallback.
+    """
+    entry_points = list(iter_entry_points(name))
+    for ep in entry_points:
+        if ep.name == plugin_name:
+            return ep.load()(registry)
+
+    for ep in entry_points:
         ep.load()
-    return registry.get_plugins()
+    for plugincls in registry.plugins:
+        if plugincls.__name__ == plugin_name:
+            return plugincls(registry)
+    return None
 
 
 class RunTest:
@@ -66,21 +89,24 @@ class RunTest:
         """
         self.entry_points = entry_points
         self.results = Results()
+        self.plugin = None
 
     def run(self, ctx):
+        """Run the test selected in ctx and return the exit code"""
         for name, registry in find_registries(self.entry_points).items():
             registry.initialize()
-            for plugin in find_plugins(name, registry):
-                if plugin.__class__.__name__ != ctx.params['test']:
-                    continue
-                selected_plugin = plugin
-                try:
-                    self.results.add(Result(plugin, SUCCESS, args=sys.argv))
-                    for result in plugin.execute(ctx):
-                        self.results.add(result)
-                except Exception:
-                    except_res = Result(plugin, CRITICAL, exception=traceback.format_exc())
-                    self.results.add(except_res)
+            plugin = find_plugin(name, registry, ctx.params['test'])
+            if plugin is None:
+                continue
+            selected_plugin = plugin
+            self.plugin = plugin
+            try:
+                self.results.add(Result(plugin, SUCCESS, args=sys.argv))
+                for result in plugin.execute(ctx):
+                    self.results.add(result)
+            except Exception:
+                except_res = Result(plugin, CRITICAL, exception=traceback.format_exc())
+                self.results.add(except_res)
 
         output = None
         for out in output_registry.plugins:
@@ -91,26 +117,33 @@ class RunTest:
         # Output first to results_output_file / stdout, and then to runner_metadata
         # After that, build the tarfile will all the logs
         output.render(self.results)
+        if ctx.params.get('plan_only'):
+            # Warnings of the planner do not fail a plan
+            return 0 if all(r.result < ERROR for r in self.results.results) else 1
+        if selected_plugin.rejected:
+            # Nothing was run, sync/ and runner_metadata belong to another run
+            return 1
         output.filename = "runner_metadata/test_result"
         output.render(self.results)
         selected_plugin.archive_results(ctx)
 
         ret_val = 0
         for result in self.results.results:
+            # Warnings of the planner do not fail a run either
+            if result.kw.get("key") == "plan" and result.result < ERROR:
+                continue
             if result.result != SUCCESS:
                 ret_val = 1
                 break
 
-        sys.exit(ret_val)
+        return ret_val
 
 
-@click.command("cli", context_settings={"show_default": True})
-@click.option("--test", default="EnrollmentTest", help="Test to execute.",
-              type=click.Choice(["EnrollmentTest",
-                                 "APITest",
-                                 "AuthenticationTest",
-                                 "CertIssuanceTest",
-                                 "GroupSizeTest"]))
+PLUGIN_REGISTRIES = ['ipaperftest.registry']
+DEFAULT_TEST = "EnrollmentTest"
+
+
+@click.command("run", context_settings={"show_default": True})
 @click.option(
     "--client-image",
     help="Image to use for clients.",
@@ -126,13 +159,32 @@ class RunTest:
     type=click.IntRange(0, 64),
     help="Number of replicas to create.",
 )
-@click.option("--threads", default=10, help="Threads to run per client during AuthenticationTest.")
-@click.option("--ad-threads", default=0, help="Active Directory login threads "
-                                              "to run per client during AuthenticationTest.")
-@click.option("--sizelimit", default=100, help="IPA search size limit")
-@click.option("--disable-selinux", default=False, is_flag=True,
-              help="Disable the SSSD SELinux provider in all clients, enable forking in pamtest")
-@click.option("--command", help="Command to execute during APITest.")
+@click.option(
+    "--replica-topology",
+    help="Replication topology of the server and replicas. A tree keeps at most 4 "
+         "agreements per host, a mesh connects every pair of hosts and custom reads "
+         "--replica-topology-file.",
+    type=click.Choice(TOPOLOGIES, case_sensitive=False),
+    default="tree",
+)
+@click.option(
+    "--replica-topology-file",
+    help="YAML file giving the parent of every replica and extra segments, "
+         "for --replica-topology custom.",
+    type=click.Path(exists=True, dir_okay=False),
+)
+@click.option(
+    "--replica-fanout",
+    help="Replicas installed from each host in the tree and mesh topologies "
+         "(default 4 for the server and 3 for the replicas).",
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--replica-install-forks",
+    help="Ansible forks used to install the replicas of a tier in parallel.",
+    type=click.IntRange(min=1),
+    default=64,
+)
 @click.option(
     "--results-format",
     help="Format to use for results output",
@@ -152,16 +204,29 @@ class RunTest:
 @click.option(
     "--provider",
     help="Provider to use during test execution",
-    type=click.Choice(["vagrant", "idmci"], case_sensitive=False), default="idmci"
+    type=click.Choice(["vagrant", "idmci", "podman", "simulation"], case_sensitive=False),
+    default="idmci"
 )
 @click.option(
     "--private-key",
     help="Private key needed to access VMs in case the default is not enough.",
 )
 @click.option(
-    "--sequential",
-    help="Run APITest commands sequentially from a single client.",
-    is_flag=True
+    "--client-cpus",
+    help="CPUs of each client VM (vagrant and podman providers only).",
+    type=click.INT,
+)
+@click.option(
+    "--client-memory",
+    help="Memory in MiB of each client VM (vagrant and podman providers only).",
+    type=click.INT,
+)
+@click.option(
+    "--vagrant-wave-size",
+    help="VMs the vagrant provider brings up together, in waves "
+         "(0 = all at once).",
+    type=click.IntRange(min=0),
+    default=0,
 )
 @click.option(
     "--idmci-lifetime",
@@ -169,9 +234,28 @@ class RunTest:
     default=8,
 )
 @click.option(
-    "--auth-spread",
-    help="Time range in minutes to spread auths in AuthenticationTest",
-    default=0,
+    "--reuse-deployment",
+    help="Run the test on the deployment recorded in runner_metadata by a "
+         "previous run instead of provisioning and installing a new one.",
+    is_flag=True
+)
+@click.option(
+    "--reset-ipa-state",
+    help="With --reuse-deployment, unenroll the clients and restart IPA "
+         "before running the test.",
+    is_flag=True
+)
+@click.option(
+    "--resume",
+    help="Resume the run recorded in runner_metadata from its first "
+         "incomplete phase, with the options it was started with.",
+    is_flag=True
+)
+@click.option(
+    "--plan-only",
+    help="Only check the options and print the hosts, resources and "
+         "estimated phase durations of the run, without provisioning.",
+    is_flag=True
 )
 @click.option(
     "--expected-result-type",
@@ -184,42 +268,171 @@ class RunTest:
     type=click.FLOAT
 )
 @click.option(
-    "--number-of-subgroups",
-    help="Number of sub groups for Groupsize test",
+    "--ssh-concurrency",
+    help="Maximum number of remote commands run at the same time. Tests that "
+         "start every client at once need at least one per client.",
+    default=1000,
+)
+@click.option(
+    "--ssh-timeout",
+    help="Time in seconds after which a remote command is killed (0 = never).",
     default=0,
 )
-@click.option("--cert-requests", default=0, help="Number of certificates to request")
-@click.option("--wsgi-processes", default=4, help="Number of WSGI processes")
+@click.option(
+    "--log-collection-concurrency",
+    help="Number of hosts logs are collected from at the same time.",
+    default=100,
+)
+@click.option(
+    "--logs-since-test-start",
+    help="Only collect what was written to the logs after the test started.",
+    is_flag=True
+)
+@click.option(
+    "--archive-codec",
+    help="Compression of the results archive. pigz, xz and zstd are used "
+         "with all the available CPUs when installed.",
+    type=click.Choice(["gz", "xz", "zstd", "none"]), default="gz"
+)
+@click.option(
+    "--archive-level",
+    help="Compression level of the results archive (default depends on "
+         "the codec).",
+    type=click.IntRange(min=0),
+)
 @click.pass_context
-def main(
+def run_test(
     ctx,
     test,
-    command,
     private_key,
     client_image,
     server_image,
-    sequential,
     expected_result,
     amount=1,
-    threads=10,
-    ad_threads=0,
-    sizelimit=100,
-    disable_selinux=False,
     replicas=0,
+    replica_topology="tree",
+    replica_topology_file=None,
+    replica_fanout=None,
+    replica_install_forks=64,
     results_format="json",
     results_output_file=None,
     custom_repo_url="",
     provider="idmci",
+    client_cpus=None,
+    client_memory=None,
+    vagrant_wave_size=0,
     idmci_lifetime=8,
-    auth_spread=0,
+    reuse_deployment=False,
+    reset_ipa_state=False,
+    resume=False,
+    plan_only=False,
     expected_result_type="no_errors",
-    number_of_subgroups=0,
-    cert_requests=0,
-    wsgi_processes=4,
+    ssh_concurrency=1000,
+    ssh_timeout=0,
+    log_collection_concurrency=100,
+    logs_since_test_start=False,
+    archive_codec="gz",
+    archive_level=None,
+    **test_options
 ):
+    """Options shared by every test, the test options come from its plugin"""
 
-    tests = RunTest(['ipaperftest.registry'])
+    tests = RunTest(PLUGIN_REGISTRIES)
     try:
-        tests.run(ctx)
+        sys.exit(tests.run(ctx))
     except RuntimeError:
         sys.exit(1)
+
+
+def plugin_command(name, plugincls):
+    """Build the ipaperftest subcommand running the plugin plugincls
+
+       The command takes the options shared by every test followed by
+       the ``options`` declared by the plugin, so they are parsed and
+       checked before anything gets provisioned.
+    """
+    test_option = click.Option(["--test"], default=name, hidden=True,
+                               type=click.Choice([name]))
+    return click.Command(
+        name,
+        params=[test_option] + run_test.params + list(plugincls.options),
+        callback=run_test.callback,
+        help=plugincls.__doc__,
+        context_settings=run_test.context_settings,
+    )
+
+
+def legacy_args(args, commands):
+    """Turn the ``--test NAME`` form of the command line into ``NAME``
+
+       The test defaults to EnrollmentTest when none is given.
+    """
+    args = list(args)
+    if args and (args[0] in commands or args[0] in ("--help", "-h")):
+        return args
+    test = DEFAULT_TEST
+    for i, arg in enumerate(args):
+        if arg == "--test" and i + 1 < len(args):
+            test = args[i + 1]
+            del args[i:i + 2]
+            break
+        if arg.startswith("--test="):
+            test = arg[len("--test="):]
+            del args[i]
+            break
+    return [test] + args
+
+
+class TestGroup(click.Group):
+    """
+    The ipaperftest command, with one subcommand per test plugin.
+
+    The subcommands are listed from the plugin entry points, and the
+    module of a plugin is only imported when its test is selected.
+    """
+    def list_commands(self, ctx):
+        return sorted(
+            ep.name
+            for registry in PLUGIN_REGISTRIES
+            for group in iter_entry_points(registry)
+            for ep in iter_entry_points(group.name)
+        )
+
+    def get_command(self, ctx, cmd_name):
+        for name, registry in find_registries(PLUGIN_REGISTRIES).items():
+            plugin = find_plugin(name, registry, cmd_name)
+            if plugin is not None:
+                return plugin_command(cmd_name, type(plugin))
+        return None
+
+    def format_commands(self, ctx, formatter):
+        # Listing the names only avoids importing every plugin for --help
+        rows = [(name, "") for name in self.list_commands(ctx)]
+        if rows:
+            with formatter.section("Tests"):
+                formatter.write_dl(rows)
+
+    def parse_args(self, ctx, args):
+        return super().parse_args(ctx, legacy_args(args, self.list_commands(ctx)))
+
+
+def make_test_context(args):
+    """Return the click context of the test selected by args
+
+       args are ipaperftest command line arguments, in either form.
+    """
+    args = legacy_args(args, main.list_commands(None))
+    command = main.get_command(None, args[0])
+    if command is None:
+        raise RuntimeError("Unknown test '%s'." % args[0])
+    return command.make_context(args[0], args[1:])
+
+
+@click.group("ipaperftest", cls=TestGroup)
+def main():
+    """Deploy an IPA environment and run a performance test on it.
+
+       The test is given either as a subcommand or with --test NAME
+       (EnrollmentTest by default). Run ``ipaperftest NAME --help`` for
+       the options of a test.
+    """
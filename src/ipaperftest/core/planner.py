@@ -0,0 +1,212 @@
+#
+# Copyright (C) 2024 FreeIPA Contributors see COPYING for license
+#
+
+import math
+import os
+
+from ipaperftest.core.archive import check_level
+from ipaperftest.core.topology import MAX_AGREEMENTS, build_topology
+
+# Rough duration of the phases in seconds, as (fixed, per host,
+# per replica). Phases that are not listed take a few seconds at most.
+PHASE_ESTIMATES = {
+    "provider.cleanup": (30, 1, 0),
+    "clone_ansible_freeipa": (10, 0, 0),
+    "provider.create_vms": (120, 10, 0),
+    "collect_hosts": (5, 0.1, 0),
+    "ansible_ping": (10, 0.1, 0),
+    "configure_server": (120, 0, 0),
+    "configure_replicas": (0, 0, 120),
+    "install_server": (900, 0, 0),
+    # Replicas of a tier are installed in parallel, see estimate_phases
+    "install_replicas": (0, 0, 0),
+    "add_replica_segments": (10, 0, 0),
+    "reset_ipa_state": (120, 1, 0),
+    "enable_data_collection": (10, 0.1, 0),
+    "mark_log_offsets": (5, 0.05, 0),
+    "collect_logs": (30, 0.1, 0),
+}
+
+
+class Plan:
+    """
+    What a run is going to deploy and how long it should take.
+
+    errors list the reasons the run cannot or should not be started,
+    warnings what is likely to make it fail or slow it down.
+    """
+    def __init__(self):
+        self.hosts = []
+        self.topology = None
+        self.totals = {}
+        self.phases = []
+        self.errors = []
+        self.warnings = []
+
+    def total(self, key):
+        """Sum key over every host type, None when a type lacks it"""
+        values = [t.get(key) for t in self.totals.values()]
+        if not values or None in values:
+            return None
+        return sum(values)
+
+    def estimated_time(self):
+        return sum(p["estimate"] for p in self.phases if p["estimate"] is not None)
+
+    def to_dict(self):
+        return {
+            "hosts": len(self.hosts),
+            "totals": self.totals,
+            "cpus": self.total("cpus"),
+            "memory": self.total("memory"),
+            "topology": self.topology,
+            "phases": self.phases,
+            "estimated_time": round(self.estimated_time(), 1),
+            "errors": self.errors,
+            "warnings": self.warnings,
+        }
+
+
+def local_memory():
+    """Return the memory of this machine in MiB, or None"""
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // (1024 * 1024)
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def check_options(plan, plugin, ctx):
+    params = ctx.params
+    if params["amount"] < 1:
+        plan.errors.append("--amount must be at least 1.")
+    if params.get("reset_ipa_state") and not params.get("reuse_deployment"):
+        plan.errors.append("--reset-ipa-state only applies with --reuse-deployment.")
+    if params.get("reuse_deployment") and not params.get("reset_ipa_state") \
+            and plugin.enrolls_clients:
+        plan.errors.append("%s enrolls the clients, which are already enrolled in a reused "
+                           "deployment: add --reset-ipa-state." % plugin.__class__.__name__)
+    if params["expected_result_type"] in ("time", "time_unit"):
+        if params["expected_result"] is None:
+            plan.errors.append("--expected-result-type %s requires --expected-result."
+                               % params["expected_result_type"])
+        elif params["expected_result"] <= 0:
+            plan.errors.append("--expected-result must be greater than 0.")
+    elif params["expected_result"] is not None:
+        plan.warnings.append("--expected-result is ignored with --expected-result-type %s."
+                             % params["expected_result_type"])
+    # Rejected before the logs are collected rather than by the compressor
+    level_error = check_level(params.get("archive_codec", "gz"), params.get("archive_level"))
+    if level_error:
+        plan.errors.append(level_error)
+
+
+def resolve_topology(plan, plugin, ctx):
+    """Fill in the hosts of the run and their resources by host type"""
+    try:
+        plan.hosts = plugin.machine_configs(ctx)
+    except RuntimeError as e:
+        plan.errors.append(str(e))
+        return
+
+    provider = plugin.provider
+    for conf in plan.hosts:
+        resources = provider.host_resources(ctx, conf["type"])
+        totals = plan.totals.setdefault(conf["type"], {"count": 0, "cpus": 0, "memory": 0})
+        totals["count"] += 1
+        for key in ("cpus", "memory"):
+            if key not in resources or totals[key] is None:
+                totals[key] = None
+            else:
+                totals[key] += resources[key]
+
+    if provider.max_hosts is not None and len(plan.hosts) > provider.max_hosts:
+        plan.errors.append("The %s provider can address at most %s hosts, the run needs %s."
+                           % (ctx.params["provider"], provider.max_hosts, len(plan.hosts)))
+
+    clients = sum(1 for conf in plan.hosts if conf["type"] == "client")
+    if clients > ctx.params["ssh_concurrency"]:
+        plan.warnings.append("--ssh-concurrency %s is lower than the %s clients, tests "
+                             "starting every client at once will not start them together."
+                             % (ctx.params["ssh_concurrency"], clients))
+
+    memory = plan.total("memory")
+    available = local_memory()
+    if provider.runs_locally and memory and available and memory > available:
+        plan.warnings.append("The VMs need %s MiB of memory, this machine has %s MiB."
+                             % (memory, available))
+
+
+def check_replica_topology(plan, ctx):
+    """Build the replication topology and check its agreements"""
+    if ctx.params["replicas"] == 0:
+        return
+    try:
+        topology = build_topology(ctx.params)
+    except RuntimeError as e:
+        plan.errors.append(str(e))
+        return
+    plan.topology = topology.summary()
+    crowded = sorted(host for host, count in topology.agreements().items()
+                     if count > MAX_AGREEMENTS)
+    if crowded:
+        plan.warnings.append("%s hosts have more than %s replication agreements, which "
+                             "FreeIPA does not recommend: %s"
+                             % (len(crowded), MAX_AGREEMENTS, ", ".join(crowded)))
+
+
+def estimate_phases(plan, ctx, phases):
+    hosts = len(plan.hosts)
+    replicas = ctx.params["replicas"]
+    for phase in phases:
+        if phase == "run":
+            # Only known when the user told us what to expect
+            estimate = None
+            if ctx.params["expected_result_type"] == "time":
+                estimate = ctx.params["expected_result"]
+            elif ctx.params["expected_result_type"] == "time_unit" \
+                    and ctx.params["expected_result"] is not None:
+                estimate = ctx.params["expected_result"] * ctx.params["amount"]
+        elif phase == "install_replicas":
+            # Tiers are installed one after the other, in batches of forks
+            forks = ctx.params.get("replica_install_forks") or 1
+            estimate = sum(600 * math.ceil(size / forks)
+                           for size in (plan.topology["tier_sizes"] if plan.topology else []))
+        else:
+            fixed, per_host, per_replica = PHASE_ESTIMATES.get(phase, (1, 0, 0))
+            estimate = round(fixed + per_host * hosts + per_replica * replicas, 1)
+        plan.phases.append({"phase": phase, "estimate": estimate})
+
+
+def plan_run(plugin, ctx, phases):
+    """Resolve the topology, resources and duration of a run
+
+       plugin must have its provider selected. phases are the names
+       of the phases execute() is going to run.
+    """
+    plan = Plan()
+    check_options(plan, plugin, ctx)
+    resolve_topology(plan, plugin, ctx)
+    check_replica_topology(plan, ctx)
+    estimate_phases(plan, ctx, phases)
+    return plan
+
+
+def format_plan(plan):
+    lines = ["Hosts:"]
+    for host_type, totals in sorted(plan.totals.items()):
+        lines.append("  %-8s %6s hosts %8s CPUs %10s MiB" % (
+            host_type, totals["count"],
+            "?" if totals["cpus"] is None else totals["cpus"],
+            "?" if totals["memory"] is None else totals["memory"]))
+    if plan.topology:
+        lines.append("Replication: %(topology)s, %(tiers)s tiers, %(segments)s segments, "
+                     "up to %(max_hops)s hops from the server" % plan.topology)
+    lines.append("Phases:")
+    for phase in plan.phases:
+        estimate = "?" if phase["estimate"] is None else "%.0fs" % phase["estimate"]
+        lines.append("  %-32s %10s" % (phase["phase"], estimate))
+    lines.append("Estimated time: %.0fs (without the unknown phases)" % plan.estimated_time())
+    lines.extend("Warning: %s" % w for w in plan.warnings)
+    lines.extend("Error: %s" % e for e in plan.errors)
+    return "\n".join(lines)
@@ -3,18 +3,20 @@
 #
 
 import subprocess as sp
+import json
 import os
+import shlex
 import uuid
 import time
 import tarfile
-import queue
-import ansible_runner
 from datetime import datetime
 
 from ipaperftest.core.constants import (
     SUCCESS,
+    WARNING,
     ERROR,
     ANSIBLE_REPLICA_INSTALL_PLAYBOOK,
+    ANSIBLE_REPLICA_SEGMENTS_PLAYBOOK,
     ANSIBLE_SERVER_ADD_REPO_PLAYBOOK,
     getLevelName,
     HOSTS_FILE_TEMPLATE,
@@ -22,12 +24,67 @@ from ipaperftest.core.constants import (
     ANSIBLE_SERVER_CONFIG_PLAYBOOK,
     ANSIBLE_REPLICA_CONFIG_PLAYBOOK,
     ANSIBLE_ENABLE_DATA_COLLECTION_PLAYBOOK,
-    ANSIBLE_FETCH_FILES_PLAYBOOK,
+    SERVER_LOG_FILES,
+    REPLICA_LOG_FILES,
+    CLIENT_LOG_FILES,
+    SAR_OUTPUT_FILE,
+    LOG_COLLECTOR_SCRIPT,
+    ANSIBLE_UPLOAD_CLIENT_FILES_PLAYBOOK,
+    ANSIBLE_RESET_IPA_STATE_PLAYBOOK,
 )
+from ipaperftest.core.archive import checked_members, write_archive
+from ipaperftest.core.executor import RemoteExecutor
+from ipaperftest.core.planner import format_plan, plan_run
+from ipaperftest.core.ssh import ssh_pool
+from ipaperftest.core.stats import summarize
+from ipaperftest.core.topology import build_topology
 from ipaperftest.providers.idmci import IdMCIProvider
+from ipaperftest.providers.podman import PodmanProvider
+from ipaperftest.providers.simulation import SimulationProvider
 from ipaperftest.providers.vagrant import VagrantProvider
 
 
+# ansible-runner events of a task result on a host
+TASK_RESULT_EVENTS = ("runner_on_ok", "runner_on_failed", "runner_on_skipped",
+                      "runner_on_unreachable")
+
+
+def ansible_host_timings(events):
+    """
+    Return how long every host of an ansible-runner run took, from
+    the results of its tasks.
+
+    The host:timing dictionary gives the start and end of the first
+    and last task of the host, their duration in seconds, whether a
+    task failed, and the seconds spent in each module.
+    """
+    timings = {}
+    for event in events or []:
+        data = event.get("event_data") or {}
+        if event.get("event") not in TASK_RESULT_EVENTS or not data.get("start") \
+                or not data.get("end"):
+            continue
+        start = datetime.fromisoformat(data["start"])
+        end = datetime.fromisoformat(data["end"])
+        timing = timings.setdefault(data.get("host"), {
+            "start": start, "end": end, "failed": False, "modules": {},
+        })
+        timing["start"] = min(timing["start"], start)
+        timing["end"] = max(timing["end"], end)
+        if event["event"] in ("runner_on_failed", "runner_on_unreachable") \
+                and not data.get("ignore_errors"):
+            timing["failed"] = True
+        module = (data.get("resolved_action") or data.get("task_action") or "").split(".")[-1]
+        timing["modules"][module] = round(timing["modules"].get(module, 0)
+                                          + (end - start).total_seconds(), 3)
+
+    for timing in timings.values():
+        timing["duration"] = round((timing["end"] - timing["start"]).total_seconds(), 3)
+        timing["start"] = timing["start"].isoformat()
+        timing["end"] = timing["end"].isoformat()
+    return timings
+
+
 class Registry:
     """
     A decorator that makes plugins available to the API
@@ -70,20 +127,36 @@ class Plugin:
             def run(self):
                ...
 
+    options lists the click options specific to the test. They are
+    added to the ipaperftest subcommand of the plugin, next to the
+    options shared by every test.
+
+    enrolls_clients is set by the tests running ipa-client-install on
+    their clients, which fails on the clients of a reused deployment
+    unless its IPA state is reset.
     """
+    options = []
+    enrolls_clients = False
+
     def __init__(self, registry):
         self.registry = registry
         self.domain = "ipa.test"
         self.custom_logs = []
         self.provider = None
+        self.ssh_pool = ssh_pool
+        # Set when the options or the planner reject the run, before
+        # anything is provisioned
+        self.rejected = False
 
-    def run_ansible_playbook_from_template(self, template, filename, playbook_args, ctx):
+    def run_ansible_playbook_from_template(self, template, filename, playbook_args, ctx,
+                                           forks=None):
         """
         The playbook must be passed as a string template.
         It will be written into a file under the sync directory
         using the filename passed.
 
-        Arguments must be passed as a dictionary.
+        Arguments must be passed as a dictionary. forks overrides
+        the number of hosts Ansible works on in parallel.
         """
 
         playbook_str = template.format(**playbook_args)
@@ -91,26 +164,76 @@ class Plugin:
         with open(playbook_path, "w") as f:
             f.write(playbook_str)
 
-        ret = ansible_runner.run(private_data_dir="runner_metadata",
-                                 playbook=filename + ".yml",
-                                 verbosity=1)
+        runner_args = {"forks": forks} if forks else {}
+        ret = self.provider.run_ansible(private_data_dir="runner_metadata",
+                                        playbook=filename + ".yml",
+                                        verbosity=1,
+                                        **runner_args)
 
         return ret
 
+    def upload_client_files(self, files, ctx):
+        """
+        Copy files from the metadata folder to the home directory
+        of root on every client.
+
+        The files are written into runner_metadata from the
+        filename:contents dictionary passed.
+        """
+        for filename, contents in files.items():
+            with open("runner_metadata/" + filename, "w") as f:
+                f.write(contents)
+
+        args = {
+            "files": "\n".join('        - "{}"'.format(f) for f in files.keys())
+        }
+        return self.run_ansible_playbook_from_template(ANSIBLE_UPLOAD_CLIENT_FILES_PLAYBOOK,
+                                                       "upload_client_files", args, ctx)
+
+    def ssh_private_keys(self, ctx):
+        return [ctx.params["private_key"], self.provider.default_private_key]
+
     def run_ssh_command(self, command, target, ctx, wait=True):
         """
         SSH into the specified host target and run the command passed.
+
+        The command is multiplexed over the pooled master connection
+        to target, so only the first command sent to a host pays for
+        the SSH handshake. The command is interpreted by the remote
+        shell only.
+
+        With wait=False the process is returned right away. Its end
+        is not tracked, so it cannot hold one of the sessions of the
+        master and opens its own connection instead.
         """
 
-        cmd = ("ssh -i '{}' -i '{}' root@{} "
-               "-o StrictHostKeyChecking=no "
-               "-o UserKnownHostsFile=/dev/null "
-               "\"{}\"").format(ctx.params["private_key"],
-                                self.provider.default_private_key, target, command)
-        func = sp.run if wait else sp.Popen
+        keys = self.ssh_private_keys(ctx)
+        if not wait:
+            cmd = self.ssh_pool.command_args(target, command, keys, multiplex=False)
+            return sp.Popen(cmd, cwd="runner_metadata",
+                            stdout=sp.PIPE, stdin=sp.DEVNULL, stderr=sp.PIPE)
+
+        self.ssh_pool.connect(target, keys)
+        multiplex = self.ssh_pool.open_session(target)
+        cmd = self.ssh_pool.command_args(target, command, keys, connect=False,
+                                         multiplex=multiplex)
+        try:
+            return sp.run(cmd, cwd="runner_metadata",
+                          stdout=sp.PIPE, stdin=sp.DEVNULL, stderr=sp.PIPE)
+        finally:
+            if multiplex:
+                self.ssh_pool.close_session(target)
+
+    def remote_executor(self, ctx, timeout=None, max_concurrency=None):
+        """
+        Return a RemoteExecutor bounded by the SSH concurrency options.
 
-        return func(cmd, shell=True, cwd="runner_metadata",
-                    stdout=sp.PIPE, stdin=sp.DEVNULL, stderr=sp.PIPE)
+        The concurrency defaults to --ssh-concurrency and the
+        per-command timeout to --ssh-timeout.
+        """
+        return RemoteExecutor(self.ssh_pool, self.ssh_private_keys(ctx),
+                              max_concurrency=max_concurrency or ctx.params["ssh_concurrency"],
+                              timeout=timeout or ctx.params["ssh_timeout"])
 
     def select_provider(self, ctx):
         selected_provider = ctx.params["provider"].lower()
@@ -118,8 +241,13 @@ class Plugin:
             self.provider = VagrantProvider()
         elif selected_provider == "idmci":
             self.provider = IdMCIProvider()
+        elif selected_provider == "podman":
+            self.provider = PodmanProvider()
+        elif selected_provider == "simulation":
+            self.provider = SimulationProvider()
         else:
             raise RuntimeError("Selected provider '%s' does not exist." % selected_provider)
+        self.ssh_pool = self.provider.connection_pool()
 
     def generate_clients(self, ctx):
         # A generator to yield client configurations which will be
@@ -138,18 +266,20 @@ class Plugin:
 
     def clone_ansible_freeipa(self, ctx):
         """ Clone ansible-freeipa upstream and create the Ansible config"""
-        sp.run(
-            [
-                "git",
-                "clone",
-                "--depth=1",
-                "--branch",
-                "v1.13.2",
-                "https://github.com/freeipa/ansible-freeipa.git",
-            ],
-            cwd="runner_metadata",
-            stdout=sp.PIPE,
-        )
+        # Simulated hosts do not run the ansible-freeipa roles
+        if not self.provider.simulated:
+            sp.run(
+                [
+                    "git",
+                    "clone",
+                    "--depth=1",
+                    "--branch",
+                    "v1.13.2",
+                    "https://github.com/freeipa/ansible-freeipa.git",
+                ],
+                cwd="runner_metadata",
+                stdout=sp.PIPE,
+            )
         with open("runner_metadata/ansible.cfg", "w") as f:
             f.write(ANSIBLE_CFG_TEMPLATE.format(
                 cwd=os.path.join(os.getcwd(), "runner_metadata"),
@@ -158,8 +288,8 @@ class Plugin:
                 )
             )
 
-    def generate_metadata(self, ctx):
-
+    def machine_configs(self, ctx):
+        """Return the configuration of every machine of the topology"""
         machine_configs = [
             {
                 "hostname": "server.%s" % self.domain.lower(),
@@ -180,74 +310,103 @@ class Plugin:
             if c:
                 machine_configs.append(c)
 
-        self.provider.generate_metadata(ctx, machine_configs, self.domain)
+        return machine_configs
+
+    def generate_metadata(self, ctx):
+        self.provider.generate_metadata(ctx, self.machine_configs(ctx), self.domain)
+
+    def collect_hosts(self, ctx):
+        """Discover the hosts created by the provider
+
+           The provider finds the running hosts in a single query. They
+           are checked against the topology, and the host registry is
+           cached in runner_metadata so that later phases and resumed
+           or reusing runs do not query the provider again.
+        """
+        self.provider.collect_hosts(ctx)
+        missing = self.provider.register_hosts(ctx, self.machine_configs(ctx))
+        self.provider.save_hosts()
+        # The test can go on without some of its clients, not without
+        # the server or a replica
+        needed = [name for name in missing
+                  if name == "server" or name.startswith("replica")]
+        if needed:
+            raise RuntimeError("The server and replicas must be running, %s not found "
+                               "after creation." % ", ".join(needed))
+        if missing:
+            yield Result(self, ERROR, key="missing_hosts",
+                         msg="{count} hosts were not found after creation: {hosts}",
+                         count=len(missing), hosts=", ".join(missing))
+
+    def save_deployment(self, ctx):
+        """Record the deployment so that later runs can reuse it"""
+        deployment = {
+            "provider": ctx.params["provider"].lower(),
+            "domain": self.domain,
+            "replicas": ctx.params["replicas"],
+            "replica_segments": [list(s) for s in build_topology(ctx.params).segments],
+            "server_image": self.provider.server_image,
+            "client_image": self.provider.client_image,
+        }
+        with open("runner_metadata/deployment.json", "w") as f:
+            json.dump(deployment, f, indent=2)
+
+    def load_deployment(self, ctx):
+        """Attach to the deployment recorded by a previous run
+
+           Only the hosts this test needs are used, and they must all
+           be part of the recorded deployment.
+        """
+        try:
+            with open("runner_metadata/deployment.json") as f:
+                deployment = json.load(f)
+        except (OSError, ValueError) as e:
+            raise RuntimeError("No deployment to reuse in runner_metadata: %s" % e)
+
+        if deployment["provider"] != ctx.params["provider"].lower():
+            raise RuntimeError("The deployment was created by the %s provider, not %s."
+                               % (deployment["provider"], ctx.params["provider"]))
+        if deployment["replicas"] != ctx.params["replicas"]:
+            raise RuntimeError("The deployment has %s replicas, %s were requested."
+                               % (deployment["replicas"], ctx.params["replicas"]))
+        segments = [list(s) for s in build_topology(ctx.params).segments]
+        if deployment.get("replica_segments", segments) != segments:
+            raise RuntimeError("The replicas of the deployment are not connected as "
+                               "--replica-topology requests.")
+
+        if not self.provider.load_hosts():
+            raise RuntimeError("No host registry to reuse in runner_metadata.")
+        names = [conf["hostname"].split(".")[0] for conf in self.machine_configs(ctx)]
+        missing = self.provider.select_hosts(names)
+        if missing:
+            raise RuntimeError("The deployment is missing hosts needed by this test: %s"
+                               % ", ".join(missing))
+
+        print("Reusing the deployment of %s hosts in runner_metadata..." % len(names))
+        self.domain = deployment["domain"]
+        self.provider.server_image = deployment["server_image"]
+        self.provider.client_image = deployment["client_image"]
 
     def generate_ansible_inventory(self, ctx):
-        # Each replica should have a maximum of 4 agreements, defined in tiers.
-        # Top node will have 4 childs, while every other node will have 3 children
-        # + 1 parent.
-        def generate_replica_lines():
-            def build_replica_tree(d={}, current_node="server", n_nodes=0, q=queue.Queue()):
-                n_children = 4 if d == {} else 3
-                for _ in range(n_children):
-                    if current_node not in d.keys():
-                        d[current_node] = [f"replica{n_nodes}"]
-                    else:
-                        d[current_node].append(f"replica{n_nodes}")
-                    n_nodes += 1
-                    if n_nodes == ctx.params["replicas"]:
-                        return d
-                for c in d[current_node]:
-                    q.put(c)
-                return build_replica_tree(d, q.get(), n_nodes, q)
-
-            def get_replica_tiers(tree, tiers=[]):
-                if tiers == []:
-                    # first tier is just original server
-                    tiers.append(["server"])
-                    return get_replica_tiers(tree, tiers)
-                else:
-                    # next tier is all children of last added tier
-                    last_tier = tiers[-1]
-                    new_tier = []
-                    for replica in last_tier:
-                        try:
-                            for child in tree[replica]:
-                                new_tier.append(child)
-                        except KeyError:
-                            # this is a leaf node
-                            continue
-                    if new_tier == []:
-                        return tiers
-                    tiers.append(new_tier)
-                    return get_replica_tiers(tree, tiers)
-
-            def get_replica_parent(tree, child):
-                for parent, children in tree.items():
-                    if child in children:
-                        return parent
-
-            tree = build_replica_tree()
-            tiers = get_replica_tiers(tree)
-            replica_lines = []
-            ipareplicas_group_lines = ["\n[ipareplicas:children]"]
-            for i, tier in enumerate(tiers[1:]):
-                ipareplicas_group_lines.append(f"ipareplicas_tier{i}")
-                # Slice tier0 as it's just the original server
-                tier_lines = [
-                    f"[ipareplicas_tier{i}]"
-                ]
-                for replica in tier:
-                    replica_ip = self.provider.hosts[replica]
-                    parent = get_replica_parent(tree, replica)
-                    tier_lines.append(f"{replica_ip} ipareplica_servers={parent}.{self.domain}")
-                replica_lines.extend(tier_lines)
+        """Write the Ansible inventory of the hosts
+
+           Replicas are grouped by install tier, each one pointing to
+           the host it is installed from. The replication topology is
+           reported with the number of hops between the hosts.
+        """
+        topology = build_topology(ctx.params)
+        replica_lines = ["[ipareplicas]"] if not topology.parents else []
+        ipareplicas_group_lines = ["\n[ipareplicas:children]"]
+        for i, tier in enumerate(topology.tiers()):
+            ipareplicas_group_lines.append(f"ipareplicas_tier{i}")
+            replica_lines.append(f"[ipareplicas_tier{i}]")
+            for replica in tier:
+                replica_ip = self.provider.hosts[replica]
+                parent = topology.parents[replica]
+                replica_lines.append(f"{replica_ip} ipareplica_servers={parent}.{self.domain}")
+        if topology.parents:
             replica_lines.extend(ipareplicas_group_lines)
-            return replica_lines
 
-        replica_lines = (generate_replica_lines()
-                         if ctx.params["replicas"] > 0
-                         else ["[ipareplicas]"])
         inventory_str = HOSTS_FILE_TEMPLATE.format(
             server_ip=self.provider.hosts["server"],
             domain=self.domain.lower(),
@@ -264,15 +423,25 @@ class Plugin:
         with open("runner_metadata/inventory", "w") as f:
             f.write(inventory_str)
 
+        if topology.parents:
+            yield Result(self, SUCCESS, key="topology",
+                         msg="Replication topology {topology}: {replicas} replicas in {tiers} "
+                             "tiers, {segments} segments, up to {max_hops} hops from the "
+                             "server, diameter {diameter}",
+                         **topology.summary())
+
     def ansible_ping(self, ctx):
         print("Sending ping to VMs...")
-        ansible_runner.run(private_data_dir="runner_metadata",
-                           host_pattern="ipaserver,ipaclients,ipareplicas*",
-                           module="ping")
-        if ctx.params["ad_threads"] > 0:
-            ansible_runner.run(private_data_dir="runner_metadata",
-                               host_pattern="windows",
-                               module="win_ping")
+        runs = [self.provider.run_ansible(private_data_dir="runner_metadata",
+                                          host_pattern="ipaserver,ipaclients,ipareplicas*",
+                                          module="ping")]
+        if ctx.params.get("ad_threads", 0) > 0:
+            runs.append(self.provider.run_ansible(private_data_dir="runner_metadata",
+                                                  host_pattern="windows",
+                                                  module="win_ping"))
+        # A fresh deployment keeps going, the failure shows up in later phases
+        if ctx.params.get("reuse_deployment") and any(r.rc != 0 for r in runs):
+            raise RuntimeError("Not all hosts of the reused deployment are reachable.")
 
     def configure_server(self, ctx):
         if ctx.params["custom_repo_url"]:
@@ -300,42 +469,196 @@ class Plugin:
 
     def install_server(self, ctx):
         print("Installing IPA server...")
-        ansible_runner.run(private_data_dir="runner_metadata",
-                           playbook="ansible-freeipa/playbooks/install-server.yml",
-                           verbosity=1)
+        self.provider.run_ansible(private_data_dir="runner_metadata",
+                                  playbook="ansible-freeipa/playbooks/install-server.yml",
+                                  verbosity=1)
 
     def install_replicas(self, ctx):
-        if ctx.params['replicas'] > 0:
-            print("Installing IPA replicas...")
-            self.run_ansible_playbook_from_template(ANSIBLE_REPLICA_INSTALL_PLAYBOOK,
-                                                    "replica_install", {}, ctx)
+        """Install the replicas one tier after the other
+
+           The replicas of a tier are installed in parallel, with up to
+           --replica-install-forks Ansible forks. How long every replica
+           took, including the DS setup with its initial LDAP replication
+           and the CA clone, comes from the ansible-runner events.
+        """
+        if ctx.params['replicas'] == 0:
+            return
+        topology = build_topology(ctx.params)
+        names = {ip: name for name, ip in self.provider.hosts.items()}
+        for i, tier in enumerate(topology.tiers()):
+            forks = min(ctx.params["replica_install_forks"], len(tier))
+            print("Installing %s IPA replicas of tier %s..." % (len(tier), i))
+            tier_start = time.time()
+            ret = self.run_ansible_playbook_from_template(ANSIBLE_REPLICA_INSTALL_PLAYBOOK,
+                                                          "replica_install_tier%s" % i,
+                                                          {"tier": i}, ctx, forks=forks)
+            tier_duration = round(time.time() - tier_start, 3)
+
+            timings = ansible_host_timings(ret.events)
+            durations = []
+            for replica in tier:
+                timing = timings.get(self.provider.hosts.get(replica))
+                if timing is None:
+                    # The provider did not report any event for this host
+                    continue
+                durations.append(timing["duration"])
+                steps = {module[len("ipareplica_"):]: duration
+                         for module, duration in timing["modules"].items()
+                         if module.startswith("ipareplica_")}
+                yield Result(self, ERROR if timing["failed"] else SUCCESS,
+                             key="replica_install.%s" % replica,
+                             msg="Replica {replica} installed from {parent} in "
+                                 "{install_duration}s",
+                             replica=replica, tier=i, parent=topology.parents[replica],
+                             install_start=timing["start"], install_end=timing["end"],
+                             install_duration=timing["duration"],
+                             ldap_replication=steps.get("setup_ds"),
+                             ca_clone=steps.get("setup_ca"), steps=steps)
+
+            failed = sorted(names.get(host, host) for host, timing in timings.items()
+                            if timing["failed"])
+            yield Result(self, ERROR if ret.rc != 0 else SUCCESS,
+                         key="replica_install.tier%s" % i,
+                         msg="Install of the {replicas} replicas of tier {tier} took "
+                             "{tier_duration}s with {forks} forks",
+                         tier=i, replicas=len(tier), forks=forks, tier_duration=tier_duration,
+                         rc=ret.rc, failed=failed, **summarize(durations, prefix="install_"))
+
+    def add_replica_segments(self, ctx):
+        """Add the replication agreements of the topology which are not
+           created by installing the replicas from their parents
+        """
+        if ctx.params['replicas'] == 0:
+            return
+        segments = build_topology(ctx.params).extra_segments()
+        if not segments:
+            return
+        print("Adding %s replication segments..." % len(segments))
+        args = {
+            "domain": self.domain,
+            "segments": "\n".join(
+                '        - ["{}", "{}", "{}"]'.format(suffix, left, right)
+                for left, right in segments for suffix in ("domain", "ca")),
+        }
+        self.run_ansible_playbook_from_template(ANSIBLE_REPLICA_SEGMENTS_PLAYBOOK,
+                                                "replica_segments", args, ctx)
+
+    def reset_ipa_state(self, ctx):
+        """Unenroll the clients and remove their hosts from IPA
+
+           Also removes the logs of the previous run and restarts the
+           IPA services on the server, so that a reused deployment
+           starts from the same state as a freshly installed one.
+        """
+        if not ctx.params.get("reset_ipa_state"):
+            return
+        print("Resetting IPA state...")
+        args = {
+            "custom_logs": " ".join(self.custom_logs),
+        }
+        self.run_ansible_playbook_from_template(ANSIBLE_RESET_IPA_STATE_PLAYBOOK,
+                                                "reset_ipa_state", args, ctx)
 
     def enable_data_collection(self, ctx):
         print("Starting monitoring on server using SAR...")
         self.run_ansible_playbook_from_template(ANSIBLE_ENABLE_DATA_COLLECTION_PLAYBOOK,
                                                 "enable_data_collection", {}, ctx)
 
-    def collect_logs(self, ctx):
-        def add_logs(logs):
-            for log in logs:
-                yield '        - "{}"'.format(log)
+    def log_files(self, host):
+        """Return the logs to collect from host, excluding sar output
 
-        # Wait for sar to analyze system
-        print("Waiting before copying logs...")
-        time.sleep(60)
+           Every path is listed once, so that the collector does not
+           archive and transfer the same logs twice.
+        """
+        if host.startswith("server"):
+            files = SERVER_LOG_FILES + self.custom_logs
+        elif host.startswith("replica"):
+            files = REPLICA_LOG_FILES + SERVER_LOG_FILES + self.custom_logs
+        elif host.startswith("client"):
+            files = CLIENT_LOG_FILES + self.custom_logs
+        else:
+            files = []
+        return list(dict.fromkeys(files))
 
-        print("Copying logs into sync folder...")
-        for host in self.provider.hosts.keys():
-            sp.run(["mkdir", "-p", f"sync/{host}"], stdout=sp.PIPE)
+    def log_hosts(self):
+        return {host: ip for host, ip in self.provider.hosts.items() if self.log_files(host)}
 
-        logstr = '\n'.join(add_logs(self.custom_logs))
+    def log_collector_command(self, host, args):
+        files = " ".join(shlex.quote(f) for f in self.log_files(host))
+        return "python3 - {} {}".format(" ".join(args), files)
 
-        args = {
-            "cwd": os.getcwd(),
-            "custom_logs": logstr
-        }
-        self.run_ansible_playbook_from_template(ANSIBLE_FETCH_FILES_PLAYBOOK,
-                                                "fetch_logs", args, ctx)
+    def mark_log_offsets(self, ctx):
+        """Record the size of every log before the test starts
+
+           With --logs-since-test-start only what is appended to the
+           logs afterwards is collected.
+        """
+        if not ctx.params.get("logs_since_test_start"):
+            return
+        print("Recording log offsets...")
+        commands = [
+            (host, ip, self.log_collector_command(host, ["--mark"]))
+            for host, ip in self.log_hosts().items()
+        ]
+        executor = self.remote_executor(
+            ctx, max_concurrency=ctx.params["log_collection_concurrency"])
+        for result in executor.run(commands, input=LOG_COLLECTOR_SCRIPT.encode("utf-8")):
+            if result.returncode != 0:
+                print("Unable to record log offsets on %s: %s"
+                      % (result.key, result.stderr.decode("utf-8").strip()))
+
+    def collect_logs(self, ctx):
+        """Fetch the logs of every host into sync/<host>
+
+           A collector piped to each host waits for sar to write a
+           sample taken after the test, then streams the logs as a
+           compressed tar archive which is unpacked locally as soon as
+           it is received.
+        """
+        print("Copying logs into sync folder...")
+        hosts = self.log_hosts()
+        commands = []
+        for host, ip in hosts.items():
+            sp.run(["mkdir", "-p", f"sync/{host}"], stdout=sp.PIPE)
+            args = ["--whole", shlex.quote(SAR_OUTPUT_FILE)]
+            if not host.startswith("client"):
+                args.extend(["--sar", shlex.quote(SAR_OUTPUT_FILE)])
+            if ctx.params.get("logs_since_test_start"):
+                args.append("--since-mark")
+            commands.append((host, ip, self.log_collector_command(host, args)))
+
+        start = time.time()
+        summary = {"files": 0, "bytes": 0, "compressed_bytes": 0}
+        failed = []
+        executor = self.remote_executor(
+            ctx, max_concurrency=ctx.params["log_collection_concurrency"])
+        for result in executor.run(commands, input=LOG_COLLECTOR_SCRIPT.encode("utf-8"),
+                                   output=lambda host: os.path.abspath(
+                                       "sync/%s.tar.gz" % host)):
+            archive = "sync/%s.tar.gz" % result.key
+            stderr = result.stderr.decode("utf-8").strip().splitlines()
+            try:
+                host_summary = json.loads(stderr[-1])
+                summary["compressed_bytes"] += os.path.getsize(archive)
+                # The archive comes from the host, it may not write
+                # outside of its directory
+                with tarfile.open(archive, "r:gz") as tar:
+                    tar.extractall("sync/%s" % result.key, members=checked_members(tar))
+            except (IndexError, ValueError, OSError, tarfile.TarError):
+                failed.append(result.key)
+                print("Unable to collect logs from %s: %s" % (result.key, "\n".join(stderr)))
+                continue
+            finally:
+                if os.path.exists(archive):
+                    os.remove(archive)
+            summary["files"] += host_summary["files"]
+            summary["bytes"] += host_summary["bytes"]
+
+        yield Result(self, SUCCESS,
+                     msg="Collected {files} log files ({bytes} bytes, {compressed_bytes} "
+                         "compressed) from {hosts} hosts in {collection_time}s",
+                     hosts=len(hosts) - len(failed), failed_hosts=sorted(failed),
+                     collection_time=round(time.time() - start, 3), **summary)
 
     def post_process_logs(self, ctx):
         """Analyze log files for failures, patterns, etc"""
@@ -364,14 +687,15 @@ class Plugin:
 
     def archive_results(self, ctx):
         """ Create tar with logs and metadata"""
-        with tarfile.open(self.results_archive_name + ".tar.gz", "w:gz") as tar:
-            files_to_add = [
-                "sync/",
-                "runner_metadata",
-            ]
-            files_to_add.extend(self.provider.files_to_log)
-            for f in files_to_add:
-                tar.add(f)
+        files_to_add = [
+            "sync/",
+            "runner_metadata",
+        ]
+        files_to_add.extend(self.provider.files_to_log)
+        self.archive_path, self.manifest_path = write_archive(
+            self.results_archive_name, files_to_add,
+            codec=ctx.params.get("archive_codec", "gz"),
+            level=ctx.params.get("archive_level"))
 
     def validate_options(self, ctx):
         pass
@@ -379,11 +703,47 @@ class Plugin:
     def run(self, ctx):
         pass
 
-    def execute(self, ctx):
-        self.select_provider(ctx)
+    def plan_execution(self, ctx):
+        """Check the whole run before anything gets provisioned
 
-        funcs = [
+           The topology, the resources it needs and the estimated time
+           of every phase are reported. A run the planner finds
+           impossible or wasteful is stopped here.
+        """
+        phases = [self.phase_name(func) for func in self.execution_phases(ctx)]
+        plan = plan_run(self, ctx, phases)
+        print(format_plan(plan))
+        self.plan = plan.to_dict()
+
+        yield Result(self, WARNING if plan.warnings else SUCCESS, key="plan",
+                     msg="Plan: {hosts} hosts, {cpus} CPUs, {memory} MiB, "
+                         "about {estimated_time}s",
+                     **self.plan)
+        if plan.errors:
+            raise RuntimeError("Run rejected by the planner: %s" % " ".join(plan.errors))
+
+    def execution_phases(self, ctx):
+        """Return the phases of execute(), in the order they are run"""
+        if ctx.params.get("reuse_deployment"):
+            return [
+                self.validate_options,
+                self.plan_execution,
+                self.provider.check_requirements,
+                self.reset_sync_folder,
+                self.load_deployment,
+                self.generate_ansible_inventory,
+                self.ansible_ping,
+                self.reset_ipa_state,
+                self.enable_data_collection,
+                self.mark_log_offsets,
+                self.run,
+                self.collect_logs,
+                self.post_process_logs,
+                self.check_results,
+            ]
+        return [
             self.validate_options,
+            self.plan_execution,
             self.provider.check_requirements,
             self.provider.cleanup,
             self.reset_sync_folder,
@@ -392,26 +752,176 @@ class Plugin:
             self.provider.setup,
             self.generate_metadata,
             self.provider.create_vms,
-            self.provider.collect_hosts,
+            self.collect_hosts,
+            self.save_deployment,
             self.generate_ansible_inventory,
             self.ansible_ping,
             self.configure_server,
             self.configure_replicas,
             self.install_server,
             self.install_replicas,
+            self.add_replica_segments,
             self.enable_data_collection,
+            self.mark_log_offsets,
             self.run,
             self.collect_logs,
             self.post_process_logs,
             self.check_results,
         ]
 
-        for func in funcs:
+    def execute(self, ctx):
+        self.phases = []
+        self.phase_results = []
+        checkpoint = self.load_checkpoint(ctx) if ctx.params.get("resume") else None
+        self.select_provider(ctx)
+        if checkpoint:
+            for key, value in checkpoint["provider"].items():
+                setattr(self.provider, key, value)
+            # The registry may hold more hosts than this test uses
+            if self.provider.load_hosts():
+                self.provider.select_hosts(
+                    [conf["hostname"].split(".")[0] for conf in self.machine_configs(ctx)])
+            print("Resuming after phase %s..." % (checkpoint["completed"][-1]
+                                                  if checkpoint["completed"] else "(none)"))
+            # Report the results of the phases run before the interruption
+            self.phase_results = checkpoint.get("results", [])
+            for data in self.phase_results:
+                yield Result.from_dict(data)
+
+        if ctx.params.get("plan_only"):
+            # Nothing is saved, runner_metadata may belong to another run
+            yield from self.run_phase(self.validate_options, ctx)
+            yield from self.run_phase(self.plan_execution, ctx)
+            return
+
+        funcs = self.execution_phases(ctx)
+        completed = checkpoint["completed"] if checkpoint else []
+        try:
+            for func in funcs:
+                if self.phase_name(func) in completed:
+                    continue
+                try:
+                    yield from self.run_phase(func, ctx)
+                except Exception:
+                    if func in (self.validate_options, self.plan_execution):
+                        self.rejected = True
+                    raise
+                self.save_checkpoint(ctx)
+        finally:
+            self.write_phase_timeline()
+
+    def phase_name(self, func):
+        name = func.__name__
+        if getattr(func, "__self__", None) is self.provider:
+            name = "provider." + name
+        return name
+
+    def checkpoint_state(self):
+        """Return the plugin attributes that can be saved in a checkpoint
+
+           Everything JSON can store is saved, so that attributes set
+           by earlier phases (execution_time, clients_succeeded, ...)
+           are available to the phases run after resuming.
+        """
+        state = {}
+        for key, value in vars(self).items():
+            if key in ("registry", "provider", "ssh_pool", "phase_results"):
+                continue
             try:
-                yield from func(ctx)
-            except TypeError:
-                # nothing to yield from in func
-                pass
+                json.dumps(value)
+            except (TypeError, ValueError):
+                continue
+            state[key] = value
+        return state
+
+    def save_checkpoint(self, ctx):
+        """Record the completed phases and the state needed to resume"""
+        if not os.path.isdir("runner_metadata"):
+            return
+        checkpoint = {
+            "test": self.__class__.__name__,
+            "completed": [p["phase"] for p in self.phases if p["outcome"] == "success"],
+            "params": {k: v for k, v in ctx.params.items() if k != "resume"},
+            "provider": {
+                "server_image": self.provider.server_image,
+                "client_image": self.provider.client_image,
+            },
+            "state": self.checkpoint_state(),
+            "results": self.phase_results,
+        }
+        with open("runner_metadata/checkpoint.json.tmp", "w") as f:
+            json.dump(checkpoint, f, indent=2)
+        os.replace("runner_metadata/checkpoint.json.tmp", "runner_metadata/checkpoint.json")
+
+    def load_checkpoint(self, ctx):
+        """Restore the options and plugin state saved by save_checkpoint
+
+           The options of the interrupted run replace the ones given,
+           except for the output options. Returns the checkpoint, whose
+           provider state is restored once the provider is selected.
+        """
+        try:
+            with open("runner_metadata/checkpoint.json") as f:
+                checkpoint = json.load(f)
+        except (OSError, ValueError) as e:
+            raise RuntimeError("No checkpoint to resume from in runner_metadata: %s" % e)
+        if checkpoint["test"] != self.__class__.__name__:
+            raise RuntimeError("The checkpoint is for %s, pass --test %s to resume it."
+                               % (checkpoint["test"], checkpoint["test"]))
+
+        for key, value in checkpoint["params"].items():
+            if key not in ("results_format", "results_output_file"):
+                ctx.params[key] = value
+        for key, value in checkpoint["state"].items():
+            setattr(self, key, value)
+        return checkpoint
+
+    def run_phase(self, func, ctx):
+        """Run a single phase of execute() and time it
+
+           A Result with the start, end, duration and outcome of the
+           phase is yielded after the results of the phase itself. A
+           failed phase is recorded and its exception re-raised.
+        """
+        phase = {"phase": self.phase_name(func), "start": time.time()}
+        results = []
+        try:
+            phase_results = func(ctx)
+            # Phases that are not generators return None
+            for result in phase_results or ():
+                results.append(result)
+                yield result
+        except Exception:
+            phase.update(end=time.time(), outcome="failed")
+            self.add_phase(phase)
+            yield self.phase_result(phase, ERROR)
+            raise
+        phase.update(end=time.time(), outcome="success")
+        self.add_phase(phase)
+        results.append(self.phase_result(phase, SUCCESS))
+        # Saved in the checkpoint, to be reported again when resuming
+        self.phase_results.extend(result.to_dict() for result in results)
+        yield results[-1]
+
+    def add_phase(self, phase):
+        phase["duration"] = round(phase["end"] - phase["start"], 6)
+        self.phases.append(phase)
+
+    def phase_result(self, phase, result):
+        return Result(self, result, key="phase." + phase["phase"],
+                      when=datetime.utcfromtimestamp(phase["start"]).isoformat(),
+                      duration="%6.6f" % phase["duration"],
+                      msg="Phase {phase}: {outcome} after {phase_duration}s",
+                      phase=phase["phase"], outcome=phase["outcome"],
+                      phase_start=phase["start"], phase_end=phase["end"],
+                      phase_duration=phase["duration"])
+
+    def write_phase_timeline(self):
+        """Write the phases run so far to runner_metadata/phases.json"""
+        if not os.path.isdir("runner_metadata"):
+            return
+        with open("runner_metadata/phases.json", "w") as f:
+            json.dump(self.phases, f, indent=2)
 
 
 class Result:
@@ -462,6 +972,24 @@ class Result:
         return "%s.%s(%s): %s" % (self.source, self.test, self.kw,
                                   self.result)
 
+    def to_dict(self):
+        return dict(source=self.source,
+                    test=self.test,
+                    result=getLevelName(self.result),
+                    uuid=self.uuid,
+                    when=self.when,
+                    duration=self.duration,
+                    kw=self.kw)
+
+    @classmethod
+    def from_dict(cls, data):
+        """Rebuild a Result from its to_dict() dictionary"""
+        result = cls(None, getLevelName(data["result"]), source=data["source"],
+                     test=data["test"], when=data["when"], duration=data["duration"],
+                     **data["kw"])
+        result.uuid = data["uuid"]
+        return result
+
 
 class Results:
     """
@@ -493,10 +1021,4 @@ class Results:
 
     def output(self):
         for result in self.results:
-            yield dict(source=result.source,
-                       test=result.test,
-                       result=getLevelName(result.result),
-                       uuid=result.uuid,
-                       when=result.when,
-                       duration=result.duration,
-                       kw=result.kw)
+            yield result.to_dict()
@@ -0,0 +1,143 @@
+#
+# Copyright (C) 2024 FreeIPA Contributors see COPYING for license
+#
+
+import atexit
+import os
+import shutil
+import subprocess as sp
+import tempfile
+
+
+class SSHConnectionPool:
+    """
+    Keep one authenticated SSH master connection per host and
+    multiplex every command sent to that host over it.
+
+    sshd refuses the sessions of a connection past its MaxSessions,
+    10 by default, so at most max_sessions commands run over a master
+    at a time. The commands beyond that open their own connection.
+
+    Control sockets are kept in a private temporary directory rather
+    than in runner_metadata, which is wiped at the start of every
+    execution. Masters are closed when the interpreter exits, and
+    expire on their own after `persist` of inactivity otherwise.
+
+    Usage::
+
+        ssh_pool.connect("192.168.3.2", keys)
+        multiplex = ssh_pool.open_session("192.168.3.2")
+        argv = ssh_pool.command_args("192.168.3.2", "hostname", keys, connect=False,
+                                     multiplex=multiplex)
+        sp.run(argv, cwd="runner_metadata", stdout=sp.PIPE)
+        if multiplex:
+            ssh_pool.close_session("192.168.3.2")
+    """
+    def __init__(self, persist="30m", max_sessions=10):
+        self.persist = persist
+        self.max_sessions = max_sessions
+        self.control_dir = None
+        self.masters = set()
+        self.sessions = {}  # target:commands running over its master
+
+    def control_path(self, target):
+        if self.control_dir is None:
+            self.control_dir = tempfile.mkdtemp(prefix="ipaperftest-ssh-")
+        return os.path.join(self.control_dir, target)
+
+    def base_args(self, target, private_keys, multiplex=True):
+        args = ["ssh"]
+        for key in private_keys:
+            if key:
+                args.extend(["-i", key])
+        args.extend([
+            "-o", "StrictHostKeyChecking=no",
+            "-o", "UserKnownHostsFile=/dev/null",
+            "-o", "ControlPath=%s" % (self.control_path(target) if multiplex else "none"),
+        ])
+        return args
+
+    def master_args(self, target, private_keys):
+        """Return the argv starting a background master for target"""
+        return self.base_args(target, private_keys) + [
+            "-M", "-N", "-f",
+            "-o", "ControlMaster=yes",
+            "-o", "ControlPersist=%s" % self.persist,
+            "root@%s" % target,
+        ]
+
+    def is_connected(self, target):
+        return target in self.masters and os.path.exists(self.control_path(target))
+
+    def register_master(self, target, returncode):
+        """Record the outcome of running master_args for target"""
+        if returncode == 0:
+            self.masters.add(target)
+        else:
+            self.masters.discard(target)
+        return returncode == 0
+
+    def connect(self, target, private_keys, cwd="runner_metadata"):
+        """Start the master connection for target unless it is alive.
+
+           A failure to start the master is not fatal: commands fall
+           back to opening their own connection.
+        """
+        if self.is_connected(target):
+            return True
+
+        ret = sp.run(self.master_args(target, private_keys), cwd=cwd,
+                     stdin=sp.DEVNULL, stdout=sp.DEVNULL, stderr=sp.DEVNULL)
+        return self.register_master(target, ret.returncode)
+
+    def open_session(self, target):
+        """Reserve a session on the master of target
+
+           Returns False when there is no master or all its sessions
+           are in use, the command then needs its own connection.
+           Every reserved session must be given back with
+           close_session once the command is done.
+        """
+        sessions = self.sessions.get(target, 0)
+        if not self.is_connected(target) or sessions >= self.max_sessions:
+            return False
+        self.sessions[target] = sessions + 1
+        return True
+
+    def close_session(self, target):
+        self.sessions[target] = max(0, self.sessions.get(target, 0) - 1)
+
+    def command_args(self, target, command, private_keys, cwd="runner_metadata", connect=True,
+                     multiplex=True):
+        """Return the argv running command on target
+
+           The command goes over the master of target unless multiplex
+           is False.
+        """
+        if connect and multiplex:
+            self.connect(target, private_keys, cwd)
+        return self.base_args(target, private_keys, multiplex) + [
+            "-o", "ControlMaster=no",
+            "root@%s" % target,
+            command,
+        ]
+
+    def close(self, target):
+        if target not in self.masters:
+            return
+        self.masters.discard(target)
+        self.sessions.pop(target, None)
+        sp.run(self.base_args(target, []) + [
+            "-O", "exit", "root@%s" % target,
+        ], stdin=sp.DEVNULL, stdout=sp.DEVNULL, stderr=sp.DEVNULL)
+
+    def close_all(self):
+        for target in list(self.masters):
+            self.close(target)
+        if self.control_dir is not None:
+            shutil.rmtree(self.control_dir, ignore_errors=True)
+            self.control_dir = None
+
+
+ssh_pool = SSHConnectionPool()
+atexit.register(ssh_pool.close_all)
@@ -0,0 +1,77 @@
+#
+# Copyright (C) 2024 FreeIPA Contributors see COPYING for license
+#
+
+import math
+
+
+def percentile(values, pct):
+    """
+    Return the pct percentile of values using linear interpolation
+    between the closest ranks.
+
+    values does not need to be sorted. None is returned for an empty
+    sequence.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * pct / 100.0
+    low = math.floor(rank)
+    high = math.ceil(rank)
+    if low == high:
+        return ordered[int(rank)]
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def summarize(values, prefix=""):
+    """
+    Summarize a latency distribution as a flat dictionary that can
+    be passed as Result keywords.
+
+    Every key is prefixed with prefix so several distributions can be
+    reported by the same Result.
+    """
+    ordered = sorted(values)
+    summary = {
+        "count": len(ordered),
+        "min": None,
+        "mean": None,
+        "p50": None,
+        "p90": None,
+        "p99": None,
+        "max": None,
+    }
+    if ordered:
+        summary.update({
+            "min": round(ordered[0], 6),
+            "mean": round(sum(ordered) / len(ordered), 6),
+            "p50": round(percentile(ordered, 50), 6),
+            "p90": round(percentile(ordered, 90), 6),
+            "p99": round(percentile(ordered, 99), 6),
+            "max": round(ordered[-1], 6),
+        })
+    return {prefix + key: value for key, value in summary.items()}
+
+
+def throughput_series(timestamps, origin=None, interval=None, max_points=120):
+    """
+    Count events per interval seconds, starting at origin.
+
+    origin defaults to the earliest timestamp. When interval is not
+    given it is chosen so that the series has at most max_points
+    entries. Returns an (interval, counts) tuple.
+    """
+    if not timestamps:
+        return interval or 1, []
+    if origin is None:
+        origin = min(timestamps)
+    span = max(timestamps) - origin
+    if interval is None:
+        interval = max(1, math.ceil(span / max_points))
+    counts = [0] * (int(span // interval) + 1)
+    for ts in timestamps:
+        idx = int((ts - origin) // interval)
+        if 0 <= idx < len(counts):
+            counts[idx] += 1
+    return interval, counts
@@ -0,0 +1,216 @@
+#
+# Copyright (C) 2024 FreeIPA Contributors see COPYING for license
+#
+
+from collections import deque
+
+import yaml
+
+TOPOLOGIES = ["tree", "star", "ring", "mesh", "custom"]
+# Replication agreements FreeIPA recommends per server
+MAX_AGREEMENTS = 4
+
+
+class Topology:
+    """
+    Replication topology of the server and its replicas.
+
+    parents maps every replica to the server or replica it is
+    installed from. The replicas are installed in tiers: a replica
+    is in the tier after the one of its parent, so that every tier
+    can be installed in parallel once the previous ones are done.
+
+    Installing a replica creates a replication agreement (segment)
+    with its parent. extra_segments lists the agreements added after
+    the install, as (left, right) host name pairs.
+    """
+    def __init__(self, name, parents, extra_segments=()):
+        self.name = name
+        self.parents = dict(parents)
+        self.hosts = ["server"] + list(self.parents)
+        self.depth = {"server": 0}
+        for replica in self.parents:
+            self.depth_of(replica)
+
+        segments = set()
+        for replica, parent in self.parents.items():
+            segments.add(tuple(sorted((replica, parent))))
+        self.install_segments = set(segments)
+        for left, right in extra_segments:
+            for host in (left, right):
+                if host not in self.depth:
+                    raise RuntimeError("Unknown host %s in the segments of the %s topology."
+                                       % (host, name))
+            if left == right:
+                raise RuntimeError("Segment from %s to itself in the %s topology."
+                                   % (left, name))
+            segments.add(tuple(sorted((left, right))))
+        self.segments = sorted(segments)
+
+    def depth_of(self, host):
+        """Return the number of installs between the server and host"""
+        start = host
+        chain = []
+        while host not in self.depth:
+            if host in chain:
+                raise RuntimeError("Replicas %s are installed from each other in the %s "
+                                   "topology." % (", ".join(chain), self.name))
+            if host not in self.parents:
+                raise RuntimeError("Unknown host %s in the %s topology." % (host, self.name))
+            chain.append(host)
+            host = self.parents[host]
+        for child in reversed(chain):
+            self.depth[child] = self.depth[self.parents[child]] + 1
+        return self.depth[start]
+
+    def tiers(self):
+        """Return the replicas of every install tier, in install order"""
+        tiers = [[] for _ in range(max(self.depth.values()))]
+        for replica in self.parents:
+            tiers[self.depth[replica] - 1].append(replica)
+        return tiers
+
+    def extra_segments(self):
+        return [s for s in self.segments if s not in self.install_segments]
+
+    def neighbours(self):
+        neighbours = {host: set() for host in self.hosts}
+        for left, right in self.segments:
+            neighbours[left].add(right)
+            neighbours[right].add(left)
+        return neighbours
+
+    def hops(self, source="server", neighbours=None):
+        """Return the replication hops from source to every host"""
+        neighbours = neighbours or self.neighbours()
+        hops = {source: 0}
+        queue = deque([source])
+        while queue:
+            host = queue.popleft()
+            for other in neighbours[host]:
+                if other not in hops:
+                    hops[other] = hops[host] + 1
+                    queue.append(other)
+        return hops
+
+    def diameter(self):
+        """Return the largest number of hops a change takes to replicate"""
+        neighbours = self.neighbours()
+        return max(max(self.hops(host, neighbours).values()) for host in self.hosts)
+
+    def agreements(self):
+        return {host: len(others) for host, others in self.neighbours().items()}
+
+    def summary(self):
+        hops = self.hops()
+        replica_hops = [hops[replica] for replica in self.parents]
+        return {
+            "topology": self.name,
+            "replicas": len(self.parents),
+            "tiers": len(self.tiers()),
+            "tier_sizes": [len(tier) for tier in self.tiers()],
+            "segments": len(self.segments),
+            "max_hops": max(replica_hops, default=0),
+            "mean_hops": round(sum(replica_hops) / len(replica_hops), 2) if replica_hops else 0,
+            "diameter": self.diameter(),
+            "max_agreements": max(self.agreements().values()),
+            "hops": hops,
+        }
+
+
+def replica_names(replicas):
+    return ["replica%s" % i for i in range(replicas)]
+
+
+def tree_topology(replicas, fanout=None):
+    """Install every replica from the first host with room left
+
+       By default the server has 4 children and every replica 3, so
+       that no host has more than 4 agreements.
+    """
+    parents = {}
+    queue = deque(["server"])
+    names = deque(replica_names(replicas))
+    while names:
+        parent = queue.popleft()
+        for _ in range(fanout or (MAX_AGREEMENTS if parent == "server" else MAX_AGREEMENTS - 1)):
+            if not names:
+                break
+            replica = names.popleft()
+            parents[replica] = parent
+            queue.append(replica)
+    return Topology("tree", parents)
+
+
+def star_topology(replicas):
+    """Install every replica from the server"""
+    return Topology("star", {replica: "server" for replica in replica_names(replicas)})
+
+
+def ring_topology(replicas):
+    """Install the replicas in a chain and close it back to the server"""
+    names = replica_names(replicas)
+    parents = dict(zip(names, ["server"] + names[:-1]))
+    extra = [(names[-1], "server")] if replicas > 1 else []
+    return Topology("ring", parents, extra)
+
+
+def mesh_topology(replicas, fanout=None):
+    """Connect every pair of hosts, installing them as a tree"""
+    tree = tree_topology(replicas, fanout)
+    extra = [(left, right) for i, left in enumerate(tree.hosts)
+             for right in tree.hosts[i + 1:]]
+    return Topology("mesh", tree.parents, extra)
+
+
+def custom_topology(replicas, path):
+    """Load a topology from a YAML file
+
+       The file maps every replica to the host it is installed from
+       and may list extra segments::
+
+           parents:
+             replica0: server
+             replica1: replica0
+           segments:
+             - [replica1, server]
+    """
+    if not path:
+        raise RuntimeError("--replica-topology custom requires --replica-topology-file.")
+    try:
+        with open(path) as f:
+            data = yaml.safe_load(f) or {}
+    except (OSError, yaml.YAMLError) as e:
+        raise RuntimeError("Unable to read the topology file %s: %s" % (path, e))
+    if not isinstance(data, dict):
+        raise RuntimeError("The topology file %s must contain a mapping." % path)
+
+    parents = {str(k): str(v) for k, v in (data.get("parents") or {}).items()}
+    if sorted(parents) != sorted(replica_names(replicas)):
+        raise RuntimeError("The topology file %s must give the parent of replica0 to "
+                           "replica%s, and of no other host." % (path, replicas - 1))
+    segments = []
+    for segment in data.get("segments") or []:
+        if not isinstance(segment, (list, tuple)) or len(segment) != 2:
+            raise RuntimeError("Segments of %s must be pairs of hosts, not %s."
+                               % (path, segment))
+        segments.append((str(segment[0]), str(segment[1])))
+    return Topology("custom", parents, segments)
+
+
+def build_topology(params):
+    """Return the replication topology requested by the options"""
+    replicas = params["replicas"]
+    name = params.get("replica_topology") or "tree"
+    fanout = params.get("replica_fanout")
+    if name == "tree":
+        return tree_topology(replicas, fanout)
+    if name == "star":
+        return star_topology(replicas)
+    if name == "ring":
+        return ring_topology(replicas)
+    if name == "mesh":
+        return mesh_topology(replicas, fanout)
+    if name == "custom":
+        return custom_topology(replicas, params.get("replica_topology_file"))
+    raise RuntimeError("Unknown replica topology '%s'." % name)
@@ -2,35 +2,139 @@
 # Copyright (C) 2021 FreeIPA Contributors see COPYING for license
 #
 
+import click
+import json
 import math
 import os
+import shlex
 import time
-import ansible_runner
 from datetime import datetime
 
 from ipaperftest.core.plugin import Plugin, Result
+from ipaperftest.core.stats import summarize
 from ipaperftest.core.constants import (
     ANSIBLE_APITEST_CLIENT_UPLOAD_SEQUENTIAL_SCRIPT_PLAYBOOK,
     SUCCESS,
     ERROR,
-    ANSIBLE_APITEST_CLIENT_CONFIG_PLAYBOOK)
+    ANSIBLE_APITEST_CLIENT_CONFIG_PLAYBOOK,
+    APITEST_RUNNER_SCRIPT,
+    APITEST_JSONRPC_SCRIPT)
 from ipaperftest.plugins.registry import registry
 
 
+# Adaptive client sizing. Every command of the CLI mode is an ipa
+# process of its own; the JSON-RPC mode only needs a thread per session.
+CLI_COMMANDS_PER_CPU = 25
+CLI_COMMAND_MEMORY = 80  # MiB
+JSONRPC_SESSIONS_PER_CPU = 50
+
+
+def ipa_command_argv(command):
+    """Split an `ipa` command line into the arguments following `ipa`
+
+       Used by the JSON-RPC mode, where the client translates them into
+       a call of the matching API command.
+    """
+    try:
+        argv = shlex.split(command)
+    except ValueError as e:
+        raise RuntimeError("Unable to parse command '%s': %s" % (command, e))
+    if len(argv) < 2 or os.path.basename(argv[0]) != "ipa":
+        raise RuntimeError("JSON-RPC mode requires an 'ipa <command> ...' command, "
+                           "got '%s'" % command)
+    if argv[1].startswith("-"):
+        raise RuntimeError("Global ipa options are not supported in JSON-RPC mode.")
+    return argv[1:]
+
+
 @registry
 class APITest(Plugin):
+    """Run an IPA command many times at once from the clients."""
+
+    options = [
+        click.Option(
+            ["--command"],
+            help="Command to execute, {id} is replaced with the command number.",
+        ),
+        click.Option(
+            ["--sequential"],
+            help="Run the commands sequentially from a single client.",
+            is_flag=True
+        ),
+        click.Option(
+            ["--commands-per-client"],
+            help="Commands run by each client. 0 sizes the clients from "
+                 "the resources of the provider's client hosts.",
+            type=click.IntRange(min=0), default=25,
+        ),
+        click.Option(
+            ["--api-target-concurrency"],
+            help="Calls in flight across all clients when sizing the clients of "
+                 "the JSON-RPC mode from their resources (0 = --amount).",
+            type=click.IntRange(min=0), default=0,
+        ),
+        click.Option(
+            ["--api-mode"],
+            help="How commands are issued: by running the ipa CLI, or as "
+                 "JSON-RPC calls over authenticated keep-alive sessions.",
+            type=click.Choice(["cli", "jsonrpc"]), default="cli"
+        ),
+        click.Option(
+            ["--api-concurrency"],
+            help="HTTPS sessions each client keeps open in the JSON-RPC mode.",
+            type=click.IntRange(min=1), default=10,
+        ),
+        click.Option(
+            ["--api-batch-size"],
+            help="Commands sent per JSON-RPC request in the JSON-RPC mode "
+                 "(more than 1 uses the batch command).",
+            type=click.IntRange(min=1), default=1,
+        ),
+    ]
 
     def __init__(self, registry):
         super().__init__(registry)
         self.custom_logs = ["command*log", ]
 
+    def size_clients(self, ctx):
+        """Pick the number of clients and how many commands each runs
+
+           With --commands-per-client 0 the size of a client comes from
+           the cpus and memory of the provider's client hosts: in CLI mode
+           all of its commands run at once, in JSON-RPC mode its sessions
+           share the --api-target-concurrency calls in flight.
+        """
+        amount = ctx.params['amount']
+        self.api_concurrency = ctx.params['api_concurrency']
+        if ctx.params['commands_per_client']:
+            self.commands_per_client = ctx.params['commands_per_client']
+            return math.ceil(amount / self.commands_per_client)
+
+        resources = self.provider.host_resources(ctx, "client")
+        if "cpus" not in resources or "memory" not in resources:
+            raise RuntimeError("The %s provider does not define the resources of its "
+                               "clients, set --commands-per-client."
+                               % ctx.params['provider'])
+        if ctx.params['api_mode'] == "jsonrpc":
+            target = ctx.params['api_target_concurrency'] or amount
+            per_client = resources["cpus"] * JSONRPC_SESSIONS_PER_CPU
+            n_clients = math.ceil(min(target, amount) / per_client)
+            self.api_concurrency = math.ceil(min(target, amount) / n_clients)
+        else:
+            per_client = max(1, min(resources["cpus"] * CLI_COMMANDS_PER_CPU,
+                                    resources["memory"] // CLI_COMMAND_MEMORY))
+            n_clients = math.ceil(amount / per_client)
+        self.commands_per_client = math.ceil(amount / n_clients)
+        print("Sizing clients for {} cpus and {} MiB: {} clients, {} commands each".format(
+            resources["cpus"], resources["memory"], n_clients, self.commands_per_client))
+        return n_clients
+
     def generate_clients(self, ctx):
         if ctx.params['sequential']:
             # We only need a single client for sequential mode
             n_clients = 1
         else:
-            self.commands_per_client = 25
-            n_clients = math.ceil(ctx.params['amount'] / self.commands_per_client)
+            n_clients = self.size_clients(ctx)
         for i in range(n_clients):
             idx = str(i).zfill(3)
             machine_name = "client{}".format(idx)
@@ -44,57 +148,89 @@ class APITest(Plugin):
     def validate_options(self, ctx):
         if not ctx.params.get('command'):
             raise RuntimeError('command is required')
+        if ctx.params['api_mode'] == "jsonrpc":
+            if ctx.params['sequential']:
+                raise RuntimeError("--api-mode jsonrpc cannot be used with --sequential.")
+            ipa_command_argv(ctx.params['command'].format(id="0"))
 
     def run_simultaneously(self, ctx):
-        # Wait 2 min per client before running the commands
-        clients = [name for name, _ in self.provider.hosts.items() if name.startswith("client")]
-        local_run_time, epoch_run_time = (
-            self.run_ssh_command(
-                "date --date now+{}min '+%H:%M %s'"
-                .format(str(len(clients) * 2)),
-                self.provider.hosts[clients[0]], ctx)
-            .stdout.decode("utf-8")
-            .strip().split(" ")
-        )
+        """Start every command at the same epoch timestamp
+
+           A runner uploaded to each client starts its commands at that
+           time and prints a record with the time every command started
+           and ended, taken on the client. The records are read from the
+           output of the SSH session as they arrive. The execution time
+           is the longest span of commands run by a single client.
+
+           In JSON-RPC mode the runner issues the commands as API calls
+           over api_concurrency sessions instead of forking the ipa CLI.
+        """
+        jsonrpc = ctx.params['api_mode'] == "jsonrpc"
+        clients = {name: ip for name, ip in self.provider.hosts.items()
+                   if name.startswith("client")}
+        client_names = list(clients.keys())
 
-        # commands[0] -> list of commands for client #1
-        commands = [[] for _ in clients]
+        # client name -> list of [id, command] for that client
+        commands = {name: [] for name in client_names}
         for i in range(ctx.params['amount']):
             client_idx = math.floor(i / self.commands_per_client)
             id_str = str(i).zfill(len(str(ctx.params['amount'])))
             formated_api_cmd = ctx.params['command'].format(id=id_str)
-            cmd = (
-                r"echo 'echo {cmd} > ~/command{id}log;"
-                r"{cmd} >> ~/command{id}log 2>&1;"
-                r"echo \$? >> ~/command{id}log' "
-                r"| at {time}".format(
-                 cmd=formated_api_cmd, id=str(i), time=local_run_time)
-            )
-            commands[client_idx].append(cmd)
-        for id, command_list in enumerate(commands):
-            self.run_ssh_command(" && ".join(command_list), self.provider.hosts[clients[id]], ctx)
+            command = [str(i), formated_api_cmd]
+            if jsonrpc:
+                command.append(ipa_command_argv(formated_api_cmd))
+            commands[client_names[client_idx]].append(command)
 
-        print("Commands will be run at %s (machine local time)" % local_run_time)
-        sleep_time = int(epoch_run_time) - time.time()
-        time.sleep(sleep_time)
-        # Wait until all atd commands have completed
-        # (that is, once /var/spool/at only has the 'spool' dir)
+        if jsonrpc:
+            runner = "apitest_jsonrpc.py"
+            runner_args = " --server server.{} --concurrency {} --batch-size {}".format(
+                self.domain, self.api_concurrency, ctx.params['api_batch_size'])
+            script = APITEST_JSONRPC_SCRIPT
+        else:
+            runner = "apitest_runner.py"
+            runner_args = ""
+            script = APITEST_RUNNER_SCRIPT
+        self.upload_client_files({
+            runner: script,
+            "apitest_commands.json": json.dumps(commands),
+        }, ctx)
 
-        start_time = time.time()
-        while True:
-            clients_cmds_pending = []
-            for client in clients:
-                cmds_pending = (
-                    self.run_ssh_command("sudo ls /var/spool/at | wc -l",
-                                         self.provider.hosts[client], ctx)
-                    .stdout.decode("utf-8")
-                    .strip()
-                )
-                clients_cmds_pending.append(cmds_pending)
-            if all([cmds == "1" for cmds in clients_cmds_pending]):
-                break
-            time.sleep(5)
-        self.execution_time = time.time() - start_time
+        # Leave enough time for every runner to be started
+        run_time = int(time.time()) + 30 + len(clients) // 20
+        runner_cmds = [
+            (name, ip, "python3 {} --client {} --start {}{}".format(
+                runner, name, run_time, runner_args))
+            for name, ip in clients.items()
+        ]
+        print("Commands will be run at %s" % time.ctime(run_time))
+
+        self.command_events = []
+
+        def record(host, line):
+            try:
+                event = json.loads(line)
+            except ValueError:
+                return
+            event["host"] = host
+            self.command_events.append(event)
+            if len(self.command_events) % 100 == 0:
+                print("%s/%s commands completed" % (len(self.command_events),
+                                                    ctx.params['amount']))
+
+        for result in self.remote_executor(ctx).run(runner_cmds, on_line=record):
+            if result.returncode != 0:
+                print("Runner on %s returned %s: %s" % (
+                    result.key, result.returncode, result.stderr.decode("utf-8").strip()))
+
+        if not self.command_events:
+            raise RuntimeError("None of the clients reported completed commands.")
+        # The clocks of the clients are not synchronized, so the start and
+        # end of commands are only compared on the client that ran them
+        spans = {}
+        for e in self.command_events:
+            first, last = spans.get(e["host"], (e["start"], e["end"]))
+            spans[e["host"]] = (min(first, e["start"]), max(last, e["end"]))
+        self.execution_time = max(last - first for first, last in spans.values())
 
     def run_sequentially(self, ctx):
         commands = []
@@ -134,9 +270,9 @@ class APITest(Plugin):
         }
         self.run_ansible_playbook_from_template(ANSIBLE_APITEST_CLIENT_CONFIG_PLAYBOOK,
                                                 "apitest_client_config", args, ctx)
-        ansible_runner.run(private_data_dir="runner_metadata",
-                           playbook="ansible-freeipa/playbooks/install-client.yml",
-                           verbosity=1)
+        self.provider.run_ansible(private_data_dir="runner_metadata",
+                                  playbook="ansible-freeipa/playbooks/install-client.yml",
+                                  verbosity=1)
 
         clients = [name for name, _ in self.provider.hosts.items() if name.startswith("client")]
         for client in clients:
@@ -168,6 +304,19 @@ class APITest(Plugin):
         with open("sync/returncodes", "w") as f:
             f.write(returncodes)
 
+        if not ctx.params["sequential"]:
+            with open("sync/command_timings", "w") as f:
+                f.write("host id returncode start end duration\n")
+                for e in sorted(self.command_events, key=lambda e: e["start"]):
+                    f.write("{} {} {} {:.6f} {:.6f} {:.6f}\n".format(
+                        e["host"], e["id"], e["returncode"], e["start"], e["end"],
+                        e["end"] - e["start"]))
+            yield Result(self, SUCCESS,
+                         msg="Command latency: p50 {latency_p50}s, p90 {latency_p90}s, "
+                             "p99 {latency_p99}s, max {latency_max}s",
+                         **summarize([e["end"] - e["start"] for e in self.command_events],
+                                     prefix="latency_"))
+
         if commands_succeeded == ctx.params['amount']:
             yield Result(self, SUCCESS, msg="All commands executed successfully.",
                          successes=commands_succeeded)
@@ -178,8 +327,14 @@ class APITest(Plugin):
 
         yield Result(self, SUCCESS, msg="Test executed in {} seconds.".format(self.execution_time))
 
+        if ctx.params["sequential"]:
+            mode = "sequential"
+        elif ctx.params["api_mode"] == "jsonrpc":
+            mode = "jsonrpc"
+        else:
+            mode = "simultaneous"
         self.results_archive_name = "APITest-{}-{}-{}-{}commands-{}fails-{}s".format(
-            "sequential" if ctx.params["sequential"] else "simultaneous",
+            mode,
             datetime.now().strftime("%FT%H%MZ"),
             self.provider.server_image.replace("/", ""),
             ctx.params['amount'],
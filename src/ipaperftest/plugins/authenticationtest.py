@@ -2,6 +2,8 @@
 # Copyright (C) 2021 FreeIPA Contributors see COPYING for license
 #
 
+import click
+import json
 import os
 import random
 import subprocess as sp
@@ -9,6 +11,7 @@ import time
 from datetime import datetime
 
 from ipaperftest.core.plugin import Plugin, Result
+from ipaperftest.core.stats import summarize
 from ipaperftest.core.constants import (
     SUCCESS,
     WARNING,
@@ -19,16 +22,80 @@ from ipaperftest.core.constants import (
     ANSIBLE_AUTHENTICATIONTEST_AD_SERVER_ESTABLISH_TRUST_PLAYBOOK,
     ANSIBLE_AUTHENTICATIONTEST_AD_SERVER_CREATE_USERS_PLAYBOOK,
     ANSIBLE_AUTHENTICATIONTEST_NOSELINUX_CONFIG_PLAYBOOK,
-    ANSIBLE_COUNT_IPA_HOSTS_PLAYBOOK)
+    ANSIBLE_COUNT_IPA_HOSTS_PLAYBOOK,
+    AUTHENTICATIONTEST_RATE_DRIVER_SCRIPT)
 from ipaperftest.plugins.registry import registry
 
+# Steps timed by pamtest for every login
+PAM_STEPS = ("authenticate", "acct_mgmt", "open_session", "close_session")
+
 
 @registry
 class AuthenticationTest(Plugin):
+    """Log in from the clients with pamtest and measure the logins."""
+
+    enrolls_clients = True
+    options = [
+        click.Option(
+            ["--threads"],
+            help="Threads to run per client.",
+            type=click.IntRange(min=1), default=10,
+        ),
+        click.Option(
+            ["--ad-threads"],
+            help="Active Directory login threads to run per client.",
+            type=click.IntRange(min=0), default=0,
+        ),
+        click.Option(
+            ["--disable-selinux"],
+            help="Disable the SSSD SELinux provider in all clients, enable forking in pamtest",
+            is_flag=True
+        ),
+        click.Option(
+            ["--auth-spread"],
+            help="Time range in minutes to spread auths",
+            type=click.IntRange(min=0), default=0,
+        ),
+        click.Option(
+            ["--auth-rate"],
+            help="Target authentication rate (auth/s, across all clients) of the "
+                 "open-loop mode. Repeat to run a rate ramp.",
+            type=click.FloatRange(min=0, min_open=True),
+            multiple=True,
+        ),
+        click.Option(
+            ["--auth-rate-duration"],
+            help="Duration in seconds of each --auth-rate step.",
+            type=click.IntRange(min=1), default=60,
+        ),
+        click.Option(
+            ["--auth-rate-workers"],
+            help="Logins in flight on each client in the open-loop mode. Later "
+                 "arrivals wait for a worker, which is reported as start lag.",
+            type=click.IntRange(min=1), default=200,
+        ),
+        click.Option(
+            ["--auth-arrival"],
+            help="Arrival process used to schedule logins in the open-loop mode.",
+            type=click.Choice(["poisson", "fixed"]), default="poisson"
+        ),
+        click.Option(
+            ["--pamtest-iterations"],
+            help="Logins performed by each pamtest thread "
+                 "(default 1, or no limit with --pamtest-duration).",
+            type=click.IntRange(min=0),
+        ),
+        click.Option(
+            ["--pamtest-duration"],
+            help="Time in seconds each pamtest thread keeps logging in "
+                 "(0 = only use --pamtest-iterations).",
+            type=click.IntRange(min=0), default=0,
+        ),
+    ]
 
     def __init__(self, registry):
         super().__init__(registry)
-        self.custom_logs = ["pamtest.log", ]
+        self.custom_logs = ["pamtest.log", "pamtest-rate.log", ]
 
     def generate_clients(self, ctx):
         if ctx.params["ad_threads"] > 0:
@@ -51,11 +118,15 @@ class AuthenticationTest(Plugin):
             )
 
     def validate_options(self, ctx):
-        if not ctx.params.get('threads'):
-            raise RuntimeError('threads number is required')
-        if ctx.params.get("ad_threads", 0) > ctx.params["threads"]:
+        if ctx.params["ad_threads"] > ctx.params["threads"]:
             raise RuntimeError("Number of AD login threads should be equal "
                                "or lower than the threads amount.")
+        if ctx.params["pamtest_iterations"] == 0 and ctx.params["pamtest_duration"] == 0:
+            raise RuntimeError("pamtest needs a duration to loop without an iterations limit.")
+        if ctx.params["auth_rate"]:
+            if ctx.params["threads"] - ctx.params["ad_threads"] <= 0:
+                raise RuntimeError("The open-loop mode only logs in IPA users, "
+                                   "at least one non-AD thread is required.")
 
     def install_server(self, ctx):
         if ctx.params["ad_threads"] > 0:
@@ -120,7 +191,7 @@ class AuthenticationTest(Plugin):
             "sudo ipa-client-install -p admin -w password -U "
             "--enable-dns-updates --no-nisdomain -N",
         ]
-        processes = {}
+        commands = []
         non_client_hosts = 0
         windows_hosts = 0
         installed = 0
@@ -137,19 +208,16 @@ class AuthenticationTest(Plugin):
             if installed % 30 == 0:
                 sleep_time += 20
             cmds = ["sleep {}".format(sleep_time + random.randrange(1, 10))] + client_cmds
-            proc = self.run_ssh_command(" && ".join(cmds), ip, ctx, False)
-            processes[host] = proc
+            commands.append((host, ip, " && ".join(cmds)))
 
         print("Waiting for client installs to be completed...")
         self.clients_succeeded = 0
         clients_returncodes = ""
-        for host, proc in processes.items():
-            proc.communicate()
-            returncode = proc.returncode
-            rc_str = "Host " + host + " returned " + str(returncode)
+        for result in self.remote_executor(ctx).run(commands):
+            rc_str = "Host " + result.key + " returned " + str(result.returncode)
             clients_returncodes += rc_str + "\n"
             print(rc_str)
-            if returncode == 0:
+            if result.returncode == 0:
                 self.clients_succeeded += 1
         print("Clients succeeded: %s" % str(self.clients_succeeded))
         print("Return codes written to sync directory.")
@@ -187,13 +255,24 @@ class AuthenticationTest(Plugin):
                 "authenticationtest_no_selinux", {}, ctx
             )
 
+        if ctx.params["auth_rate"]:
+            self.run_rate_steps(ctx)
+            return
+
         # Client authentications will be triggered at now + 1min per 20 clients
         wait_time = max(int(len(self.provider.hosts.keys()) / 20), 1) * 60
         client_auth_time = int(time.time()) + wait_time
 
+        # Each pamtest thread may loop for a number of logins or a duration
+        loop_args = ""
+        if ctx.params["pamtest_iterations"] is not None:
+            loop_args += "--iterations {} ".format(ctx.params["pamtest_iterations"])
+        if ctx.params["pamtest_duration"] > 0:
+            loop_args += "--duration {} ".format(ctx.params["pamtest_duration"])
+
         # Now that all the client installs are done, fire off the
         # authentications (for now whether all installs are ok or not)
-        processes = {}
+        commands = []
         for host, ip in self.provider.hosts.items():
             if not host.startswith("client"):
                 continue
@@ -204,29 +283,231 @@ class AuthenticationTest(Plugin):
                 spread = random.randrange(0, int(ctx.params['auth_spread'])) * 60
             cmds = [
                 "sleep $(( {} - $(date +%s) ))".format(str(client_auth_time + spread)),
-                "sudo pamtest {} --threads {} --ad-threads {} -o pamtest.log".format(
+                "sudo pamtest {} --threads {} --ad-threads {} {}-o pamtest.log".format(
                     '-f' if ctx.params["disable_selinux"] else '',
                     str(ctx.params["threads"]),
-                    str(ctx.params["ad_threads"])
+                    str(ctx.params["ad_threads"]),
+                    loop_args
                 ),
             ]
-            proc = self.run_ssh_command(" && ".join(cmds), ip, ctx, False)
-            processes[host] = proc
+            commands.append((host, ip, " && ".join(cmds)))
 
         print("Waiting for client auth to be completed...")
 
         start_time = time.time()
-        for host, proc in processes.items():
-            proc.communicate()
+        for result in self.remote_executor(ctx).run(commands):
+            if result.returncode != 0:
+                print("Host %s returned %s" % (result.key, result.returncode))
         self.execution_time = time.time() - start_time - wait_time
 
         return
 
+    def run_rate_steps(self, ctx):
+        """Drive logins as an open-loop arrival process at each of the
+           requested rates, one step after the other.
+
+           The target rate is split evenly between clients. Every client
+           runs a driver which starts one pamtest login per arrival,
+           without waiting for the previous ones to finish, on a pool of
+           auth_rate_workers threads.
+        """
+        self.upload_client_files(
+            {"pamtest_rate_driver.py": AUTHENTICATIONTEST_RATE_DRIVER_SCRIPT}, ctx)
+
+        clients = {host: ip for host, ip in self.provider.hosts.items()
+                   if host.startswith("client")}
+        users = ctx.params["threads"] - ctx.params["ad_threads"]
+        duration = ctx.params["auth_rate_duration"]
+
+        # Every step is appended to pamtest-rate.log, drop the records
+        # of a previous run of a reused deployment
+        for _ in self.remote_executor(ctx).run(
+                [(host, ip, "rm -f pamtest-rate.log") for host, ip in clients.items()]):
+            pass
+
+        self.rate_steps = []
+        self.execution_time = 0
+        for step, rate in enumerate(ctx.params["auth_rate"]):
+            # Leave enough time for every driver to be started
+            start = int(time.time()) + 30 + len(clients) // 20
+            commands = []
+            for idx, (host, ip) in enumerate(clients.items()):
+                commands.append((host, ip, (
+                    "python3 pamtest_rate_driver.py --rate {} --duration {} --start {} "
+                    "--arrival {} --phase {} --seed {} --users {} --step {} --workers {} {}"
+                    "--output pamtest-rate.log").format(
+                        rate / len(clients), duration, start,
+                        ctx.params["auth_arrival"], idx / len(clients),
+                        random.randrange(2 ** 32), users, step,
+                        ctx.params["auth_rate_workers"],
+                        "--fork " if ctx.params["disable_selinux"] else "")))
+            self.rate_steps.append({"step": step, "rate": rate, "start": start})
+
+            print("Running %s auth/s for %ss starting at %s..."
+                  % (rate, duration, time.ctime(start)))
+            for result in self.remote_executor(ctx).run(commands):
+                if result.returncode != 0:
+                    print("Host %s returned %s" % (result.key, result.returncode))
+            self.execution_time += time.time() - start
+
+    def post_process_rate_logs(self, ctx):
+        """Report achieved rate, latency and error rate for each rate step"""
+        records = []
+        for host in os.listdir("sync"):
+            if not host.startswith("client"):
+                continue
+            logpath = "sync/{}/pamtest-rate.log".format(host)
+            try:
+                with open(logpath) as f:
+                    lines = f.readlines()
+            except FileNotFoundError:
+                yield Result(self, WARNING, msg="File %s not found" % logpath)
+                continue
+            for line in lines:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+
+        duration = ctx.params["auth_rate_duration"]
+        total_logins = 0
+        total_failures = 0
+        for step, rate in enumerate(ctx.params["auth_rate"]):
+            step_records = [r for r in records if r["step"] == step]
+            if not step_records:
+                yield Result(self, ERROR, error="No logins recorded for %s auth/s." % rate,
+                             step=step, target_rate=rate)
+                continue
+            succeeded = [r for r in step_records if r["returncode"] == 0]
+            failures = len(step_records) - len(succeeded)
+            first_scheduled = min(r["scheduled"] for r in step_records)
+            last_end = max(r["end"] for r in step_records)
+            # No rate can be measured when the step took no time at all
+            span = last_end - first_scheduled
+            kw = summarize([r["end"] - r["start"] for r in succeeded], prefix="latency_")
+            kw.update(summarize([r["start"] - r["scheduled"] for r in step_records],
+                                prefix="start_lag_"))
+            kw.update({
+                "step": step,
+                "target_rate": rate,
+                "offered_rate": round(len(step_records) / duration, 3),
+                "achieved_rate": round(len(succeeded) / span, 3) if span > 0 else None,
+                "error_rate": round(failures / len(step_records), 4),
+                "logins": len(step_records),
+                "failures": failures,
+            })
+            result = SUCCESS if failures == 0 and span > 0 else ERROR
+            yield Result(self, result,
+                         msg="Target {target_rate} auth/s: achieved {achieved_rate} auth/s, "
+                             "errors {error_rate}, latency p50 {latency_p50}s, "
+                             "p90 {latency_p90}s, p99 {latency_p99}s",
+                         **kw)
+            total_logins += len(step_records)
+            total_failures += failures
+
+        self.results_archive_name = "AuthenticationTest-{}-{}-{}auth_s-{}logins-{}fails".format(
+            datetime.now().strftime("%FT%H%MZ"),
+            self.provider.server_image.replace("/", ""),
+            "_".join(str(rate) for rate in ctx.params["auth_rate"]),
+            total_logins,
+            total_failures
+        )
+
+    def parse_timing(self, line):
+        """Parse a pamtest timing record into a dictionary
+
+           Steps which were not reached have a duration of -1 and are
+           not counted in the total.
+        """
+        timing = {}
+        for field in line.split()[1:]:
+            key, value = field.split("=", 1)
+            if key == "user":
+                timing[key] = value
+            elif key in ("result", "iteration"):
+                timing[key] = int(value)
+            else:
+                timing[key] = float(value)
+        timing["total"] = sum(timing[step] for step in PAM_STEPS if timing.get(step, -1) >= 0)
+        return timing
+
+    def report_timings(self, timings, slowest=10):
+        """Report the global latency distribution of each PAM step and
+           the users with the slowest logins.
+        """
+        if not timings:
+            yield Result(self, WARNING, msg="No pamtest timing records found.")
+            return
+
+        with open("sync/pamtest_timings", "w") as f:
+            f.write("host user result start %s total\n" % " ".join(PAM_STEPS))
+            for t in sorted(timings, key=lambda t: t["start"]):
+                f.write("{} {} {} {:.6f} {} {:.6f}\n".format(
+                    t["host"], t["user"], t["result"], t["start"],
+                    " ".join("{:.6f}".format(t[step]) for step in PAM_STEPS),
+                    t["total"]))
+        print("Per-login timings written to sync directory.")
+
+        kw = summarize([t["total"] for t in timings], prefix="total_")
+        for step in PAM_STEPS:
+            kw.update(summarize([t[step] for t in timings if t[step] >= 0],
+                                prefix=step + "_"))
+        yield Result(self, SUCCESS,
+                     msg="Login latency over {total_count} logins: p50 {total_p50}s, "
+                         "p90 {total_p90}s, p99 {total_p99}s, max {total_max}s "
+                         "(pam_authenticate p99 {authenticate_p99}s)",
+                     **kw)
+
+        yield from self.report_steady_state(timings)
+
+        slowest_logins = [
+            {"host": t["host"], "user": t["user"], "result": t["result"],
+             "total": round(t["total"], 6)}
+            for t in sorted(timings, key=lambda t: t["total"], reverse=True)[:slowest]
+        ]
+        yield Result(self, SUCCESS,
+                     msg="Slowest login: {slowest_user} ({slowest_total}s)",
+                     slowest_user=slowest_logins[0]["user"],
+                     slowest_total=slowest_logins[0]["total"],
+                     slowest_logins=slowest_logins)
+
+    def report_steady_state(self, timings):
+        """Report the first, cold-cache, iteration of every worker apart
+           from the following ones when pamtest looped.
+        """
+        cold = [t for t in timings if t.get("iteration", 0) == 0]
+        steady = [t for t in timings if t.get("iteration", 0) > 0]
+        if not steady:
+            return
+
+        yield Result(self, SUCCESS,
+                     msg="Cold-cache logins: {cold_count}, p50 {cold_p50}s, p99 {cold_p99}s",
+                     **summarize([t["total"] for t in cold], prefix="cold_"))
+
+        succeeded = [t for t in steady if t["result"] == 0]
+        first_start = min(t["start"] for t in steady)
+        last_end = max(t["start"] + t["total"] for t in steady)
+        throughput = len(succeeded) / (last_end - first_start) if last_end > first_start else 0
+        yield Result(self, SUCCESS,
+                     msg="Steady-state logins: {steady_count}, {steady_throughput} auth/s, "
+                         "p50 {steady_p50}s, p99 {steady_p99}s, {steady_failures} failed",
+                     steady_throughput=round(throughput, 3),
+                     steady_failures=len(steady) - len(succeeded),
+                     **summarize([t["total"] for t in steady], prefix="steady_"))
+
     def post_process_logs(self, ctx):
-        """ Calculate number of succeeded threads """
+        """ Calculate number of succeeded threads and logins
+
+            Each thread prints one "Thread returned" line, failed if
+            any of its logins failed, and one Timing record per login.
+        """
+        if ctx.params["auth_rate"]:
+            yield from self.post_process_rate_logs(ctx)
+            return
 
         total_successes = 0
         total_threads = 0
+        timings = []
         for host in os.listdir("sync"):
             if not host.startswith("client"):
                 continue
@@ -240,7 +521,13 @@ class AuthenticationTest(Plugin):
 
             n_threads = 0
             n_succeeded = 0
+            host_timings = []
             for line in logstr:
+                if line.startswith("Timing "):
+                    timing = self.parse_timing(line)
+                    timing["host"] = host
+                    host_timings.append(timing)
+                    continue
                 if not line.startswith("Thread returned"):
                     continue
 
@@ -257,6 +544,14 @@ class AuthenticationTest(Plugin):
                              error="Not all threads on %s succeded: %s/%s (%s)."
                              % (host, n_succeeded, n_threads, percentage))
 
+            if host_timings:
+                yield Result(self, SUCCESS,
+                             msg="Login latency on {host}: p50 {total_p50}s, "
+                                 "p90 {total_p90}s, p99 {total_p99}s, max {total_max}s",
+                             host=host,
+                             **summarize([t["total"] for t in host_timings], prefix="total_"))
+            timings.extend(host_timings)
+
             total_successes += n_succeeded
             total_threads += n_threads
 
@@ -265,8 +560,10 @@ class AuthenticationTest(Plugin):
                          error="None of the threads returned results.")
         total_percentage = round((total_successes / total_threads) * 100)
 
+        failed_logins = sum(1 for t in timings if t["result"] != 0)
         yield Result(self, SUCCESS, msg="{} threads out of {} succeeded ({}%)".format(
-            total_successes, total_threads, total_percentage), successes=total_successes)
+            total_successes, total_threads, total_percentage), successes=total_successes,
+            logins=len(timings), failed_logins=failed_logins)
 
         if total_percentage == 100:
             yield Result(self, SUCCESS, msg="All threads succeded.")
@@ -275,6 +572,8 @@ class AuthenticationTest(Plugin):
                          error="Not all threads succeeded: %s/%s (%s)."
                          % (total_successes, total_threads, total_percentage))
 
+        yield from self.report_timings(timings)
+
         self.results_archive_name = "AuthenticationTest-{}-{}-{}threads-{}fails".format(
             datetime.now().strftime("%FT%H%MZ"),
             self.provider.server_image.replace("/", ""),
@@ -2,14 +2,16 @@
 # Copyright (C) 2024 FreeIPA Contributors see COPYING for license
 #
 
+import click
+import json
 import os
 import random
-import resource
 import subprocess as sp
 import time
 from datetime import datetime
 
 from ipaperftest.core.plugin import Plugin, Result
+from ipaperftest.core.stats import summarize, throughput_series
 from ipaperftest.core.constants import (
     SUCCESS,
     WARNING,
@@ -17,16 +19,43 @@ from ipaperftest.core.constants import (
     ANSIBLE_ENROLLMENTTEST_CLIENT_CONFIG_PLAYBOOK,
     ANSIBLE_COUNT_IPA_HOSTS_PLAYBOOK,
     ANSIBLE_CERTISSUANCETEST_SERVER_TUNING_PLAYBOOK,
-    ANSIBLE_CERTISSUANCETEST_SERVER_CONFIG_PLAYBOOK)
+    ANSIBLE_CERTISSUANCETEST_SERVER_CONFIG_PLAYBOOK,
+    CERTISSUANCETEST_DRIVER_SCRIPT)
 from ipaperftest.plugins.registry import registry
 
 
 @registry
 class CertIssuanceTest(Plugin):
+    """Request certificates for services from every client at once."""
+
+    enrolls_clients = True
+    options = [
+        click.Option(
+            ["--cert-requests"],
+            help="Number of certificates to request",
+            type=click.IntRange(min=1), required=True,
+        ),
+        click.Option(
+            ["--wsgi-processes"],
+            help="Number of WSGI processes",
+            type=click.IntRange(min=1), default=4,
+        ),
+        click.Option(
+            ["--cert-batch"],
+            help="Fire all certificate requests of a client from a driver running on "
+                 "the client instead of one SSH command per request.",
+            is_flag=True
+        ),
+        click.Option(
+            ["--ad-threads"],
+            help="Deploy an Active Directory server next to IPA when greater than 0.",
+            type=click.IntRange(min=0), default=0,
+        ),
+    ]
 
     def __init__(self, registry):
         super().__init__(registry)
-        self.custom_logs = ["getcert.log", ]
+        self.custom_logs = ["getcert.log", "certrequests.log", ]
 
     def generate_clients(self, ctx):
 
@@ -40,10 +69,6 @@ class CertIssuanceTest(Plugin):
                 }
             )
 
-    def validate_options(self, ctx):
-        if not ctx.params.get('threads'):
-            raise RuntimeError('threads number is required')
-
     def install_server(self, ctx):
         if ctx.params["ad_threads"] > 0:
             # install AD server
@@ -71,7 +96,7 @@ class CertIssuanceTest(Plugin):
             "sudo ipa-client-install -p admin -w password -U "
             "--enable-dns-updates --no-nisdomain -N",
         ]
-        processes = {}
+        commands = []
         non_client_hosts = 0
         installed = 0
         sleep_time = 20
@@ -84,20 +109,20 @@ class CertIssuanceTest(Plugin):
             # spread the client install time to hopefully have all pass
             if installed % 30 == 0:
                 sleep_time += 20
-            cmds = ["sleep {}".format(sleep_time + random.randrange(1, 10))] + client_cmds
-            proc = self.run_ssh_command(" && ".join(cmds), ip, ctx, False)
-            processes[host] = proc
+            # The request logs are appended to, drop the ones of a
+            # previous run of a reused deployment
+            cmds = ["rm -f certrequests.log request.log",
+                    "sleep {}".format(sleep_time + random.randrange(1, 10))] + client_cmds
+            commands.append((host, ip, " && ".join(cmds)))
 
         print("Waiting for client installs to be completed...")
         self.clients_succeeded = 0
         clients_returncodes = ""
-        for host, proc in processes.items():
-            proc.communicate()
-            returncode = proc.returncode
-            rc_str = "Host " + host + " returned " + str(returncode)
+        for result in self.remote_executor(ctx).run(commands):
+            rc_str = "Host " + result.key + " returned " + str(result.returncode)
             clients_returncodes += rc_str + "\n"
             print(rc_str)
-            if returncode == 0:
+            if result.returncode == 0:
                 self.clients_succeeded += 1
         print("Clients succeeded: %s" % str(self.clients_succeeded))
         print("Return codes written to sync directory.")
@@ -142,61 +167,152 @@ class CertIssuanceTest(Plugin):
             "certissuancetest_server_tuning", args, ctx
         )
 
-        # Client authentications will be triggered at now + 1min per 20 clients
-        # wait_time = max(int(len(self.provider.hosts.keys()) / 20), 1) * 60
-        client_wait_time = int(time.time()) + 30
-
         # Now that all the client installs are done, fire off the
         # certificate requests (for now whether all installs are ok or not)
-        resource.setrlimit(resource.RLIMIT_NOFILE, (16384, 16384))
-        processes = []
-        for host, ip in self.provider.hosts.items():
-            if not host.startswith("client"):
-                continue
-            for i in range(ctx.params["cert_requests"]):
-                service_cmd = 'sudo ipa-getcert request -K service{}/{}.{} '\
-                    '-f /etc/pki/tls/certs/service{}.pem ' \
-                    '-k /etc/pki/tls/private/service{}.key -v -w >> request.log 2>&1' \
-                    .format(i, host, self.domain.lower(), i, i)
-                try:
-                    proc = self.run_ssh_command(service_cmd, ip, ctx, False)
-                    processes.append(proc)
-                except IOError:
-                    print("Length of procs ", len(processes))
-                    raise
+        if ctx.params["cert_batch"]:
+            self.request_certificates_batched(ctx)
+        else:
+            self.request_certificates(ctx)
 
-        print("Waiting for certificate issuance to be completed...")
+        # Get the getcert output
+        commands = [
+            (host, ip, 'sudo ipa-getcert list > getcert.log')
+            for host, ip in self.provider.hosts.items()
+            if host.startswith("client")
+        ]
 
-        start_time = time.time()
-        for proc in processes:
-            proc.communicate()
-        self.execution_time = time.time() - start_time - client_wait_time
+        print("Waiting for collection of getcert output to be completed...")
 
-        # Get the getcert output
-        processes = {}
-        cmds = []
+        for _ in self.remote_executor(ctx).run(commands):
+            pass
+
+        return
+
+    def request_certificates(self, ctx):
+        """Send each certificate request through its own SSH command"""
+        commands = []
         for host, ip in self.provider.hosts.items():
             if not host.startswith("client"):
                 continue
             for i in range(ctx.params["cert_requests"]):
-                cmds.append('sudo ipa-getcert list > getcert.log')
-            proc = self.run_ssh_command(" && ".join(cmds), ip, ctx, False)
-            processes[host] = proc
+                # Record the same per-request timing as the batch driver
+                service_cmd = (
+                    "start=$(date +%s.%N); "
+                    "sudo ipa-getcert request -I service{i} -K service{i}/{host}.{domain} "
+                    "-f /etc/pki/tls/certs/service{i}.pem "
+                    "-k /etc/pki/tls/private/service{i}.key -v -w >> request.log 2>&1; "
+                    "rc=$?; "
+                    "printf '{{\"request\": \"service{i}\", \"start\": %s, \"end\": %s, "
+                    "\"returncode\": %s}}\\n' $start $(date +%s.%N) $rc >> certrequests.log; "
+                    "exit $rc"
+                ).format(i=i, host=host, domain=self.domain.lower())
+                commands.append((host, ip, service_cmd))
 
-        print("Waiting for collection of getcert output to be completed...")
+        print("Waiting for certificate issuance to be completed...")
 
+        # Every request is in flight at once whatever --ssh-concurrency
+        # is, the load is what the test measures
         start_time = time.time()
-        for host, proc in processes.items():
-            proc.communicate()
-        self.execution_time = time.time() - start_time - client_wait_time
+        for result in self.remote_executor(ctx, max_concurrency=len(commands)).run(commands):
+            if result.returncode != 0:
+                print("Request on %s returned %s" % (result.key, result.returncode))
+        self.execution_time = time.time() - start_time
+
+    def request_certificates_batched(self, ctx):
+        """Upload a driver to every client which fires all of its requests
+           locally at the same instant, and run it once per client.
+
+           Each driver writes one record per request to certrequests.log,
+           which is collected along with the rest of the logs.
+        """
+        self.upload_client_files(
+            {"certissuance_driver.py": CERTISSUANCETEST_DRIVER_SCRIPT}, ctx)
+
+        clients = {host: ip for host, ip in self.provider.hosts.items()
+                   if host.startswith("client")}
+        # Leave enough time for every driver to be started before the
+        # requests are fired.
+        start = int(time.time()) + 30 + len(clients) // 20
+        commands = [
+            (host, ip,
+             "python3 certissuance_driver.py --requests {} --host {}.{} "
+             "--start {} --output certrequests.log".format(
+                 ctx.params["cert_requests"], host, self.domain.lower(), start))
+            for host, ip in clients.items()
+        ]
 
-        return
+        print("Certificate requests will be fired at %s" % time.ctime(start))
+        print("Waiting for certificate issuance to be completed...")
+
+        first_start = None
+        last_end = None
+        for result in self.remote_executor(ctx).run(commands):
+            try:
+                summary = json.loads(result.stdout.decode("utf-8").strip().splitlines()[-1])
+            except (IndexError, ValueError):
+                print("Driver on %s returned %s: %s" % (
+                    result.key, result.returncode, result.stderr.decode("utf-8").strip()))
+                continue
+            if summary["failures"]:
+                print("%s out of %s requests failed on %s" % (
+                    summary["failures"], summary["requests"], result.key))
+            first_start = min(first_start or summary["start"], summary["start"])
+            last_end = max(last_end or summary["end"], summary["end"])
+
+        if first_start is None:
+            raise RuntimeError("None of the certificate request drivers reported results.")
+        self.execution_time = last_end - first_start
+
+    def read_request_records(self, host):
+        """Load the per-request timing records written on a client"""
+        records = []
+        logpath = "sync/{}/certrequests.log".format(host)
+        try:
+            with open(logpath) as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return records
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+        return records
+
+    def report_latencies(self, records):
+        """Aggregate issuance latency, from submission until certmonger
+           reports MONITORING, over every tracked request.
+        """
+        issued = [r for r in records if r["status"] == "MONITORING" and r["returncode"] == 0]
+        if not issued:
+            yield Result(self, WARNING, msg="No certificate request timing records found.")
+            return
+
+        with open("sync/cert_latencies", "w") as f:
+            f.write("host request status returncode start end latency\n")
+            for r in sorted(records, key=lambda r: r["start"]):
+                f.write("{} {} {} {} {:.6f} {:.6f} {:.6f}\n".format(
+                    r["host"], r["request"], r["status"], r["returncode"],
+                    r["start"], r["end"], r["end"] - r["start"]))
+        print("Per-request latencies written to sync directory.")
+
+        first_start = min(r["start"] for r in records)
+        interval, series = throughput_series([r["end"] for r in issued], origin=first_start)
+        summary = summarize([r["end"] - r["start"] for r in issued], prefix="latency_")
+        yield Result(self, SUCCESS,
+                     msg="Issuance latency over {latency_count} requests: "
+                         "p50 {latency_p50}s, p90 {latency_p90}s, p99 {latency_p99}s, "
+                         "max {latency_max}s",
+                     throughput_interval=interval,
+                     throughput=series,
+                     **summary)
 
     def post_process_logs(self, ctx):
         """ Calculate number of succeeded threads """
 
         total_successes = 0
         total_requested = 0
+        latencies = []
         for host in os.listdir("sync"):
             if not host.startswith("client"):
                 continue
@@ -210,14 +326,25 @@ class CertIssuanceTest(Plugin):
 
             n_requested = 0
             n_succeeded = 0
+            statuses = {}
+            request_id = None
             for line in logstr:
+                if line.startswith("Request ID"):
+                    request_id = line.split("'")[1]
+                    continue
                 if "status:" not in line:
                     continue
 
                 n_requested += 1
+                statuses[request_id] = line.split(":", 1)[1].strip()
                 if 'MONITORING' in line:
                     n_succeeded += 1
 
+            for record in self.read_request_records(host):
+                record["host"] = host
+                record["status"] = statuses.get(record["request"], "UNTRACKED")
+                latencies.append(record)
+
             if n_requested > 0:
                 percentage = round((n_succeeded / n_requested) * 100)
             else:
@@ -252,6 +379,8 @@ class CertIssuanceTest(Plugin):
         if total_requested != total_successes:
             msg = "fails"
 
+        yield from self.report_latencies(latencies)
+
         self.results_archive_name = \
             "CertIssuanceTest-{}-{}-{}clients-{}requests-{}issued-{}".format(
                 datetime.now().strftime("%FT%H%MZ"),
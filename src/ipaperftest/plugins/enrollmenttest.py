@@ -13,11 +13,15 @@ from ipaperftest.core.constants import (
     ERROR,
     ANSIBLE_ENROLLMENTTEST_CLIENT_CONFIG_PLAYBOOK,
     ANSIBLE_COUNT_IPA_HOSTS_PLAYBOOK)
+from ipaperftest.core.topology import build_topology
 from ipaperftest.plugins.registry import registry
 
 
 @registry
 class EnrollmentTest(Plugin):
+    """Enroll every client at once and count the hosts IPA knows."""
+
+    enrolls_clients = True
 
     def __init__(self, registry):
         super().__init__(registry)
@@ -53,15 +57,15 @@ class EnrollmentTest(Plugin):
             "sudo ipa-client-install -p admin -w password -U "
             "--enable-dns-updates --no-nisdomain -N >> ~/install-cmd-output 2>&1",
         ]
-        processes = {}
+        commands = []
         non_client_hosts = 0
         for host, ip in self.provider.hosts.items():
             if host == "server" or host.startswith("replica"):
                 non_client_hosts += 1
                 continue
-            processes[host] = self.run_ssh_command(" && ".join(client_cmds), ip, ctx, False)
+            commands.append((host, ip, " && ".join(client_cmds)))
         print(
-            "Client installation commands sent, client install will start at %s"
+            "Sending client installation commands, client install will start at %s"
             % time.ctime(client_install_time)
         )
         print("Waiting for client installs to be completed...")
@@ -69,12 +73,10 @@ class EnrollmentTest(Plugin):
         start_time = time.time()
         self.clients_succeeded = 0
         clients_returncodes = ""
-        for host, proc in processes.items():
-            proc.communicate()
-            returncode = proc.returncode
-            rc_str = "Host " + host + " returned " + str(returncode)
+        for result in self.remote_executor(ctx).run(commands):
+            rc_str = "Host " + result.key + " returned " + str(result.returncode)
             clients_returncodes += rc_str + "\n"
-            if returncode == 0:
+            if result.returncode == 0:
                 self.clients_succeeded += 1
         self.execution_time = time.time() - start_time - wait_time
         print("Clients succeeded: %s" % str(self.clients_succeeded))
@@ -111,8 +113,8 @@ class EnrollmentTest(Plugin):
             datetime.now().strftime("%FT%H%MZ"),
             self.provider.server_image.replace("/", ""),
             non_client_hosts,
-            len(processes),
-            len(processes) - self.clients_succeeded
+            len(commands),
+            len(commands) - self.clients_succeeded
         )
 
         return
@@ -142,8 +144,13 @@ class EnrollmentTest(Plugin):
                             server_count[hostname] = 1
                         break
 
+        # Replication hops from the first server, to relate the
+        # distribution to the replication topology
+        hops = build_topology(ctx.params).hops()
         for server, enrollments in server_count.items():
             percentage = round((enrollments / n_clients) * 100)
             yield Result(self, SUCCESS,
                          msg="Server %s managed %s out of %s enrollments (%s)"
-                         % (server, enrollments, n_clients, percentage))
+                         % (server, enrollments, n_clients, percentage),
+                         server=server, enrollments=enrollments,
+                         hops=hops.get(server.split(".")[0]))
@@ -2,6 +2,7 @@
 # Copyright (C) 2022 FreeIPA Contributors see COPYING for license
 #
 
+import click
 import subprocess as sp
 from datetime import datetime
 
@@ -22,6 +23,20 @@ class GroupSizeTest(Plugin):
                           used sizelimit=100, the default.
     """
 
+    options = [
+        click.Option(
+            ["--threads"],
+            help="Number of members of the group.",
+            type=click.IntRange(min=1), default=10,
+        ),
+        click.Option(["--sizelimit"], help="IPA search size limit", default=100),
+        click.Option(
+            ["--number-of-subgroups"],
+            help="Number of sub groups",
+            type=click.IntRange(min=0), default=0,
+        ),
+    ]
+
     def __init__(self, registry):
         super().__init__(registry)
         self.custom_logs = ["~/*group_add_member.log", ]
@@ -2,6 +2,7 @@
 # Copyright (C) 2022 FreeIPA Contributors see COPYING for license
 #
 
+import ipaddress
 import os
 import subprocess as sp
 from ipaperftest.core.constants import IDMCI_HOST_TEMPLATE, IDMCI_METADATA_TEMPLATE
@@ -18,6 +19,12 @@ class IdMCIProvider(Provider):
         super().__init__()
         self.default_private_key = "config/id_rsa"
         self.windows_admin_password = "Secret123"
+        # IdM-CI specific host groups
+        self.types = {
+            "server": {"group": "ipalarge"},
+            "client": {"group": "ipaclient"},
+            "ad": {"group": "ad"},
+        }
 
     def check_requirements(self):
         path = os.path.join(os.path.expanduser('~'), ".idmci-ansible-vault-password-file")
@@ -52,13 +59,6 @@ class IdMCIProvider(Provider):
            client entries.
         """
 
-        # IdM-CI specific host types
-        types = {
-            "server": "ipalarge",
-            "client": "ipaclient",
-            "ad": "ad"
-        }
-
         server_img = ctx.params["server_image"]
         client_img = ctx.params["client_image"]
         self.server_image = server_img if server_img else "fedora-38"
@@ -74,7 +74,7 @@ class IdMCIProvider(Provider):
         for conf in machine_configs:
             hosts_metadata += IDMCI_HOST_TEMPLATE.format(
                 hostname=conf['hostname'],
-                group=types[conf['type']],
+                group=self.types[conf['type']]["group"],
                 os=images[conf['type']]
             )
 
@@ -100,11 +100,33 @@ class IdMCIProvider(Provider):
         """
         mrack_output = sp.run(["mrack", "list"],
                               stderr=sp.PIPE, cwd="runner_metadata").stderr.decode("utf-8")
-        # mrack list output example:
-        # active fedora-34 41df92f5-5f47-426a-9267-47758d6b9098 fedora34.idmci.test 10.0.199.6 None None  # noqa: E501
-        for line in mrack_output.splitlines():
-            info = line.split(" ")
-            if info[0] != "active":
+        self.hosts.update(parse_mrack_list(mrack_output))
+
+
+def parse_mrack_list(output):
+    """Return the host:ip pairs of the active hosts listed by mrack
+
+       mrack list output example:
+       active fedora-34 41df92f5-5f47-426a-9267-47758d6b9098 fedora34.idmci.test 10.0.199.6 None None  # noqa: E501
+
+       Columns are found by their content rather than their position:
+       the IP is the first field that is an IP address, the name is
+       the last fully qualified host name before it.
+    """
+    hosts = {}
+    for line in output.splitlines():
+        fields = line.split()
+        if not fields or fields[0] != "active":
+            continue
+        name = None
+        for field in fields[1:]:
+            try:
+                ip = str(ipaddress.ip_address(field))
+            except ValueError:
+                if "." in field and field[0].isalpha():
+                    name = field.split(".")[0]  # don't include full domain
                 continue
-            name = info[3].split(".")[0]  # don't include full domain
-            self.hosts[name] = info[4]
+            if name:
+                hosts[name] = ip
+            break
+    return hosts
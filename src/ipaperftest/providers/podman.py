@@ -0,0 +1,188 @@
+#
+# Copyright (C) 2024 FreeIPA Contributors see COPYING for license
+#
+
+import json
+import os
+import shutil
+import socket
+import subprocess as sp
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from ipaperftest.core.constants import PODMAN_CONTAINERFILE_TEMPLATE, PODMAN_PACKAGES
+from ipaperftest.providers.provider import Provider
+
+NETWORK = "ipaperftest"
+SUBNET = "10.89.0.0/16"
+LABEL = "ipaperftest"
+# Containers started at the same time by create_vms
+CREATE_CONCURRENCY = 16
+SSH_WAIT_TIMEOUT = 300
+
+
+class PodmanProvider(Provider):
+    """
+    Podman provider. Every host is a systemd container on a private
+    network of the local machine, which lets a single large machine
+    run hundreds of clients.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.default_private_key = "~/.ipaperftest/podman_id_ed25519"
+        # A /16 network, minus its network, gateway and broadcast addresses
+        self.max_hosts = 2 ** 16 - 3
+        self.runs_locally = True
+        self.types = {
+            "server": {
+                "memory": 4096,
+                "cpus": 4,
+            },
+            "client": {
+                "memory": 512,
+                "cpus": 1,
+            },
+        }
+
+    def check_requirements(self, ctx):
+        if not shutil.which("podman"):
+            raise RuntimeError("podman is not installed.")
+        # Networks of rootless podman cannot be reached from the host
+        if os.geteuid() != 0:
+            raise RuntimeError("The podman provider needs to run as root.")
+
+    def cleanup(self, ctx):
+        """We clean up *before* an execution so that the containers remain.
+
+           This is so we can evaluate what, if anything, went wrong.
+        """
+        ids = sp.run(["podman", "ps", "-aq", "--filter", "label=" + LABEL],
+                     stdout=sp.PIPE).stdout.decode("utf-8").split()
+        if ids:
+            sp.run(["podman", "rm", "-f", "-t", "0"] + ids, stdout=sp.PIPE)
+
+    def setup(self, ctx):
+        """Create the SSH key of the containers and their network"""
+        key = os.path.expanduser(self.default_private_key)
+        if not os.path.exists(key):
+            os.makedirs(os.path.dirname(key), exist_ok=True)
+            sp.run(["ssh-keygen", "-q", "-t", "ed25519", "-N", "", "-f", key], check=True)
+
+        if sp.run(["podman", "network", "exists", NETWORK]).returncode != 0:
+            sp.run(["podman", "network", "create", "--subnet", SUBNET, NETWORK],
+                   stdout=sp.PIPE, check=True)
+
+    def generate_metadata(self, ctx, machine_configs, domain):
+        """Create a Containerfile per host type and the container list
+
+           This directly controls creating the entries for the server
+           and replicas. A per-test generator is used to generate the
+           client entries.
+        """
+        server_img = ctx.params["server_image"]
+        client_img = ctx.params["client_image"]
+        self.server_image = server_img if server_img else "registry.fedoraproject.org/fedora:38"
+        self.client_image = client_img if client_img else "registry.fedoraproject.org/fedora:38"
+        images = {
+            "server": self.server_image,
+            "client": self.client_image,
+        }
+
+        os.makedirs("runner_metadata/podman", exist_ok=True)
+        shutil.copyfile(os.path.expanduser(self.default_private_key) + ".pub",
+                        "runner_metadata/podman/authorized_keys")
+
+        containers = []
+        for conf in machine_configs:
+            if conf["type"] not in images:
+                raise RuntimeError("The podman provider cannot create %s hosts."
+                                   % conf["type"])
+            resources = self.host_resources(ctx, conf["type"])
+            containers.append({
+                "name": "ipaperftest-" + conf["hostname"].split(".")[0],
+                "hostname": conf["hostname"],
+                "type": conf["type"],
+                "image": "localhost/ipaperftest-%s:latest" % conf["type"],
+                "cpus": resources["cpus"],
+                "memory": resources["memory"],
+            })
+
+        for host_type in set(c["type"] for c in containers):
+            with open("runner_metadata/podman/Containerfile.%s" % host_type, "w") as f:
+                f.write(PODMAN_CONTAINERFILE_TEMPLATE.format(
+                    image=images[host_type], packages=PODMAN_PACKAGES[host_type]))
+        with open("runner_metadata/podman/containers.json", "w") as f:
+            json.dump(containers, f, indent=2)
+
+    def run_container(self, conf):
+        cmd = [
+            "podman", "run", "-d",
+            "--name", conf["name"],
+            "--hostname", conf["hostname"],
+            "--label", LABEL,
+            "--network", NETWORK,
+            "--systemd", "always",
+            "--cpus", str(conf["cpus"]),
+            "--memory", "%dm" % conf["memory"],
+        ]
+        if conf["type"] == "server":
+            # The IPA server services need to tune the kernel and mount
+            cmd.append("--privileged")
+        cmd.append(conf["image"])
+        return sp.run(cmd, stdout=sp.PIPE, stderr=sp.PIPE)
+
+    def create_vms(self, ctx):
+        """Build the images and start every container"""
+        with open("runner_metadata/podman/containers.json") as f:
+            containers = json.load(f)
+
+        print("Building images...")
+        for host_type in sorted(set(c["type"] for c in containers)):
+            sp.run(["podman", "build", "-t", "localhost/ipaperftest-%s:latest" % host_type,
+                    "-f", "Containerfile.%s" % host_type, "."],
+                   cwd="runner_metadata/podman", check=True)
+
+        print("Creating containers...")
+        with ThreadPoolExecutor(max_workers=CREATE_CONCURRENCY) as pool:
+            procs = list(pool.map(self.run_container, containers))
+        for conf, proc in zip(containers, procs):
+            if proc.returncode != 0:
+                print("Unable to create %s: %s"
+                      % (conf["name"], proc.stderr.decode("utf-8").strip()))
+
+    def wait_for_ssh(self):
+        """Wait until sshd accepts connections in every container"""
+        waiting = dict(self.hosts)
+        deadline = time.time() + SSH_WAIT_TIMEOUT
+        while waiting and time.time() < deadline:
+            for name, ip in list(waiting.items()):
+                try:
+                    socket.create_connection((ip, 22), timeout=1).close()
+                    del waiting[name]
+                except OSError:
+                    pass
+            if waiting:
+                time.sleep(1)
+        if waiting:
+            print("SSH is not available on: %s" % ", ".join(sorted(waiting)))
+
+    def collect_hosts(self, ctx):
+        """Collect IP information on the running containers in a dict
+
+           hostname:ip
+        """
+        ids = sp.run(["podman", "ps", "-q", "--filter", "label=" + LABEL],
+                     stdout=sp.PIPE).stdout.decode("utf-8").split()
+        if not ids:
+            return
+        containers = json.loads(sp.run(["podman", "inspect"] + ids,
+                                       stdout=sp.PIPE).stdout.decode("utf-8"))
+        for container in containers:
+            if not container["State"]["Running"]:
+                continue
+            name = container["Config"]["Hostname"].split(".")[0]
+            network = container["NetworkSettings"]["Networks"].get(NETWORK)
+            if network and network.get("IPAddress"):
+                self.hosts[name] = network["IPAddress"]
+        self.wait_for_ssh()
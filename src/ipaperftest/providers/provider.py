@@ -2,6 +2,16 @@
 # Copyright (C) 2022 FreeIPA Contributors see COPYING for license
 #
 
+import json
+import os
+
+import ansible_runner
+
+from ipaperftest.core.ssh import ssh_pool
+
+HOSTS_FILE = "runner_metadata/hosts.json"
+
+
 class Provider:
     """
     Base class for different providers used during test execution
@@ -14,6 +24,89 @@ class Provider:
         self.windows_admin_password = ""
         self.default_private_key = ""  # path relative to runner_metadata
         self.hosts = {}  # host:ip dictionary
+        self.inventory = {}  # host:{hostname, ip, role, cpus, memory} dictionary
+        self.types = {}  # host type:settings dictionary
+        self.max_hosts = None  # hosts the provider can address, None if unlimited
+        self.runs_locally = False  # VMs run on the machine running ipaperftest
+        self.simulated = False  # hosts are simulated, nothing is deployed
+
+    def host_resources(self, ctx, host_type):
+        """Return the cpus and memory (in MiB) of a host type
+
+           Keys the provider does not know about are left out. Providers
+           creating the machines locally size the clients from
+           --client-cpus and --client-memory when they are given.
+        """
+        settings = self.types.get(host_type, {})
+        resources = {key: settings[key] for key in ("cpus", "memory") if key in settings}
+        if host_type == "client" and self.runs_locally:
+            if ctx.params.get("client_cpus"):
+                resources["cpus"] = ctx.params["client_cpus"]
+            if ctx.params.get("client_memory"):
+                resources["memory"] = ctx.params["client_memory"]
+        return resources
+
+    def register_hosts(self, ctx, machine_configs):
+        """Build the host registry from the hosts found by collect_hosts
+
+           Every host of machine_configs found by collect_hosts is
+           recorded with its role and resources, the others are
+           ignored. Returns the names of the hosts that were not found.
+        """
+        found = self.hosts
+        self.hosts = {}
+        self.inventory = {}
+        missing = []
+        for conf in machine_configs:
+            name = conf["hostname"].split(".")[0]
+            if name not in found:
+                missing.append(name)
+                continue
+            self.hosts[name] = found[name]
+            self.inventory[name] = dict(
+                hostname=conf["hostname"],
+                ip=found[name],
+                role="replica" if name.startswith("replica") else conf["type"],
+                **self.host_resources(ctx, conf["type"]),
+            )
+        return missing
+
+    def select_hosts(self, names):
+        """Restrict the registry to the hosts in names
+
+           Returns the names that are not in the registry.
+        """
+        self.hosts = {name: ip for name, ip in self.hosts.items() if name in names}
+        self.inventory = {name: host for name, host in self.inventory.items() if name in names}
+        return [name for name in names if name not in self.hosts]
+
+    def save_hosts(self):
+        """Cache the host registry in runner_metadata"""
+        with open(HOSTS_FILE, "w") as f:
+            json.dump(self.inventory, f, indent=2)
+
+    def load_hosts(self):
+        """Restore the host registry cached by save_hosts
+
+           Returns False when there is none.
+        """
+        if not os.path.exists(HOSTS_FILE):
+            return False
+        try:
+            with open(HOSTS_FILE) as f:
+                self.inventory = json.load(f)
+        except ValueError as e:
+            raise RuntimeError("The host registry %s is corrupted: %s" % (HOSTS_FILE, e))
+        self.hosts = {name: host["ip"] for name, host in self.inventory.items()}
+        return True
+
+    def connection_pool(self):
+        """Return the pool the remote commands to the hosts go through"""
+        return ssh_pool
+
+    def run_ansible(self, **kwargs):
+        """Run ansible-runner against the hosts, returning its Runner"""
+        return ansible_runner.run(**kwargs)
 
     def check_requirements(self, ctx):
         pass
@@ -31,4 +124,5 @@ class Provider:
         pass
 
     def collect_hosts(self, ctx):
+        """Fill hosts with the name:ip of the running hosts, in one query"""
         pass
@@ -0,0 +1,258 @@
+#
+# Copyright (C) 2024 FreeIPA Contributors see COPYING for license
+#
+"""
+Stand-in for a remote host of the simulation provider.
+
+Run as ``python3 simhost.py --root DIR COMMAND`` in place of
+``ssh HOST COMMAND``. DIR is the file system of the
+simulated host, with root's home in DIR/root. The commands sent by the
+tests are not run: they are recognized and answered with the output
+and logs the real command would leave behind, at realistic sizes.
+The log collector is the exception, it is run for real on DIR.
+
+This module is started once per remote command, so it must only
+import the standard library.
+"""
+
+import argparse
+import json
+import os
+import random
+import shlex
+import sys
+import time
+
+PAM_STEPS = ("authenticate", "acct_mgmt", "open_session", "close_session")
+DOMAIN = "ipa.test"
+
+
+def option(argv, name, default=None, cast=str):
+    """Return the value following name in argv"""
+    if name in argv and argv.index(name) + 1 < len(argv):
+        return cast(argv[argv.index(name) + 1])
+    return default
+
+
+def filler(rng, lines):
+    """Return debug lines like the ones filling the IPA install logs"""
+    return "".join(
+        "2024-01-01T00:00:%02dZ DEBUG Starting external process args=%r "
+        "Process finished, return code=0 stdout=%s\n"
+        % (i % 60, ["/usr/bin/certutil", "-d", "sql:/etc/ipa/nssdb", "-L"],
+           "%032x" % rng.getrandbits(128))
+        for i in range(lines)
+    )
+
+
+class Host:
+    def __init__(self, root):
+        self.root = root
+        self.home = os.path.join(root, "root")
+        self.name = os.path.basename(os.path.normpath(root))
+        self.rng = random.Random(self.name)
+
+    def path(self, path):
+        """Map a path of the simulated host to the local file system"""
+        if path.startswith("~"):
+            path = self.home + path[1:]
+        if not os.path.isabs(path):
+            return os.path.join(self.home, path)
+        if path.startswith(self.root):
+            return path
+        return os.path.join(self.root, path.lstrip("/"))
+
+    def write(self, path, data, mode="w"):
+        path = self.path(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, mode) as f:
+            f.write(data)
+
+    def latency(self, mean=0.05):
+        return self.rng.expovariate(1 / mean)
+
+    def client_install(self):
+        # About 100 KiB, like a real ipaclient-install.log
+        self.write("/var/log/ipaclient-install.log",
+                   filler(self.rng, 400)
+                   + "2024-01-01T00:01:00Z DEBUG [IPA Discovery]\n"
+                   + "2024-01-01T00:01:00Z INFO discovered server server.%s\n" % DOMAIN
+                   + filler(self.rng, 400)
+                   + "2024-01-01T00:02:00Z INFO The ipa-client-install command was "
+                   "successful\n")
+        self.write("/etc/ipa/default.conf", "[global]\nserver = server.%s\n" % DOMAIN)
+        self.write("install-cmd-output", "Client configuration complete.\n", "a")
+        return 0
+
+    def client_uninstall(self):
+        path = self.path("/etc/ipa/default.conf")
+        if os.path.exists(path):
+            os.remove(path)
+        return 0
+
+    def pamtest(self, argv):
+        threads = option(argv, "--threads", 10, int)
+        iterations = option(argv, "--iterations", None, int)
+        if iterations is None:
+            iterations = 3 if option(argv, "--duration", 0, float) else 1
+        lines = []
+        now = time.time()
+        for thread in range(threads):
+            for iteration in range(max(iterations, 1)):
+                steps = " ".join("%s=%.6f" % (step, self.latency(0.02)) for step in PAM_STEPS)
+                lines.append("Timing user=user%s result=0 iteration=%s start=%.6f %s\n"
+                             % (thread, iteration, now + iteration, steps))
+            lines.append("Thread returned 0\n")
+        self.write(option(argv, "-o", "pamtest.log"), "".join(lines))
+        return 0
+
+    def pamtest_rate(self, argv):
+        rate = option(argv, "--rate", 1, float)
+        duration = option(argv, "--duration", 60, float)
+        start = option(argv, "--start", time.time(), float)
+        users = option(argv, "--users", 1, int)
+        step = option(argv, "--step", 0, int)
+        records = []
+        for idx in range(int(rate * duration)):
+            scheduled = start + idx / rate
+            latency = self.latency(0.05)
+            records.append(json.dumps({
+                "step": step, "user": idx % users, "scheduled": scheduled,
+                "start": scheduled + 0.001, "end": scheduled + 0.001 + latency,
+                "returncode": 0,
+            }) + "\n")
+        self.write(option(argv, "--output", "pamtest-rate.log"), "".join(records), "a")
+        print(json.dumps({"logins": len(records), "failures": 0}))
+        return 0
+
+    def cert_request(self, argv):
+        nickname = option(argv, "-I", "service0")
+        now = time.time()
+        self.write("requests/" + nickname, nickname)
+        self.write("request.log", "New signing request \"%s\" added.\n" % nickname, "a")
+        self.write("certrequests.log", json.dumps({
+            "request": nickname, "start": now, "end": now + self.latency(0.5),
+            "returncode": 0}) + "\n", "a")
+        return 0
+
+    def cert_batch(self, argv):
+        requests = option(argv, "--requests", 1, int)
+        start = option(argv, "--start", time.time(), float)
+        records = []
+        for i in range(requests):
+            nickname = "service%s" % i
+            self.write("requests/" + nickname, nickname)
+            records.append({"request": nickname, "start": start,
+                            "end": start + self.latency(0.5), "returncode": 0,
+                            "output": "New signing request \"%s\" added." % nickname})
+        self.write(option(argv, "--output", "certrequests.log"),
+                   "".join(json.dumps(r) + "\n" for r in records))
+        print(json.dumps({
+            "start": start,
+            "end": max((r["end"] for r in records), default=start),
+            "requests": len(records),
+            "failures": 0,
+        }))
+        return 0
+
+    def cert_list(self):
+        requests = self.path("requests")
+        names = sorted(os.listdir(requests)) if os.path.isdir(requests) else []
+        # About 1 KiB per tracked certificate, like ipa-getcert list
+        self.write("getcert.log", "Number of certificates and requests being tracked: %s.\n"
+                   % len(names) + "".join(
+                       "Request ID '%s':\n\tstatus: MONITORING\n\tstuck: no\n"
+                       "\tkey pair storage: type=FILE,location='/etc/pki/tls/private/%s.key'\n"
+                       "\tcertificate: type=FILE,location='/etc/pki/tls/certs/%s.pem'\n"
+                       "\tCA: IPA\n\tissuer: CN=Certificate Authority,O=%s\n"
+                       "\tsubject: CN=%s.%s,O=%s\n\texpires: 2026-01-01 00:00:00 UTC\n"
+                       "\tkey usage: digitalSignature,nonRepudiation,keyEncipherment\n"
+                       "\teku: id-kp-serverAuth,id-kp-clientAuth\n"
+                       "\tpre-save command: \n\tpost-save command: \n"
+                       "\ttrack: yes\n\tauto-renew: yes\n"
+                       % (name, name, name, DOMAIN.upper(), self.name, DOMAIN,
+                          DOMAIN.upper())
+                       for name in names))
+        return 0
+
+    def api_runner(self, argv):
+        client = option(argv, "--client")
+        start = option(argv, "--start", time.time(), float)
+        with open(self.path("apitest_commands.json")) as f:
+            commands = json.load(f).get(client, [])
+        for command in commands:
+            cmd_id, line = command[0], command[1]
+            end = start + self.latency(0.2)
+            self.write("command%slog" % cmd_id, "%s\n----\nAdded user\n----\n0\n" % line)
+            print(json.dumps({"id": cmd_id, "start": start, "end": end, "returncode": 0}))
+        return 0
+
+    def group_add_member(self, command):
+        self.write("group_add_member.log", "%s\n-----\nNumber of members added 1\n"
+                   "-----\nreal %.2f\nuser 0.50\nsys 0.10\n0\n"
+                   % (command, 1 + self.latency(1)))
+        return 0
+
+    def sequential(self):
+        with open(self.path("apitest_sequential_commands.sh")) as f:
+            for line in f:
+                if line.startswith("echo "):
+                    cmd = line[len("echo "):].split(" > ")[0]
+                    cmd_id = line.split("~/command")[1].split("log")[0]
+                    self.write("command%slog" % cmd_id, "%s\n0\n" % cmd)
+        return 0
+
+    def log_collector(self, argv):
+        # Collect the logs for real, from the simulated file system
+        args = []
+        for arg in argv[2:]:
+            if arg.startswith("/") or arg.startswith("~"):
+                arg = self.path(arg)
+            args.append(arg)
+        os.environ["HOME"] = self.home
+        os.chdir(self.home)
+        os.execvp(sys.executable, [sys.executable, "-"] + args)
+
+    def run(self, command):
+        try:
+            argv = shlex.split(command)
+        except ValueError:
+            argv = command.split()
+        if argv[:2] == ["python3", "-"]:
+            return self.log_collector(argv)
+        if "ipa-client-install" in command:
+            if "--uninstall" in argv:
+                return self.client_uninstall()
+            return self.client_install()
+        if "pamtest_rate_driver.py" in command:
+            return self.pamtest_rate(argv)
+        if "pamtest " in command:
+            return self.pamtest(argv)
+        if "certissuance_driver.py" in command:
+            return self.cert_batch(argv)
+        if "ipa-getcert request" in command:
+            return self.cert_request(argv)
+        if "ipa-getcert list" in command:
+            return self.cert_list()
+        if "apitest_runner.py" in command or "apitest_jsonrpc.py" in command:
+            return self.api_runner(argv)
+        if "apitest_sequential_commands.sh" in command:
+            return self.sequential()
+        if "group-add-member" in command:
+            return self.group_add_member(command.split(" > ")[0][len("echo "):])
+        return 0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--root", required=True)
+    parser.add_argument("command")
+    args = parser.parse_args()
+    host = Host(args.root)
+    os.makedirs(host.home, exist_ok=True)
+    os.chdir(host.home)
+    return host.run(args.command)
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
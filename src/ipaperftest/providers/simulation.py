@@ -0,0 +1,226 @@
+#
+# Copyright (C) 2024 FreeIPA Contributors see COPYING for license
+#
+
+import contextlib
+import io
+import os
+import shutil
+import sys
+
+import yaml
+
+from ipaperftest.providers import simhost
+from ipaperftest.providers.provider import Provider
+
+# Root of the simulated hosts, relative to the working directory
+SIMULATION_DIR = "simulation"
+SIMHOST = os.path.abspath(simhost.__file__)
+
+# Inventory groups of the plays, matched against the host names
+GROUPS = {
+    "all": "",
+    "ipaserver": "server",
+    "ipareplicas": "replica",
+    "ipaclients": "client",
+    "windows": "windows",
+}
+
+
+class SimulatedPool:
+    """
+    Stand-in for the SSH connection pool of the simulation provider.
+
+    Commands are run by a simhost process working on the directory
+    of the simulated host, in place of ssh.
+    """
+    def __init__(self, provider):
+        self.provider = provider
+
+    def master_args(self, target, private_keys):
+        return ["true"]
+
+    def is_connected(self, target):
+        return True
+
+    def register_master(self, target, returncode):
+        return True
+
+    def connect(self, target, private_keys, cwd="runner_metadata"):
+        return True
+
+    def open_session(self, target):
+        return True
+
+    def close_session(self, target):
+        pass
+
+    def command_args(self, target, command, private_keys, cwd="runner_metadata", connect=True,
+                     multiplex=True):
+        return [sys.executable, SIMHOST, "--root", self.provider.host_root(target), command]
+
+    def close(self, target):
+        pass
+
+    def close_all(self):
+        pass
+
+
+class SimulatedRun:
+    """The subset of an ansible-runner Runner the tests look at"""
+    def __init__(self, facts):
+        self.rc = 0
+        self.status = "successful"
+        self.events = []
+        self.facts = facts
+
+    def get_fact_cache(self, host):
+        return self.facts.get(host, {})
+
+
+class SimulationProvider(Provider):
+    """
+    Simulation provider. Nothing is deployed: every host is a
+    directory under ./simulation and the commands sent to it are
+    answered by ipaperftest.providers.simhost with synthetic output
+    and logs. This measures the overhead of ipaperftest itself, at
+    host counts no lab could provide.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.default_private_key = ""
+        self.simulated = True
+        self.server_image = "simulation"
+        self.client_image = "simulation"
+        self.types = {
+            "server": {
+                "memory": 8192,
+                "cpus": 4,
+            },
+            "client": {
+                "memory": 2048,
+                "cpus": 1,
+            },
+        }
+        self.machine_configs = []
+        self.roots = {}  # ip:host directory dictionary
+
+    def connection_pool(self):
+        return SimulatedPool(self)
+
+    def host_root(self, target):
+        """Return the directory of the host with the IP target"""
+        if target not in self.roots:
+            self.roots = {ip: os.path.abspath(os.path.join(SIMULATION_DIR, name))
+                          for name, ip in self.hosts.items()}
+        if target not in self.roots:
+            raise RuntimeError("Unknown simulated host %s." % target)
+        return self.roots[target]
+
+    def cleanup(self, ctx):
+        shutil.rmtree(SIMULATION_DIR, ignore_errors=True)
+
+    def generate_metadata(self, ctx, machine_configs, domain):
+        self.machine_configs = machine_configs
+
+    def create_vms(self, ctx):
+        """Create the file system of every host
+
+           Servers and replicas are created as installed IPA servers,
+           with install logs of a realistic size.
+        """
+        for conf in self.machine_configs:
+            name = conf["hostname"].split(".")[0]
+            host = simhost.Host(os.path.join(SIMULATION_DIR, name))
+            os.makedirs(host.home, exist_ok=True)
+            if conf["type"] == "server":
+                host.write("/var/log/ipaserver-install.log", simhost.filler(host.rng, 4000))
+                if name.startswith("replica"):
+                    host.write("/var/log/ipareplica-install.log",
+                               simhost.filler(host.rng, 2000))
+                host.write("/var/log/krb5kdc.log", simhost.filler(host.rng, 1000))
+                host.write("/var/log/httpd/error_log", simhost.filler(host.rng, 1000))
+                host.write("/var/log/dirsrv/slapd-IPA-TEST/access",
+                           simhost.filler(host.rng, 2000))
+                host.client_install()
+
+    def collect_hosts(self, ctx):
+        for idx, conf in enumerate(self.machine_configs):
+            name = conf["hostname"].split(".")[0]
+            if os.path.isdir(os.path.join(SIMULATION_DIR, name)):
+                self.hosts[name] = "10.%d.%d.%d" % (
+                    (idx + 1) // 65536, (idx + 1) // 256 % 256, (idx + 1) % 256)
+
+    def group_hosts(self, pattern):
+        """Return the names of the hosts matched by an inventory pattern"""
+        names = set()
+        for group in str(pattern).replace(",", " ").split():
+            prefix = GROUPS.get(group.rstrip("*").split("_")[0])
+            if prefix is not None:
+                names.update(n for n in self.hosts if n.startswith(prefix))
+        return sorted(names)
+
+    def enrolled(self):
+        return sum(1 for name in self.hosts if os.path.exists(
+            os.path.join(SIMULATION_DIR, name, "etc/ipa/default.conf")))
+
+    def run_task(self, task, names, private_data_dir, facts):
+        hosts = [simhost.Host(os.path.join(SIMULATION_DIR, name)) for name in names]
+        if "synchronize" in task:
+            for item in task.get("with_items", []):
+                src = os.path.join(private_data_dir, item)
+                if not os.path.isfile(src):
+                    continue
+                for host in hosts:
+                    os.makedirs(host.home, exist_ok=True)
+                    shutil.copy(src, host.home)
+        elif "copy" in task and "content" in task["copy"]:
+            for host in hosts:
+                host.write(task["copy"]["dest"], task["copy"]["content"])
+        elif "shell" in task or "command" in task:
+            cmd = task.get("shell", task.get("command"))
+            if isinstance(cmd, dict):
+                cmd = cmd.get("cmd", "")
+            for host in hosts:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    host.run(cmd)
+        elif "set_fact" in task:
+            enrolled = str(self.enrolled())
+            for name in names:
+                facts.setdefault(self.hosts[name], {}).update({
+                    key: enrolled if key == "host_find_output" else value
+                    for key, value in task["set_fact"].items()
+                })
+
+    def run_ansible(self, **kwargs):
+        """Apply what the playbook would change to the simulated hosts
+
+           Only the tasks the tests depend on are simulated: file
+           uploads, commands, client enrollment and the host count
+           fact. Modules like ping always succeed.
+        """
+        facts = {}
+        private_data_dir = kwargs.get("private_data_dir", "runner_metadata")
+        playbook = kwargs.get("playbook")
+        if not playbook:
+            return SimulatedRun(facts)
+
+        path = os.path.join(private_data_dir, playbook)
+        if not os.path.exists(path):
+            # The ansible-freeipa playbooks are not cloned
+            if "install-client" in playbook:
+                for name in self.group_hosts("ipaclients"):
+                    simhost.Host(os.path.join(SIMULATION_DIR, name)).client_install()
+            return SimulatedRun(facts)
+
+        with open(path) as f:
+            try:
+                plays = yaml.safe_load(f) or []
+            except yaml.YAMLError:
+                plays = []
+        for play in plays:
+            names = self.group_hosts(play.get("hosts", ""))
+            for task in play.get("tasks") or []:
+                self.run_task(task, names, private_data_dir, facts)
+        return SimulatedRun(facts)
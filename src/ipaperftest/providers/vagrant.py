@@ -4,7 +4,13 @@
 
 import os
 import subprocess as sp
-from ipaperftest.core.constants import VAGRANT_HOST_TEMPLATE, VAGRANTFILE_TEMPLATE
+import time
+from ipaperftest.core.constants import (
+    SUCCESS,
+    WARNING,
+    VAGRANT_HOST_TEMPLATE,
+    VAGRANTFILE_TEMPLATE,
+)
 from ipaperftest.providers.provider import Provider
 
 
@@ -18,6 +24,24 @@ class VagrantProvider(Provider):
         self.files_to_log.append("Vagrantfile")
         self.default_private_key = "~/.vagrant.d/insecure_private_key"
         self.windows_admin_password = "vagrant"
+        # generate_ip hands out 192.168.3.2 to 192.168.255.254
+        self.max_hosts = 253 * 253
+        self.runs_locally = True
+        self.types = {
+            "server": {
+                "memory": 8192,
+                "cpus": 4,
+            },
+            "client": {
+                "memory": 2048,
+                "cpus": 1,
+            },
+            "ad": {
+                "memory": 8192,
+                "cpus": 4
+            }
+        }
+        self.machines = []  # (machine name, box) of every VM in the Vagrantfile
 
     def generate_ip(self):
         ip_x = 3
@@ -38,10 +62,13 @@ class VagrantProvider(Provider):
            This is so we can evaluate what, if anything, went wrong.
         """
 
-        if os.path.exists("Vagrantfile"):
-            sp.run(["vagrant", "destroy", "-f"], stdout=sp.PIPE)
+        if not os.path.exists("Vagrantfile"):
+            return
+        if sp.run(["vagrant", "destroy", "-f"], stdout=sp.PIPE).returncode != 0:
+            # libvirtd may be stuck after a failed run, restart it and retry
             sp.run(["systemctl", "restart", "libvirtd"], stdout=sp.PIPE)
             sp.run(["sleep", "5"], stdout=sp.PIPE)
+            sp.run(["vagrant", "destroy", "-f"], stdout=sp.PIPE)
 
     def generate_metadata(self, ctx, machine_configs, domain):
         """Create the Vagrantfile
@@ -50,21 +77,6 @@ class VagrantProvider(Provider):
            client entries.
         """
 
-        types = {
-            "server": {
-                "memory": 8192,
-                "cpus": 4,
-            },
-            "client": {
-                "memory": 2048,
-                "cpus": 1,
-            },
-            "ad": {
-                "memory": 8192,
-                "cpus": 4
-            }
-        }
-
         server_img = ctx.params["server_image"]
         client_img = ctx.params["client_image"]
         self.server_image = server_img if server_img else "fedora/38-cloud-base"
@@ -89,12 +101,15 @@ class VagrantProvider(Provider):
         ip_generator = self.generate_ip()
 
         hosts_metadata = ""
+        self.machines = []
         for conf in machine_configs:
+            resources = self.host_resources(ctx, conf["type"])
+            self.machines.append((conf['hostname'].split(".")[0], images[conf['type']]))
             hosts_metadata += VAGRANT_HOST_TEMPLATE.format(
                 machine_name=conf['hostname'].split(".")[0],
                 hostname=conf['hostname'],
-                memory=types[conf["type"]]["memory"],
-                cpus=types[conf["type"]]["cpus"],
+                memory=resources["memory"],
+                cpus=resources["cpus"],
                 box=images[conf['type']],
                 ip=next(ip_generator),
                 extra_options=ad_extra_options.format(
@@ -117,20 +132,85 @@ class VagrantProvider(Provider):
         with open("Vagrantfile", "w") as f:
             f.write(file_contents)
 
+    def add_boxes(self):
+        """Download the boxes of the Vagrantfile which are missing"""
+        listed = sp.run(["vagrant", "box", "list"], stdout=sp.PIPE).stdout.decode("utf-8")
+        present = set(line.split(" ")[0] for line in listed.splitlines() if "libvirt" in line)
+        for box in sorted(set(box for _, box in self.machines) - present):
+            print("Adding box %s..." % box)
+            sp.run(["vagrant", "box", "add", "--provider", "libvirt", box])
+
+    def waves(self, wave_size):
+        """Split the machines into the waves brought up by create_vms
+
+           The first wave has a single VM per box, which imports the
+           box into the libvirt storage pool. The VMs of the following
+           waves are then created as linked clones of that image
+           instead of racing to upload it. wave_size 0 brings up all
+           of them in the second wave.
+        """
+        first = []
+        rest = []
+        boxes = set()
+        for name, box in self.machines:
+            if box in boxes:
+                rest.append(name)
+            else:
+                boxes.add(box)
+                first.append(name)
+        size = wave_size or len(rest) or 1
+        return [first] + [rest[i:i + size] for i in range(0, len(rest), size)]
+
     def create_vms(self, ctx):
-        """Bring up all the configured virtual machines"""
+        """Bring up all the configured virtual machines, in waves
+
+           The boot time of every wave is reported.
+        """
+        # plugin imports the providers
+        from ipaperftest.core.plugin import Result
+
         print("Creating VMs...")
-        sp.run(["vagrant", "up", "--parallel"])
+        if not self.machines:
+            sp.run(["vagrant", "up", "--parallel"])
+            return
+        self.add_boxes()
+        waves = self.waves(ctx.params.get("vagrant_wave_size", 0))
+        for idx, names in enumerate(waves):
+            print("Creating wave %s/%s (%s VMs)..." % (idx + 1, len(waves), len(names)))
+            start = time.time()
+            ret = sp.run(["vagrant", "up", "--parallel"] + names)
+            yield Result(None, SUCCESS if ret.returncode == 0 else WARNING,
+                         source=self.__class__.__module__, test=self.__class__.__name__,
+                         key="vagrant_wave.%s" % idx,
+                         msg="Wave {wave}: {vms} VMs up in {boot_time}s",
+                         wave=idx, vms=len(names), boot_time=round(time.time() - start, 3),
+                         returncode=ret.returncode)
 
     def collect_hosts(self, ctx):
         """Collect IP information on the configured hosts in a dict
 
            hostname:ip
         """
-        grep_output = sp.run(
-            "vagrant ssh-config | grep -i HostName -B 1",
-            shell=True, stdout=sp.PIPE).stdout.decode("utf-8")
-        host_lines = grep_output.split("--")
-        for line in host_lines:
-            pair = line.replace("\n", "").replace("Host ", "").split("  HostName ")
-            self.hosts[pair[0]] = pair[1]
+        output = sp.run(["vagrant", "ssh-config"], stdout=sp.PIPE).stdout.decode("utf-8")
+        self.hosts.update(parse_ssh_config(output))
+
+
+def parse_ssh_config(output):
+    """Return the host:HostName pairs of ssh_config formatted output
+
+       Keywords are case insensitive and may be separated from their
+       value by spaces or an equal sign, in any order within a Host
+       block.
+    """
+    hosts = {}
+    host = None
+    for line in output.splitlines():
+        fields = line.strip().replace("=", " ", 1).split(None, 1)
+        if len(fields) != 2:
+            continue
+        keyword, value = fields[0].lower(), fields[1].strip()
+        if keyword == "host":
+            host = value
+        elif keyword == "hostname" and host is not None:
+            hosts[host] = value
+    return hosts
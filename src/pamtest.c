@@ -16,12 +16,20 @@
 #include <errno.h>
 #include <string.h>
 #include <sys/wait.h>
+#include <time.h>
 
 
-/* The only global, the name of the PAM service */
+/* The name of the PAM service */
 char * pam_service = NULL;
 
-int call_pam(void *ptr);
+/* How many logins each worker performs, 0 for no limit */
+int iterations = -1;
+
+/* When each worker stops looping, if a duration was given */
+int duration = 0;
+struct timespec deadline;
+
+int call_pam(void *ptr, int iteration);
 
 FILE *fp = NULL;
 
@@ -51,17 +59,38 @@ int conv_static_password(int num_msg, const struct pam_message **msgm,
 
 static struct pam_conv conv = { conv_static_password, NULL };
 
-int call_pam(void *username)
+/*
+ * Call a PAM function and store how long it took, in seconds, in elapsed
+ */
+static int timed_pam_call(int (*func)(pam_handle_t *, int), pam_handle_t *pamh,
+                          double *elapsed)
+{
+    struct timespec start, end;
+    int ret;
+
+    clock_gettime(CLOCK_MONOTONIC, &start);
+    ret = func(pamh, 0);
+    clock_gettime(CLOCK_MONOTONIC, &end);
+    *elapsed = (end.tv_sec - start.tv_sec) + (end.tv_nsec - start.tv_nsec) / 1e9;
+
+    return ret;
+}
+
+int call_pam(void *username, int iteration)
 {
     pam_handle_t *pamh;
     int result;
+    struct timespec started;
+    /* Duration of each PAM step, -1 when the step was not reached */
+    double t_auth = -1, t_acct = -1, t_open = -1, t_close = -1;
 
+    clock_gettime(CLOCK_REALTIME, &started);
     fprintf(fp, "authenticating %s:%s\n", pam_service, (char *)username);
     if ((result = pam_start(pam_service, username, &conv, &pamh)) != PAM_SUCCESS) {
         fprintf(fp, "start for %s failed: %s (%d)\n", (char *)username, pam_strerror(pamh, result), result);
-    } else if ((result = pam_authenticate(pamh, 0)) != PAM_SUCCESS) {
+    } else if ((result = timed_pam_call(pam_authenticate, pamh, &t_auth)) != PAM_SUCCESS) {
         fprintf(fp, "authenticate for %s failed: %s (%d)\n", (char *)username, pam_strerror(pamh, result), result);
-    } else if ((result = pam_acct_mgmt(pamh, 0)) != PAM_SUCCESS) {
+    } else if ((result = timed_pam_call(pam_acct_mgmt, pamh, &t_acct)) != PAM_SUCCESS) {
         fprintf(fp, "acct_mgmt for %s failed: %s (%d)\n", (char *)username, pam_strerror(pamh, result), result);
     } else { 
         fprintf(fp, "authenticated %s\n", (char *)username);
@@ -77,23 +106,66 @@ int call_pam(void *username)
             ccache_txt = pam_getenv(pamh, "KRB5CCNAME");
             setenv("KRB5CCNAME", ccache_txt, 1);
             fprintf(fp, "%s\n", ccache_txt);
-            krb5_init_context(&krbctx);
-            krb5_cc_default(krbctx, &ccache);
-            krb5_cc_get_principal(krbctx, ccache, &uprinc);
-            krb5_unparse_name(krbctx, uprinc, &outname);
-            fprintf(fp, "principal %s\n", outname);
+            if (krb5_init_context(&krbctx) == 0) {
+                if (krb5_cc_default(krbctx, &ccache) == 0 &&
+                    krb5_cc_get_principal(krbctx, ccache, &uprinc) == 0 &&
+                    krb5_unparse_name(krbctx, uprinc, &outname) == 0) {
+                    fprintf(fp, "principal %s\n", outname);
+                }
+                /* Logins are repeated, nothing may be kept between them */
+                krb5_free_unparsed_name(krbctx, outname);
+                krb5_free_principal(krbctx, uprinc);
+                if (ccache != NULL) {
+                    krb5_cc_close(krbctx, ccache);
+                }
+                krb5_free_context(krbctx);
+            }
         }
     }
 
-    if (pam_open_session(pamh, 0) != PAM_SUCCESS) {
+    if (timed_pam_call(pam_open_session, pamh, &t_open) != PAM_SUCCESS) {
         fprintf(fp, "open session for %s failed: %s (%d)\n", (char *)username, pam_strerror(pamh, result), result);
     } else {
-        pam_close_session(pamh, 0);
+        timed_pam_call(pam_close_session, pamh, &t_close);
     }
     if (pam_end(pamh, result) != PAM_SUCCESS) {
         fprintf(fp, "end failed:  %s (%d)\n", pam_strerror(pamh, result), result);
     }
 
+    /* One machine-readable record per PAM transaction */
+    fprintf(fp, "Timing user=%s iteration=%d start=%ld.%06ld authenticate=%.6f acct_mgmt=%.6f "
+            "open_session=%.6f close_session=%.6f result=%d\n",
+            (char *)username, iteration, (long)started.tv_sec, started.tv_nsec / 1000,
+            t_auth, t_acct, t_open, t_close, result);
+    return result;
+}
+
+/*
+ * Log the same user in over and over until either the number of
+ * iterations or the duration is reached. The thread fails with the
+ * result of its last failed login, if any.
+ */
+int run_logins(void *username)
+{
+    struct timespec now;
+    int result = 0;
+    int ret;
+    int i;
+
+    for (i = 0; iterations == 0 || i < iterations; i++) {
+        if (duration > 0 && i > 0) {
+            clock_gettime(CLOCK_MONOTONIC, &now);
+            if (now.tv_sec > deadline.tv_sec ||
+                (now.tv_sec == deadline.tv_sec && now.tv_nsec >= deadline.tv_nsec)) {
+                break;
+            }
+        }
+        ret = call_pam(username, i);
+        if (ret != PAM_SUCCESS) {
+            result = ret;
+        }
+    }
+
     fprintf(fp, "Thread returned %i\n", result);
     return result;
 }
@@ -105,6 +177,7 @@ int main(int argc, const char **argv)
     int threads = -1;
     int ipa_logins = 0;
     int ad_logins = 0;
+    int first_user = 0;
     pthread_t *ptr = NULL;
     int *index = NULL;
     char **usernames = NULL;
@@ -120,7 +193,10 @@ int main(int argc, const char **argv)
         {"service", 's', POPT_ARG_STRING, NULL, 's', NULL, "SERVICE"},
         {"threads", 't', POPT_ARG_INT, &threads, 0, NULL, NULL},
         {"ad-threads", 'a', POPT_ARG_INT, &ad_logins, 0, NULL, NULL},
+        {"first-user", 'u', POPT_ARG_INT, &first_user, 0, "Index of the first IPA user to log in", "N"},
         {"fork", 'f', POPT_ARG_NONE, NULL, 'f', NULL, NULL},
+        {"iterations", 'i', POPT_ARG_INT, &iterations, 0, "Logins per thread, 0 for no limit (default 1, or no limit with --duration)", "N"},
+        {"duration", 'd', POPT_ARG_INT, &duration, 0, "Keep logging in for this many seconds", "SECONDS"},
         POPT_AUTOHELP
         POPT_TABLEEND
     };
@@ -163,6 +239,17 @@ int main(int argc, const char **argv)
         goto done;
     }
 
+    if (iterations < -1 || duration < 0) {
+        printf("--iterations and --duration cannot be negative\n");
+        poptPrintUsage(pctx, stdout, 0);
+        ret = 1;
+        goto done;
+    }
+
+    if (iterations == -1) {
+        iterations = duration > 0 ? 0 : 1;
+    }
+
     if (service == NULL) {
         pam_service = strdup("login");
     } else {
@@ -208,7 +295,7 @@ int main(int argc, const char **argv)
     }
 
     for (i = 0; i < ipa_logins; i++) {
-        asprintf(&usernames[i], "user%d%s", i, uinfo.nodename);
+        asprintf(&usernames[i], "user%d%s", first_user + i, uinfo.nodename);
     }
 
     for (i = 0; i < ad_logins; i++) {
@@ -219,6 +306,9 @@ int main(int argc, const char **argv)
         asprintf(&ad_usernames[i], "user%03d%s@ad.test", i, host);
     }
 
+    clock_gettime(CLOCK_MONOTONIC, &deadline);
+    deadline.tv_sec += duration;
+
     if (dofork) {
         for (i = 0; i < ipa_logins; i++) {
             pid = fork();
@@ -228,7 +318,7 @@ int main(int argc, const char **argv)
                 exit(1);
                 break;
             case 0:  /* child */
-                call_pam(usernames[i]);
+                run_logins(usernames[i]);
                 exit(0);
                 break;
             default: /* parent */
@@ -243,21 +333,22 @@ int main(int argc, const char **argv)
                 exit(1);
                 break;
             case 0:  /* child */
-                call_pam(ad_usernames[i]);
+                run_logins(ad_usernames[i]);
                 exit(0);
                 break;
             default: /* parent */
                 break;
             }
         }
-        waitpid(-1, &status, 0);
+        /* Wait for every child, they may be looping for a while */
+        while (waitpid(-1, &status, 0) > 0);
     } else {  // threads
         for (i = 0; i < ipa_logins; i++) {
-            index[i] = pthread_create(&ptr[i], NULL, (void *) call_pam, usernames[i]);
+            index[i] = pthread_create(&ptr[i], NULL, (void *) run_logins, usernames[i]);
         }
 
         for (i = 0; i < ad_logins; i++) {
-            index[ipa_logins + i] = pthread_create(&ptr[ipa_logins + i], NULL, (void *) call_pam, ad_usernames[i]);
+            index[ipa_logins + i] = pthread_create(&ptr[ipa_logins + i], NULL, (void *) run_logins, ad_usernames[i]);
         }
 
         for (i = 0; i < threads; i++) {